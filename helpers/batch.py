@@ -0,0 +1,259 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Stream parsing of batch uploads (POST /files).
+#
+# A batch is either a multipart/form-data request with any number of files, or a tar (optionally
+# gzip/bzip2/xz compressed) or zip archive sent as the request body. The files are extracted one by one
+# while the body is received, so a batch never has to fit in memory:
+#   - multipart: parsed incrementally with werkzeug's MultipartDecoder
+#   - tar:       read sequentially ("r|*" stream mode) in a worker thread, pulling the body from the event loop
+#   - zip:       the central directory is at the end of the archive, so the body is first spooled to a
+#                temporary file (in memory up to "Batch: zip_memory_mb", then on disk)
+#
+# The files are named after their base name (secured): members of different folders with the same name get
+# the folder (then a number) appended, so they do not overwrite each other's metadata and stored images.
+#
+# Configured in the "Batch" section of config.yaml.
+#
+import io
+import os
+import asyncio
+import logging
+import tarfile
+import zipfile
+import mimetypes
+import tempfile
+
+from quart import Request
+from werkzeug.sansio.multipart import MultipartDecoder, File, Data, Epilogue, NeedData
+from werkzeug.utils import secure_filename
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+TAR_TYPES = {"application/x-tar", "application/tar", "application/x-gtar", "application/gzip",
+             "application/x-gzip", "application/x-bzip2", "application/x-xz", "application/x-compressed-tar"}
+ZIP_TYPES = {"application/zip", "application/x-zip-compressed"}
+
+_END = object()  # Returned by next() when a generator running in a worker thread is exhausted
+
+
+class UnsupportedBatch(ValueError):
+    """Raised when the body of a batch upload is neither multipart, tar nor zip."""
+
+
+class BatchUploadRequest(Request):
+    """
+    Quart request applying a separate body size limit ("Batch: max_content_mb") to the batch upload
+    routes. Quart sets the limit when the request is created, before it is routed, hence the subclass.
+    """
+
+    batch_paths = ("/files",)
+    batch_max_content_length = None
+
+    def __init__(self, method, scheme, path, *args, max_content_length=None, **kwargs):
+        if path in self.batch_paths:
+            max_content_length = self.batch_max_content_length
+        super().__init__(method, scheme, path, *args, max_content_length=max_content_length, **kwargs)
+
+
+def is_image(filename):
+    """True if the name of a file in a batch looks like an image (directories, hidden files etc. are skipped)."""
+    name = os.path.basename(filename)
+    if not name or name.startswith("."):
+        return False
+    content_type = mimetypes.guess_type(name)[0]
+    return bool(content_type) and content_type.startswith("image/")
+
+
+class UniqueNames:
+    """
+    Gives the files of a batch secure and unique names: the secured base name of the file, with the name of its
+    folder (then a number) appended if another file of the batch already has it. A file whose name is lost when
+    secured (e.g. non-ASCII characters only) is named "image_<n>", n being its position in the batch.
+    """
+
+    def __init__(self):
+        self._used = set()
+        self._count = 0
+
+    def __call__(self, path):
+        self._count += 1
+        path = path.replace("\\", "/")
+        stem, ext = os.path.splitext(os.path.basename(path))
+        stem = secure_filename(stem) or f"image_{self._count}"
+        ext = secure_filename(ext)
+        ext = f".{ext}" if ext else ""
+        name = f"{stem}{ext}"
+        if name in self._used:
+            folder = secure_filename(os.path.dirname(path))
+            name = f"{stem}_{folder}{ext}" if folder else name
+            number = 2
+            while name in self._used:
+                name = f"{stem}_{number}{ext}"
+                number += 1
+        self._used.add(name)
+        return name
+
+
+def iter_uploaded_files(mimetype, mimetype_params, body, max_file_size, zip_memory_size, body_timeout=None):
+    """
+    Returns an async iterator over the images of a batch upload.
+
+    Args:
+        mimetype (str): Content type of the request, without parameters.
+        mimetype_params (dict): Parameters of the content type (the multipart boundary).
+        body: Async iterable of the chunks of the request body.
+        max_file_size (int): Maximum size of one image, in bytes. Larger images are reported, not loaded.
+        zip_memory_size (int): Size up to which a zip archive is spooled in memory before going to disk.
+        body_timeout (float, optional): Maximum time to wait for a chunk of the body (tar archives).
+
+    Yields:
+        tuple: (secure filename, unique in the batch, content or None, error message or None), one per image.
+
+    Raises:
+        UnsupportedBatch: If the content type is not supported.
+    """
+    if mimetype == "multipart/form-data":
+        boundary = mimetype_params.get("boundary")
+        if not boundary:
+            raise UnsupportedBatch("Multipart request without boundary")
+        return _iter_multipart(body, boundary.encode("latin-1"), max_file_size, UniqueNames())
+    if mimetype in TAR_TYPES:
+        return _iter_tar(body, max_file_size, body_timeout, UniqueNames())
+    if mimetype in ZIP_TYPES:
+        return _iter_zip(body, max_file_size, zip_memory_size, UniqueNames())
+    raise UnsupportedBatch(f"Unsupported content type '{mimetype}', expected multipart/form-data, a tar or a zip archive")
+
+
+def _too_large(name, size, max_file_size):
+    return name, None, f"File is too large ({size} bytes, max. {max_file_size})"
+
+
+async def _iter_multipart(body, boundary, max_file_size, names):
+    decoder = MultipartDecoder(boundary)
+    current = None  # [filename, content, size] of the file part being received, None for form fields
+
+    def feed(chunk):
+        nonlocal current
+        decoder.receive_data(chunk)
+        results = []
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, (NeedData, Epilogue)):
+                return results
+            if isinstance(event, File):
+                current = [event.filename, bytearray(), 0] if is_image(event.filename) else None
+            elif isinstance(event, Data) and current is not None:
+                current[2] += len(event.data)
+                if current[1] is not None:
+                    if current[2] > max_file_size:
+                        current[1] = None  # Too large: skip the rest of the part
+                    else:
+                        current[1] += event.data
+                if not event.more_data:
+                    filename, content, size = current
+                    if content is None:
+                        results.append(_too_large(names(filename), size, max_file_size))
+                    else:
+                        results.append((names(filename), bytes(content), None))
+                    current = None
+            elif not isinstance(event, Data):
+                current = None  # Form field (or preamble)
+
+    async for chunk in body:
+        for item in feed(chunk):
+            yield item
+    for item in feed(None):
+        yield item
+
+
+class _BodyReader(io.RawIOBase):
+    """
+    Blocking file-like view of the request body, for archive readers running in a worker thread.
+    Chunks are pulled from the event loop on demand.
+    """
+
+    def __init__(self, body, loop, timeout=None):
+        self._chunks = body.__aiter__()
+        self._loop = loop
+        self._timeout = timeout
+        self._buffer = b""
+        self._eof = False
+
+    async def _next_chunk(self):
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and not self._eof:
+            chunk = asyncio.run_coroutine_threadsafe(self._next_chunk(), self._loop).result(self._timeout)
+            if chunk is None:
+                self._eof = True
+            else:
+                self._buffer = memoryview(chunk)
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def _archive_members(archive_files, max_file_size, names):
+    """
+    Generator (run in a worker thread) over (name, size, open) of the regular files of an archive.
+    """
+    for name, size, open_member in archive_files:
+        if not is_image(name):
+            continue
+        if size > max_file_size:
+            yield _too_large(names(name), size, max_file_size)
+            continue
+        with open_member() as member:
+            yield names(name), member.read(), None
+
+
+async def _iter_in_thread(generator):
+    """Iterates a blocking generator, each step in a worker thread."""
+    try:
+        while True:
+            item = await asyncio.to_thread(next, generator, _END)
+            if item is _END:
+                return
+            yield item
+    finally:
+        generator.close()
+
+
+async def _iter_tar(body, max_file_size, body_timeout, names):
+    reader = io.BufferedReader(_BodyReader(body, asyncio.get_running_loop(), body_timeout), buffer_size=256 * 1024)
+
+    def members():
+        with tarfile.open(fileobj=reader, mode="r|*") as archive:
+            files = ((member.name, member.size, lambda member=member: archive.extractfile(member))
+                     for member in archive if member.isfile())
+            yield from _archive_members(files, max_file_size, names)
+
+    async for item in _iter_in_thread(members()):
+        yield item
+
+
+async def _iter_zip(body, max_file_size, zip_memory_size, names):
+    with tempfile.SpooledTemporaryFile(max_size=zip_memory_size) as spooled:
+        async for chunk in body:
+            await asyncio.to_thread(spooled.write, chunk)
+
+        def members():
+            with zipfile.ZipFile(spooled) as archive:
+                files = ((info.filename, info.file_size, lambda info=info: archive.open(info))
+                         for info in archive.infolist() if not info.is_dir())
+                yield from _archive_members(files, max_file_size, names)
+
+        async for item in _iter_in_thread(members()):
+            yield item
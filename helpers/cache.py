@@ -0,0 +1,158 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Cache of rendered responses (the index page and the /metadata pages).
+#
+# The metadata only changes when an upload has been processed or entries are pruned, so the serialized
+# responses are kept until then: the server invalidates the cache on every "reading" / "invalidate" event of
+# the event bus (helpers/events.py), in all worker processes. Each cached response carries a (weak) ETag
+# (hash of the body), and its gzip / brotli encodings are computed once, the first time a client asks for them.
+#
+# Brotli is optional: install the "brotli" package to enable it, otherwise gzip is used.
+#
+import os
+import gzip
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 512
+
+
+class CachedResponse:
+    """
+    A rendered response body, with its ETag and its compressed encodings.
+
+    Attributes:
+        body: Uncompressed body (bytes).
+        mimetype: MIME type of the body.
+        etag: ETag of the body (weak: the same for all the encodings of the body).
+    """
+
+    def __init__(self, body, mimetype):
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.mimetype = mimetype
+        self.etag = f'W/"{hashlib.blake2b(self.body, digest_size=12).hexdigest()}"'
+        self._encoded = {}
+
+    def select_encoding(self, accept_encoding):
+        """Returns the best content coding accepted by the client ("br", "gzip") or None."""
+        if len(self.body) < MIN_COMPRESS_SIZE or not accept_encoding:
+            return None
+        accepted = {}
+        for item in accept_encoding.split(","):
+            coding, _, params = item.strip().partition(";")
+            quality = 1.0
+            if params.strip().startswith("q="):
+                try:
+                    quality = float(params.strip()[2:])
+                except ValueError:
+                    pass
+            accepted[coding.strip().lower()] = quality
+        for coding in ("br", "gzip"):
+            if coding == "br" and brotli is None:
+                continue
+            if accepted.get(coding, accepted.get("*", 0)) > 0:
+                return coding
+        return None
+
+    def encoded(self, coding):
+        """Returns the body in the given content coding (None = uncompressed), compressing it once."""
+        if coding is None:
+            return self.body
+        if coding not in self._encoded:
+            if coding == "br":
+                self._encoded[coding] = brotli.compress(self.body, quality=5)
+            else:
+                self._encoded[coding] = gzip.compress(self.body, compresslevel=6)
+        return self._encoded[coding]
+
+
+class ResponseCache:
+    """
+    LRU cache of rendered responses, invalidated as a whole.
+
+    Concurrent requests for the same missing key wait for a single rendering. A rendering started before
+    an invalidation is returned to its callers, but not cached.
+    """
+
+    def __init__(self, max_entries=64, enabled=True):
+        self.max_entries = int(max_entries)
+        self.enabled = bool(enabled)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}  # key -> Future of the rendering in progress
+        self._generation = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates the cache from the "Cache" section of config.yaml."""
+        return cls(
+            max_entries=config.get("Cache", "max_entries", 64),
+            enabled=config.get("Cache", "enabled", True),
+        )
+
+    def invalidate(self):
+        """Forgets all cached responses."""
+        self._generation += 1
+        self._entries.clear()
+
+    async def get(self, key, render, mimetype):
+        """
+        Returns the cached response for `key`, rendering it with `render` if needed.
+
+        Args:
+            key: Hashable key of the response (e.g. the route and its query parameters).
+            render: Coroutine function returning the body (str or bytes).
+            mimetype (str): MIME type of the body.
+
+        Returns:
+            CachedResponse
+        """
+        if not self.enabled:
+            return CachedResponse(await render(), mimetype)
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        generation = self._generation
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            entry = CachedResponse(await render(), mimetype)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as ex:
+            future.set_exception(ex)
+            future.exception()  # Retrieved: the waiting requests (if any) get it
+            raise
+        finally:
+            self._pending.pop(key, None)
+
+        future.set_result(entry)
+        if generation == self._generation:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
@@ -4,7 +4,9 @@
 # Read a YAML File containing configuration parameters into a dictionary.
 #
 # Methods: "get(variable)" : returns the value of the given variable 
+#          "read_config()" : re-reads the file, raising on errors (used to reload it, see helpers/hot_reload.py)
 #
+import copy
 import yaml
 import os
 
@@ -26,10 +28,9 @@ class ConfigLoader:
         """
         
         try:
-            with open(self.config_path, "r") as f:
-                config_data = yaml.safe_load(f)  # Use safe_load for security.
-                print(f"Loaded configuration from {self.config_path}")
-                return config_data
+            config_data = self.read_config()
+            print(f"Loaded configuration from {self.config_path}")
+            return config_data
         except FileNotFoundError:
             print(f"Configuration file {self.config_path} not found. Exiting...")
             exit()
@@ -37,6 +38,28 @@ class ConfigLoader:
             print(f"Error parsing YAML file {self.config_path}: {e}. Exiting...")
             exit()
 
+    def read_config(self):
+        """
+        Read the configuration file, without exiting on errors.
+
+        :return: The configuration data (dictionary).
+        :raises OSError: If the file cannot be read.
+        :raises yaml.YAMLError: If the file is not valid YAML, or not a mapping of sections.
+        """
+        with open(self.config_path, "r") as f:
+            config_data = yaml.safe_load(f)  # Use safe_load for security.
+        if not isinstance(config_data, dict):
+            raise yaml.YAMLError(f"{self.config_path} does not contain a mapping of sections")
+        return config_data
+
+    def with_data(self, config_data):
+        """
+        Return a ConfigLoader for the same file, holding the given configuration data (the file is not read).
+        """
+        clone = copy.copy(self)
+        clone.config_data = config_data
+        return clone
+
     def get(self, topic, key, default=None):
         """
         Get a configuration value by topic and key, with an optional default.
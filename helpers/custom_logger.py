@@ -1,34 +1,217 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Logging of the application.
+#
+# The records are handed over to a QueueHandler: the thread logging a record only puts it in a queue, a
+# QueueListener thread formats it and writes it to the console and the rotating log file. The disk I/O is off
+# the request path, and a slow disk or console never blocks the event loop.
+#
+# Configured by the "Logging" section of config.yaml (LOG_LEVEL in the environment overrides "level"):
+#   - format: "text" (default) or "json" (one object per line, for log shippers)
+#   - request_ids: add the id of the current request / job to the records (X-Request-Id, see server.py)
+#   - sampling: keep only 1 of N records of chatty messages, by message (the format string, e.g.
+#               "Inside process_Image %s") or by level ("DEBUG"). Warnings and errors are never sampled,
+#               unless named explicitly
+#
+# With several worker processes (helpers/workers.py), only the supervisor writes the log files: its listeners
+# read multiprocessing queues, which the forked processes put their records in (see share_with_children).
+#
+# The overhead of logging on the request path can be measured with:
+#    >python -m helpers.custom_logger
+#
 import os
+import sys
+import copy
+import json
+import time
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+import tempfile
+import itertools
+import contextvars
+import multiprocessing.util
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
-def setup_logging(logger_name=None, log_file=None, log_level=None, max_log_size=0.5 * 1024 * 1024, backup_count=5):
+# Id of the request (or job) being processed, added to the log records when "Logging: request_ids" is set
+request_id = contextvars.ContextVar("request_id", default="-")
+
+TEXT_FORMAT = '%(asctime)s - %(filename)s:%(lineno)d - %(levelname)s - %(message)s'
+TEXT_FORMAT_WITH_REQUEST_ID = '%(asctime)s - %(filename)s:%(lineno)d - %(levelname)s - [%(request_id)s] %(message)s'
+
+# Listeners of the loggers set up in this process (restarted in forked children, see _restart_listeners)
+_listeners = []
+
+# multiprocessing context whose children send their records to the listeners of this process, or None
+_shared_context = None
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds the id of the current request (`request_id` context variable) to the records."""
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps 1 of N records of the sampled messages.
+
+    Args:
+        rates (dict): N by message (format string of the record) or by level name. A message rate
+                      takes precedence over its level rate.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.message_rates = {}
+        self.level_rates = {}
+        for key, rate in (rates or {}).items():
+            if str(key).upper() in logging.getLevelNamesMapping():
+                self.level_rates[logging.getLevelNamesMapping()[str(key).upper()]] = max(1, int(rate))
+            else:
+                self.message_rates[key] = max(1, int(rate))
+        self._counters = {}
+
+    def filter(self, record):
+        rate = self.message_rates.get(record.msg) if isinstance(record.msg, str) else None
+        if rate is None:
+            rate = self.level_rates.get(record.levelno)
+        if rate is None or rate == 1:
+            return True
+        counter = self._counters.get((record.msg, record.levelno))
+        if counter is None:
+            counter = self._counters.setdefault((record.msg, record.levelno), itertools.count())
+        return next(counter) % rate == 0  # The first one, then every N-th one
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler leaving the formatting to the listener: only the message is merged with its arguments
+    (they may change once the call returns), and the traceback rendered, in the logging thread.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None  # The traceback keeps the frames alive
+        return record
+
+
+_exception_formatter = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats the records as JSON objects, one per line."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "file": f"{record.filename}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", "-") != "-":
+            entry["request_id"] = record.request_id
+        if record.exc_text or record.exc_info:
+            entry["exception"] = record.exc_text or self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def _restart_listeners():
+    """
+    In a forked child, the listener threads are gone: start new ones, on new queues. Unless the records are
+    sent to the listeners of the parent (share_with_children): the child keeps putting them in the shared queues.
+    """
+    for listener, queue_handler in _listeners:
+        listener._thread = None
+        if _shared_context is None:
+            listener.queue = queue_handler.queue = queue.SimpleQueue()
+            listener.start()
+
+
+def share_with_children(ctx):
+    """
+    Called by a supervisor before it forks its worker processes: the records of the children are sent to the
+    listeners of this process, through multiprocessing queues, instead of being written by each child. Log files
+    rotated by several processes at once lose records (RotatingFileHandler is not safe across processes).
+    Applies to the loggers set up before and after the call.
+
+    Args:
+        ctx: multiprocessing context the children are started with.
+    """
+    global _shared_context
+    _shared_context = ctx
+    for listener, queue_handler in _listeners:
+        if listener._thread is not None:
+            listener.stop()  # Writes the records still queued
+        listener.queue = queue_handler.queue = ctx.Queue()
+        listener.start()
+
+
+def _stop_listeners():
+    for listener, _ in _listeners:
+        if listener._thread is not None:
+            listener.stop()  # Writes the records still queued
+
+
+class _ForkHook:
+    """multiprocessing children end with os._exit(), without the atexit handlers: stop the listeners on exit."""
+
+    def __call__(self, _):
+        multiprocessing.util.Finalize(None, _stop_listeners, exitpriority=0)
+
+
+_fork_hook = _ForkHook()
+os.register_at_fork(after_in_child=_restart_listeners)
+multiprocessing.util.register_after_fork(_fork_hook, _fork_hook)
+atexit.register(_stop_listeners)
+
+
+def setup_logging(logger_name=None, log_file=None, log_level=None, max_log_size=0.5 * 1024 * 1024, backup_count=5,
+                  config=None):
     """
     Sets up the standard Python logger.
 
     Args:
         logger_name (str, optional): Name of the logger. Defaults to the filename.
         log_file (str, optional): Path to the log file. Defaults to './log/{logger_name}.log'.
-        log_level (int, optional): Logging level. Defaults to value set in ENV variable, or DEBUG if not set.
+        log_level (int, optional): Logging level. Defaults to value set in ENV variable, else "Logging: level", else INFO.
         max_log_size (int, optional): Maximum size of the log file in bytes. Defaults to 0.5 MB.
         backup_count (int, optional): Number of backup log files to keep. Defaults to 5.
+        config (ConfigLoader, optional): Configuration with the "Logging" section (format, request ids, sampling).
     """
 
+    def setting(key, default):
+        return config.get("Logging", key, default) if config is not None else default
+
     if not log_level:
-        log_level_env = os.environ.get("LOG_LEVEL")
+        log_level_env = os.environ.get("LOG_LEVEL") or str(setting("level", "INFO")).upper()
         if log_level_env in list(logging.getLevelNamesMapping()):
             log_level = logging.getLevelNamesMapping()[log_level_env]
         else:
-            log_level = logging.DEBUG
+            log_level = logging.INFO
 
     logger_name = logger_name or os.path.splitext(os.path.basename(__file__))[0]
     log_file = log_file or f"./log/{logger_name}.log"
 
     logger = logging.getLogger(logger_name)
+    if any(isinstance(handler, DeferredQueueHandler) for handler in logger.handlers):
+        return logger  # Set up already (e.g. by the supervisor of the worker processes)
     logger.setLevel(log_level)
 
-    # Formatter with filename and line number
-    formatter = logging.Formatter('%(asctime)s - %(filename)s:%(lineno)d - %(levelname)s - %(message)s')
+    # Formatter with filename and line number (and the request id, if enabled)
+    with_request_ids = bool(setting("request_ids", False))
+    if str(setting("format", "text")).lower() == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT_WITH_REQUEST_ID if with_request_ids else TEXT_FORMAT)
 
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
@@ -44,14 +227,91 @@ def setup_logging(logger_name=None, log_file=None, log_level=None, max_log_size=
 
     file_handler = RotatingFileHandler(
         log_file,
-        maxBytes=int(max_log_size),
-        backupCount=backup_count
+        maxBytes=int(float(setting("max_file_mb", max_log_size / (1024 * 1024))) * 1024 * 1024),
+        backupCount=int(setting("backup_count", backup_count))
     )
     file_handler.setLevel(log_level)
     file_handler.setFormatter(formatter)
 
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    # The logging thread only queues the records, the listener thread formats and writes them
+    queue_handler = DeferredQueueHandler(queue.SimpleQueue() if _shared_context is None else _shared_context.Queue())
+    if with_request_ids or isinstance(formatter, JsonFormatter):
+        queue_handler.addFilter(RequestIdFilter())
+    sampling = setting("sampling", None)
+    if sampling:
+        queue_handler.addFilter(SamplingFilter(sampling))  # Sampled out records are not even queued
+    listener = QueueListener(queue_handler.queue, console_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    _listeners.append((listener, queue_handler))
+
+    logger.addHandler(queue_handler)
     logger.log(log_level, f"--------- Logging started --------- Log-Level: {logging.getLevelName(log_level)}")
 
     return logger
+
+
+def benchmark(records=20000):
+    """
+    Measures the time spent in the logging calls of a request: the 9 records of an upload (process_image and
+    handle_file_upload), with direct handlers (before) and with the queue handler, with and without sampling.
+    Only the time of the calls is measured: the listener thread writes the records in the background.
+    """
+
+    def run(logger):
+        start = time.perf_counter()
+        for index in range(records // 9):
+            logger.debug("Inside Handle file Upload")
+            logger.debug("Request files: %s", {"file": f"image_{index}.jpg"})
+            logger.info("Processing file: %s, MIME type: %s", f"image_{index}.jpg", "image/jpeg")
+            logger.debug("Inside process_Image %s", f"image_{index}.jpg")
+            logger.debug("Frame Shape returned from 'detect_frame': %s", (480, 640, 3))
+            logger.debug("Counter Shape returned from 'detect_counter': %s", (120, 480, 3))
+            logger.debug("Detected Meter Value: %i (confidence %.2f)", 40276, 0.93)
+            logger.debug("Image Data Stored in MongoDB %s: Value: %i", f"image_{index}.jpg", 40276)
+            logger.info("Image %s processed", f"image_{index}.jpg")
+        return (time.perf_counter() - start) / (records // 9) * 1e6  # Microseconds per request
+
+    results = {}
+    with tempfile.TemporaryDirectory() as log_dir:
+        devnull = open(os.devnull, "w")
+        # Before: console and file handlers called by the logging thread
+        direct = logging.getLogger("benchmark-direct")
+        direct.propagate = False
+        direct.setLevel(logging.DEBUG)
+        for handler in (logging.StreamHandler(devnull),
+                        RotatingFileHandler(os.path.join(log_dir, "direct.log"), maxBytes=512 * 1024, backupCount=5)):
+            handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+            direct.addHandler(handler)
+        results["direct handlers"] = run(direct)
+
+        class Settings:
+            def __init__(self, settings):
+                self.settings = settings
+
+            def get(self, section, key, default=None):
+                return self.settings.get(key, default)
+
+        stderr, sys.stderr = sys.stderr, devnull  # The console handler of setup_logging writes to stderr
+        try:
+            for name, settings in (("queue handler", {"level": "DEBUG"}),
+                                   ("queue handler, json + request ids", {"level": "DEBUG", "format": "json",
+                                                                          "request_ids": True}),
+                                   ("queue handler, DEBUG sampled 1/10", {"level": "DEBUG", "sampling": {"DEBUG": 10}}),
+                                   ("queue handler, INFO", {"level": "INFO"})):
+                logger = setup_logging(f"benchmark-{len(results)}", os.path.join(log_dir, f"{len(results)}.log"),
+                                       config=Settings(settings))
+                logger.propagate = False
+                results[name] = run(logger)
+                _stop_listeners()  # Let the listener write the backlog, before the next measurement
+        finally:
+            _stop_listeners()
+            sys.stderr = stderr
+            devnull.close()
+
+    for name, micros in results.items():
+        print(f"{name:40s} {micros:8.1f} µs per request")
+    return results
+
+
+if __name__ == "__main__":
+    benchmark()
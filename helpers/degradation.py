@@ -0,0 +1,154 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Load shedding: degrade the processing of uploads when they arrive faster than they can be processed.
+#
+# The LoadShedder watches the depth of the job queue and the recent latency of the jobs (submission to end),
+# and picks a degradation level, each level dropping more optional work:
+#   0 FULL                 everything
+#   1 NO_PLOTS             the annotated plots (frame / counter / digits) are not rendered nor stored
+#   2 NO_THUMBNAILS        ... and the thumbnail of the counter is not generated
+#   3 NO_ORIGINALS         ... and the original upload is not persisted (disk / image store)
+#   4 REDUCED_RESOLUTION   ... and the frame and counter are detected at a lower input resolution
+#
+# The level goes up as soon as a threshold is crossed, and down one level at a time, once the load is well
+# below the thresholds of the current level and the level was held for a while (no flapping).
+# The recent latency decays with the time since the last job finished (half-life "latency_half_life_seconds"),
+# so an idle server recovers without waiting for new jobs. When the queue drains, the level goes straight
+# back to full processing.
+# The current level is exported as the "meterreader_degradation_level" metric.
+#
+# Configured in the "Degradation" section of config.yaml.
+#
+import os
+import time
+import logging
+
+from helpers import metrics
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+# Degradation levels
+FULL = 0
+NO_PLOTS = 1
+NO_THUMBNAILS = 2
+NO_ORIGINALS = 3
+REDUCED_RESOLUTION = 4
+
+LEVEL_NAMES = {FULL: "full", NO_PLOTS: "no plots", NO_THUMBNAILS: "no thumbnails",
+               NO_ORIGINALS: "no originals", REDUCED_RESOLUTION: "reduced resolution"}
+
+DEGRADATION_LEVEL = metrics.gauge("meterreader_degradation_level",
+                                  "Current load shedding level (0 = full processing, 4 = reduced resolution)")
+DEGRADATION_CHANGES = metrics.counter("meterreader_degradation_changes_total",
+                                      "Changes of the load shedding level, by new level", ["level"])
+
+
+class LoadShedder:
+    """
+    Picks the degradation level from the queue depth and the recent job latency.
+
+    Attributes:
+        enabled: False to always process uploads in full.
+        queue_depth: Queue depth from which each level (1 to 4) is entered.
+        latency_seconds: Recent job latency from which each level (1 to 4) is entered.
+        recover_ratio: A level is left when both signals are below this fraction of its thresholds.
+        min_hold_seconds: Minimum time spent at a level before stepping down.
+        imgsz_scale: Scale of the input resolution of the frame / counter detections at REDUCED_RESOLUTION.
+        latency_half_life_seconds: Time after which the recent latency is halved, if no job finishes (0 = never).
+        level: Current degradation level.
+        latency: Exponentially weighted average of the latency of the recent jobs, in seconds, when the last
+                 one finished (see recent_latency()).
+    """
+
+    def __init__(self, enabled=True, queue_depth=(4, 8, 16, 24), latency_seconds=(10, 20, 40, 60),
+                 recover_ratio=0.5, min_hold_seconds=10, imgsz_scale=0.5, latency_half_life_seconds=30):
+        self.enabled = bool(enabled)
+        self.queue_depth = [float(value) for value in queue_depth][:REDUCED_RESOLUTION]
+        self.latency_seconds = [float(value) for value in latency_seconds][:REDUCED_RESOLUTION]
+        if len(self.queue_depth) != REDUCED_RESOLUTION or len(self.latency_seconds) != REDUCED_RESOLUTION:
+            raise ValueError(f"Degradation: queue_depth and latency_seconds need {REDUCED_RESOLUTION} thresholds each")
+        self.recover_ratio = float(recover_ratio)
+        self.min_hold_seconds = float(min_hold_seconds)
+        self.imgsz_scale = float(imgsz_scale)
+        self.latency_half_life_seconds = float(latency_half_life_seconds)
+        self.level = FULL
+        self.latency = 0.0
+        self._changed_at = self._latency_at = time.monotonic()
+        DEGRADATION_LEVEL.set(self.level)
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates the load shedder from the "Degradation" section of config.yaml."""
+        return cls(
+            enabled=config.get("Degradation", "enabled", True),
+            queue_depth=config.get("Degradation", "queue_depth", [4, 8, 16, 24]),
+            latency_seconds=config.get("Degradation", "latency_seconds", [10, 20, 40, 60]),
+            recover_ratio=config.get("Degradation", "recover_ratio", 0.5),
+            min_hold_seconds=config.get("Degradation", "min_hold_seconds", 10),
+            imgsz_scale=config.get("Degradation", "imgsz_scale", 0.5),
+            latency_half_life_seconds=config.get("Degradation", "latency_half_life_seconds", 30),
+        )
+
+    def recent_latency(self, now=None):
+        """Average latency of the recent jobs, decayed by the time elapsed since the last one finished."""
+        now = time.monotonic() if now is None else now
+        if self.latency_half_life_seconds <= 0:
+            return self.latency
+        return self.latency * 0.5 ** (max(0.0, now - self._latency_at) / self.latency_half_life_seconds)
+
+    def observe_job(self, status, queue_depth=None):
+        """
+        Job listener: averages the latency of the finished jobs (status dict of helpers/jobs.py), and
+        re-evaluates the level if the current queue depth is given.
+        """
+        if status.get("finished_at") and status.get("submitted_at"):
+            now = time.monotonic()
+            latency = status["finished_at"] - status["submitted_at"]
+            self.latency = 0.7 * self.recent_latency(now) + 0.3 * latency
+            self._latency_at = now
+            if queue_depth is not None:
+                self.update(queue_depth)
+
+    def _pressure_level(self, queue_depth, latency, ratio=1.0):
+        """Highest level whose queue depth or latency threshold (times `ratio`) is reached."""
+        level = FULL
+        for index, (depth, threshold) in enumerate(zip(self.queue_depth, self.latency_seconds), start=1):
+            if queue_depth >= depth * ratio or latency >= threshold * ratio:
+                level = index
+        return level
+
+    def update(self, queue_depth):
+        """
+        Re-evaluates the level for the current queue depth (called when a job starts, and when one finishes).
+
+        Returns:
+            int: The degradation level the job is processed with.
+        """
+        if not self.enabled:
+            return FULL
+        now = time.monotonic()
+        if queue_depth == 0 and self.level > FULL and now - self._changed_at >= self.min_hold_seconds:
+            # The queue drained: the average latency is made of the waits of the jobs it held, start over
+            self.latency = 0.0
+            self._set_level(FULL, queue_depth, now)
+            return self.level
+        latency = self.recent_latency(now)
+        target = self._pressure_level(queue_depth, latency)
+        if target > self.level:
+            self._set_level(target, queue_depth, now)
+        elif (self.level > FULL and now - self._changed_at >= self.min_hold_seconds
+              and self._pressure_level(queue_depth, latency, self.recover_ratio) < self.level):
+            self._set_level(self.level - 1, queue_depth, now)
+        return self.level
+
+    def _set_level(self, level, queue_depth, now):
+        log = logger.warning if level > self.level else logger.info
+        log("Load shedding level %i (%s): queue depth %i, recent latency %.1f seconds",
+            level, LEVEL_NAMES[level], queue_depth, self.recent_latency(now))
+        self.level = level
+        self._changed_at = now
+        DEGRADATION_LEVEL.set(level)
+        DEGRADATION_CHANGES.inc(level=level)
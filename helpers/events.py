@@ -0,0 +1,276 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Event bus shared by the server processes.
+#
+# When the application is served by several worker processes (helpers/workers.py), a reading processed by one
+# worker must reach the WebSocket clients and the in-process caches of all the others. Events are published
+# on an EventBus, and every worker subscribes to it. Implementations, selected with "Events: backend":
+#   - local:         single process, events are only delivered in-process
+#   - ipc:           Unix datagram sockets, one per worker process, in "Events: ipc_directory"
+#   - changestream:  MongoDB change stream on the metadata collection (needs a replica set). Also sees the
+#                    changes made by other hosts, or by tools writing to MongoDB directly.
+#   - auto:          ipc when several workers are configured, local otherwise
+#
+# Events are JSON-serializable dictionaries with a "type":
+#   reading      a new result (filename, value, value_str, processed_at, thumbnail_url, meter_id)
+#   invalidate   metadata was deleted (retention), everything derived from it must be reloaded
+#
+import os
+import json
+import socket
+import asyncio
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+# Maximum size of an event sent between processes (Unix datagram)
+MAX_EVENT_SIZE = 64 * 1024
+
+
+def reading_event(filename, value, value_str, processed_at, has_thumbnail, meter_id=None, device_id=None,
+                  plausibility=None):
+    """
+    Builds the (compact) event published when an image has been processed.
+
+    Args:
+        filename (str): Name of the processed image.
+        value (int): Detected value (0 if none).
+        value_str (str): Detected digits.
+        processed_at (str): ISO 8601 date of the processing.
+        has_thumbnail (bool): True if a thumbnail of the counter is stored with the metadata.
+        meter_id (str, optional): Id of the meter of the image (helpers/meters.py).
+        device_id (str, optional): Device id the value was published to (Home Assistant, readings time-series).
+        plausibility (tuple, optional): (verdict, reason) of the plausibility filter; None if no value was read.
+    """
+    verdict, reason = plausibility if plausibility else (None, None)
+    return {
+        "type": "reading",
+        "filename": filename,
+        "value": value,
+        "value_str": value_str,
+        "processed_at": processed_at,
+        "thumbnail_url": f"/thumbnail/{quote(filename)}" if has_thumbnail else None,
+        "meter_id": meter_id,
+        "device_id": device_id,
+        "plausibility": verdict,
+        "rejected_reason": reason,
+    }
+
+
+class EventBus:
+    """
+    In-process event bus, and base class of the inter-process implementations.
+
+    Subscribers are called on the event loop with the event (dict). Events published by this process
+    carry its pid in "origin", events received from elsewhere carry another pid (or None).
+    """
+
+    def __init__(self):
+        self.subscribers = []
+        self._loop = None
+
+    def subscribe(self, callback):
+        """Registers a callable, called with every event."""
+        self.subscribers.append(callback)
+
+    def start(self):
+        """Starts receiving events (on the running event loop)."""
+        self._loop = asyncio.get_running_loop()
+
+    async def stop(self):
+        """Stops receiving events."""
+
+    def publish(self, event):
+        """Publishes an event to the subscribers of all processes. Must be called on the event loop."""
+        self._deliver({**event, "origin": os.getpid()})
+
+    def _deliver(self, event):
+        for callback in self.subscribers:
+            try:
+                callback(event)
+            except Exception as ex:
+                logger.error("Error in event subscriber: %s", ex)
+
+
+class UnixSocketEventBus(EventBus):
+    """
+    Event bus between the processes of one host: each process binds a Unix datagram socket in a shared
+    directory, and publishing sends the event to all the sockets found there.
+    """
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self._sock = None
+        self._path = None
+
+    def start(self):
+        super().start()
+        self._path = os.path.join(self.directory, f"{os.getpid()}.sock")
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self._path)
+        self._sock.setblocking(False)
+        self._loop.add_reader(self._sock.fileno(), self._receive)
+        logger.info("Event bus listening on %s", self._path)
+
+    async def stop(self):
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+            try:
+                os.unlink(self._path)
+            except FileNotFoundError:
+                pass
+
+    def publish(self, event):
+        event = {**event, "origin": os.getpid()}
+        self._deliver(event)
+        if self._sock is None:
+            return
+        data = json.dumps(event).encode("utf-8")
+        if len(data) > MAX_EVENT_SIZE:
+            logger.error("Event of %i bytes is too large to be sent to the other processes", len(data))
+            return
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path == self._path or not name.endswith(".sock"):
+                continue
+            try:
+                self._sock.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Socket left behind by a process that is gone
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                logger.warning("Event dropped: process listening on %s is not keeping up", path)
+            except OSError as ex:
+                logger.error("Error sending event to %s: %s", path, ex)
+
+    def _receive(self):
+        while True:
+            try:
+                data = self._sock.recv(MAX_EVENT_SIZE)
+            except (BlockingIOError, OSError):
+                return
+            try:
+                self._deliver(json.loads(data))
+            except ValueError as ex:
+                logger.error("Invalid event received: %s", ex)
+
+
+class ChangeStreamEventBus(EventBus):
+    """
+    Event bus fed by a MongoDB change stream on the metadata collection: every process (on any host)
+    sees every processed image and every deletion. The change stream is read in a background thread.
+
+    Reading events published locally are delivered right away; the same change, seen again on the
+    change stream, is then skipped.
+    """
+
+    def __init__(self, collection, retry_seconds=5):
+        super().__init__()
+        self.collection = collection
+        self.retry_seconds = retry_seconds
+        self._thread = None
+        self._stopping = threading.Event()
+        self._published = OrderedDict()  # (filename, processed_at) of the events published by this process
+
+    def start(self):
+        super().start()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._watch, name="event-bus-changestream", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join, 5)
+            self._thread = None
+
+    def publish(self, event):
+        if event.get("type") == "reading":
+            self._published[(event.get("filename"), event.get("processed_at"))] = True
+            while len(self._published) > 256:
+                self._published.popitem(last=False)
+        super().publish(event)
+
+    def _watch(self):
+        resume_token = None
+        while not self._stopping.is_set():
+            try:
+                with self.collection.watch(full_document="updateLookup", resume_after=resume_token,
+                                           max_await_time_ms=1000) as stream:
+                    logger.info("Event bus watching the change stream of %s", self.collection.name)
+                    while not self._stopping.is_set():
+                        change = stream.try_next()
+                        if change is None:
+                            continue
+                        resume_token = stream.resume_token
+                        event = self._to_event(change)
+                        if event is not None:
+                            self._loop.call_soon_threadsafe(self._deliver_remote, event)
+            except Exception as ex:
+                logger.error("Error on the change stream of %s: %s, retrying in %i seconds",
+                             self.collection.name, ex, self.retry_seconds)
+                self._stopping.wait(self.retry_seconds)
+
+    def _deliver_remote(self, event):
+        if self._published.pop((event.get("filename"), event.get("processed_at")), None):
+            return  # Published (and delivered) by this process
+        self._deliver(event)
+
+    @staticmethod
+    def _to_event(change):
+        operation = change.get("operationType")
+        if operation in ("insert", "update", "replace"):
+            document = change.get("fullDocument")
+            if not document or "processed_at" not in document:
+                return None
+            event = reading_event(document.get("filename"), document.get("value_int", 0), document.get("value_str", ""),
+                                  document.get("processed_at"), bool(document.get("detected_thumbnail")),
+                                  meter_id=document.get("meter"),
+                                  plausibility=(document["plausibility"], document.get("rejected_reason"))
+                                  if document.get("plausibility") else None)
+        elif operation in ("delete", "drop", "invalidate"):
+            event = {"type": "invalidate"}
+        else:
+            return None
+        return {**event, "origin": None}
+
+
+def create_event_bus(config, db_handler, worker_count=1):
+    """
+    Create the event bus selected in config.yaml ("Events: backend").
+
+    Args:
+        config: Configuration object.
+        db_handler: MongoDBHandler, whose metadata collection is watched by the changestream backend.
+        worker_count (int): Number of worker processes serving the application.
+
+    Returns:
+        EventBus: The event bus.
+    """
+    backend = (config.get("Events", "backend", "auto") or "auto").lower()
+    if backend == "auto":
+        backend = "ipc" if worker_count > 1 else "local"
+    if backend == "local":
+        return EventBus()
+    if backend == "ipc":
+        directory = config.get("Events", "ipc_directory") or os.path.join(tempfile.gettempdir(), "meterreader-events")
+        return UnixSocketEventBus(directory)
+    if backend == "changestream":
+        return ChangeStreamEventBus(db_handler.collection)
+    raise ValueError(f"Unknown event bus backend '{backend}', expected 'auto', 'local', 'ipc' or 'changestream'")
@@ -0,0 +1,251 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Hot reload of config.yaml: new thresholds, weights or meters without restarting the server.
+#
+# The HotReloader watches the directory of config.yaml with watchdog. When the file changes (saved in place, or
+# replaced by an editor / a deployment), it waits for the writes to settle ("debounce_seconds"), then:
+#   1. reads and validates the new file: YAML syntax, the "Meters" section, the weights files of every meter,
+#      the confidence thresholds and the "Plausibility" settings. An invalid file is logged and ignored: the
+#      server keeps running with the configuration it has
+#   2. creates the new MeterRegistry and loads its models in a worker thread. The models of unchanged weights
+#      files are reused as they are, only the new ones are loaded and warmed up (one inference on a blank image)
+#   3. hands the new registry to the server, which swaps it in with a single assignment: the jobs started from
+#      then on use the new readers, the jobs in flight finish with the readers they started with (the old
+#      models are freed once the last of them is done). The uploads are never paused nor dropped.
+#
+# Only the "YOLO", "Meters" and "Plausibility" sections are applied on the fly: they are the only sections copied
+# into the running configuration. Changes to the other sections are logged, and take effect on the next restart.
+#
+# Reloads are counted by the "meterreader_config_reloads_total" metric, by outcome (applied, invalid, failed).
+# Configured in the "HotReload" section of config.yaml.
+#
+import os
+import re
+import asyncio
+import logging
+
+import yaml
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+from helpers import metrics
+from helpers.meters import MeterRegistry
+from helpers.plausibility import DEFAULT_SETTINGS
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+CONFIG_RELOADS = metrics.counter("meterreader_config_reloads_total", "Reloads of config.yaml, by outcome", ["outcome"])
+
+# Sections of config.yaml applied without a restart
+RELOADABLE_SECTIONS = ("YOLO", "Meters", "Plausibility")
+
+# Detection stages of a MeterReader
+STAGES = ("frame", "counter", "digits")
+
+
+def validate_config(config):
+    """
+    Checks the sections of a configuration that are applied on a reload.
+
+    Args:
+        config (ConfigLoader): The configuration to check.
+
+    Returns:
+        list: The problems found (empty if the configuration can be applied).
+    """
+    errors = []
+    weights = config.get("YOLO", "weights") or {}
+    if not isinstance(weights, dict) or any(stage not in weights for stage in STAGES):
+        return [f"YOLO: weights must name the weights file of each of {', '.join(STAGES)}"]
+    weights_path = config.get("YOLO", "weights_path") or ""
+
+    try:
+        registry = MeterRegistry.from_config(config)
+    except (ValueError, TypeError, AttributeError, re.error) as ex:
+        return [f"Meters: {ex}"]
+    for meter in registry:
+        for stage, filename in {**weights, **meter.weights}.items():
+            if stage not in STAGES:
+                errors.append(f"Meters: {meter.id}: unknown weights stage '{stage}'")
+            elif not os.path.isfile(os.path.join(weights_path, filename)):
+                errors.append(f"Meters: {meter.id}: weights file {os.path.join(weights_path, filename)} not found")
+        for stage, value in meter.confidence.items():
+            try:
+                valid = stage in STAGES and 0 < float(value) <= 1
+            except (TypeError, ValueError):
+                valid = False
+            if not valid:
+                errors.append(f"Meters: {meter.id}: invalid confidence threshold {stage}: {value}")
+        for key in meter.plausibility:
+            if key not in DEFAULT_SETTINGS:
+                errors.append(f"Meters: {meter.id}: unknown plausibility setting '{key}'")
+
+    for key, default in DEFAULT_SETTINGS.items():
+        value = config.get("Plausibility", key, default)
+        if isinstance(default, bool):
+            continue
+        try:
+            if float(value) < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            errors.append(f"Plausibility: {key} must be a positive number, not {value!r}")
+    return errors
+
+
+class HotReloader(FileSystemEventHandler):
+    """
+    Reloads config.yaml when it changes, and hands the validated new meters to the server.
+
+    Attributes:
+        config: ConfigLoader of the running server (its reloadable sections are replaced on every applied reload).
+        registry: Function returning the MeterRegistry in use (its models are reused).
+        apply: Function (config, registry) swapping the new configuration and meters in. Called on the event loop.
+        debounce_seconds: Time without changes to the file before it is reloaded.
+        warmup: True to run the newly loaded models once before they are swapped in.
+    """
+
+    def __init__(self, config, registry, apply, debounce_seconds=1.0, warmup=True):
+        super().__init__()
+        self.config = config
+        self.registry = registry
+        self.apply = apply
+        self.debounce_seconds = float(debounce_seconds)
+        self.warmup = bool(warmup)
+        self.path = os.path.realpath(config.config_path)
+        self._loop = None
+        self._observer = None
+        self._timer = None
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def from_config(cls, config, registry, apply):
+        """
+        Creates the reloader from the "HotReload" section of config.yaml.
+
+        Returns:
+            HotReloader or None: None if disabled.
+        """
+        if not config.get("HotReload", "enabled", True):
+            return None
+        return cls(
+            config,
+            registry,
+            apply,
+            debounce_seconds=config.get("HotReload", "debounce_seconds", 1),
+            warmup=config.get("HotReload", "warmup", True),
+        )
+
+    def start(self):
+        """Starts watching config.yaml. Called on the event loop of the server."""
+        self._loop = asyncio.get_running_loop()
+        self._observer = Observer()
+        self._observer.schedule(self, os.path.dirname(self.path), recursive=False)
+        self._observer.daemon = True
+        self._observer.start()
+        logger.info("Watching %s for changes", self.path)
+
+    async def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            await asyncio.to_thread(self._observer.join)
+            self._observer = None
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def on_any_event(self, event):
+        """watchdog callback, on the thread of the observer."""
+        if event.is_directory or event.event_type not in ("created", "modified", "moved"):
+            return  # Not the opened / closed events of reading the file
+        paths = (event.src_path, getattr(event, "dest_path", ""))
+        if any(path and os.path.realpath(path) == self.path for path in paths):
+            self._loop.call_soon_threadsafe(self._changed)
+
+    def _changed(self):
+        # Editors write the file in several steps: reload once the writes have settled
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self._loop.call_later(self.debounce_seconds, self._start_reload)
+
+    def _start_reload(self):
+        self._timer = None
+        self._task = asyncio.create_task(self.reload(), name="config-reload")
+
+    async def reload(self):
+        """
+        Reloads config.yaml, and applies it if it is valid.
+
+        Returns:
+            bool: True if a new configuration was applied.
+        """
+        async with self._lock:  # One reload at a time, the last change wins
+            try:
+                data = await asyncio.to_thread(self.config.read_config)
+            except (OSError, yaml.YAMLError) as ex:
+                logger.error("Cannot reload %s, keeping the running configuration: %s", self.path, ex)
+                CONFIG_RELOADS.inc(outcome="invalid")
+                return False
+            changed = {section for section in set(data) | set(self.config.config_data)
+                       if data.get(section) != self.config.config_data.get(section)}
+            if not changed:
+                logger.debug("%s saved without changes", self.path)
+                return False
+
+            restart_needed = sorted(changed - set(RELOADABLE_SECTIONS))
+            if restart_needed:
+                logger.warning("Changes to %s in %s take effect on the next restart", ", ".join(restart_needed), self.path)
+            changed -= set(restart_needed)
+            if not changed:
+                return False
+
+            # The running configuration, with the reloadable sections of the file
+            live_data = dict(self.config.config_data)
+            for section in RELOADABLE_SECTIONS:
+                if section in data:
+                    live_data[section] = data[section]
+                else:
+                    live_data.pop(section, None)
+            new_config = self.config.with_data(live_data)
+            errors = validate_config(new_config)
+            if errors:
+                for error in errors:
+                    logger.error("Invalid %s: %s", self.path, error)
+                logger.error("Reload of %s refused (%i problem(s)), keeping the running configuration",
+                             self.path, len(errors))
+                CONFIG_RELOADS.inc(outcome="invalid")
+                return False
+
+            registry = None
+            if changed & {"YOLO", "Meters"}:
+                try:
+                    registry = await asyncio.to_thread(self._load, new_config)
+                except Exception as ex:
+                    logger.error("Cannot load the models of the new %s, keeping the running ones: %s", self.path, ex)
+                    CONFIG_RELOADS.inc(outcome="failed")
+                    return False
+
+            self.apply(new_config, registry)
+            self.config.config_data = live_data
+            logger.info("Reloaded %s: %s", self.path, ", ".join(sorted(changed)))
+            CONFIG_RELOADS.inc(outcome="applied")
+            return True
+
+    def _load(self, config):
+        """Creates the new registry and its readers, and warms up the new models. Runs in a worker thread."""
+        current = self.registry().models
+        registry = MeterRegistry.from_config(config)
+        registry.load_readers(config, current)
+        new_paths = set(registry.models) - set(current)
+        if self.warmup and new_paths:
+            for meter in registry:
+                meter.reader.warmup(new_paths)
+                new_paths -= set(meter.reader.model_paths.values())
+        logger.info("Meters %s ready, %i new model(s) loaded", ", ".join(registry.meters),
+                    len(set(registry.models) - set(current)))
+        return registry
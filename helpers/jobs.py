@@ -0,0 +1,468 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Bounded job queue feeding the inference workers.
+#
+# Every upload becomes a Job, put in a bounded queue and processed by a fixed number of worker tasks.
+# Clients either wait for the result (synchronous uploads) or get the job id back immediately and poll
+# GET /jobs/<id> (asynchronous uploads). When the queue is full, new jobs are refused (QueueFull), so the
+# server can answer 429 instead of piling up requests it cannot serve in time.
+#
+# Jobs are queued in priority lanes: "interactive" (single uploads, someone is waiting for the result) and "bulk"
+# (batch uploads, spool replays, other background work). The workers are shared between the busy lanes by
+# weighted fair sharing (with weights 4 and 1, four interactive jobs are started for each bulk job), and the
+# bulk lane has a concurrency cap ("max_concurrency"): a large backfill never occupies more than that many
+# workers, so it delays a live upload by at most the bulk jobs already running.
+#
+# Every job has a Deadline ("Jobs: deadline_seconds", counted from its submission): the handler runs its stages
+# through Deadline.run() / check(), so a job past its deadline, or cancelled because its client went away, is
+# aborted between stages (JobAborted) instead of running to completion behind the other jobs. A stage running in
+# a thread cannot be interrupted: the worker of an aborted job waits for it before starting the next job, so the
+# number of workers keeps bounding the images being processed at once.
+#
+# Configured in the "Jobs" section of config.yaml.
+#
+import os
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+from helpers import metrics
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+# Job status values
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Reasons of aborted jobs
+TIMEOUT = "timeout"
+CANCELLED = "cancelled"
+
+# Priority lanes
+INTERACTIVE = "interactive"
+BULK = "bulk"
+DEFAULT_LANES = {INTERACTIVE: {"weight": 4}, BULK: {"weight": 1, "max_concurrency": 1, "deadline_includes_queue": False}}
+
+JOBS_FINISHED = metrics.counter("meterreader_jobs_total", "Finished jobs, by status", ["status"])
+JOBS_ABORTED = metrics.counter("meterreader_jobs_aborted_total",
+                               "Jobs aborted past their deadline or cancelled, by reason and stage", ["reason", "stage"])
+JOB_DURATION = metrics.histogram("meterreader_job_duration_seconds", "Time from the start to the end of the jobs")
+JOB_QUEUE_WAIT = metrics.histogram("meterreader_job_queue_wait_seconds",
+                                   "Time the jobs waited in the queue before starting, by lane", ["lane"])
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted while the queue is full.
+
+    Attributes:
+        retry_after: Estimated number of seconds until there is room in the queue.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Job queue is full, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class JobAborted(Exception):
+    """
+    Raised in the handler of a job past its deadline (TIMEOUT) or cancelled (CANCELLED).
+
+    Attributes:
+        reason: TIMEOUT or CANCELLED.
+        stage: Stage of the job that was not run (or not completed).
+    """
+
+    def __init__(self, reason, stage, detail=None):
+        message = f"Deadline exceeded at stage '{stage}'" if reason == TIMEOUT else f"Cancelled at stage '{stage}'"
+        super().__init__(f"{message}: {detail}" if detail else message)
+        self.reason = reason
+        self.stage = stage
+
+
+class Deadline:
+    """
+    Deadline and cancellation flag of a job, checked between the stages of its handler.
+
+    Attributes:
+        seconds: Time allowed to the job, or None (no deadline).
+        expires_at: time.monotonic() value at which the job times out, or None (no deadline, or not started).
+        cancel_reason: Why the job was cancelled (e.g. "client disconnected"), or None.
+    """
+
+    def __init__(self, seconds=None, started=True):
+        self.seconds = float(seconds) if seconds else None
+        self.expires_at = None
+        self.cancel_reason = None
+        if started:
+            self.start()
+        self._cancelled = None  # Future set by cancel(), waking up the stage awaited by run()
+        self._abandoned = None  # Stage given up on, still running in its worker thread
+
+    def start(self):
+        """Starts counting down, if not started yet."""
+        if self.seconds is not None and self.expires_at is None:
+            self.expires_at = time.monotonic() + self.seconds
+
+    def remaining(self):
+        """Seconds left until the deadline (None if there is none)."""
+        return None if self.expires_at is None else max(0.0, self.expires_at - time.monotonic())
+
+    def cancel(self, reason):
+        """
+        Cancels the job: the stage being awaited is abandoned (see run()) and no other stage is started.
+        Must be called on the event loop.
+        """
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+            if self._cancelled is not None and not self._cancelled.done():
+                self._cancelled.set_result(None)
+
+    def check(self, stage):
+        """
+        Raises JobAborted if the job is cancelled or past its deadline, before running `stage`.
+        """
+        if self.cancel_reason is not None:
+            raise JobAborted(CANCELLED, stage, self.cancel_reason)
+        if self.expires_at is not None and time.monotonic() >= self.expires_at:
+            raise JobAborted(TIMEOUT, stage)
+
+    async def run(self, stage, func, *args, **kwargs):
+        """
+        Runs a (blocking) stage in a worker thread, giving up on it when the deadline passes or the
+        job is cancelled.
+
+        A stage cannot be interrupted: the job is aborted at once, but the thread of the abandoned stage runs
+        until the stage is done (its result, or error, is dropped). The job queue waits for it (settle()) before
+        the worker starts another job, so an abandoned stage never runs at the same time as the next job, on the
+        same models.
+
+        Raises:
+            JobAborted: If the job is cancelled or past its deadline (before or while running the stage).
+        """
+        self.check(stage)
+        stage_task = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+        self._cancelled = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait([stage_task, self._cancelled], timeout=self.remaining(),
+                               return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            self._abandon(stage_task)
+            raise
+        finally:
+            self._cancelled.cancel()
+            self._cancelled = None
+        if stage_task.done():
+            return stage_task.result()
+        self._abandon(stage_task)
+        if self.cancel_reason is not None:
+            raise JobAborted(CANCELLED, stage, self.cancel_reason)
+        raise JobAborted(TIMEOUT, stage)
+
+    async def settle(self):
+        """Waits until the thread of an abandoned stage, if any, is done."""
+        if self._abandoned is not None:
+            await asyncio.wait([self._abandoned])
+            self._abandoned = None
+
+    def _abandon(self, stage_task):
+        # The thread keeps running until the stage is done: drop its result (or error) when it is
+        stage_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        self._abandoned = stage_task
+
+
+class Job:
+    """
+    A unit of work (one uploaded image) and its status.
+
+    Attributes:
+        id: Unique id of the job.
+        filename: Name of the uploaded file.
+        payload: Data passed to the handler (not exposed through the API).
+        lane: Priority lane of the job (INTERACTIVE, BULK).
+        status: One of QUEUED, RUNNING, DONE, FAILED.
+        result: Value returned by the handler (DONE), or None.
+        error: Error message (FAILED), or None.
+        deadline: Deadline of the job, checked by the handler between its stages.
+        future: asyncio.Future resolved with the result, for callers waiting on the job.
+    """
+
+    def __init__(self, filename, payload, deadline_seconds=None, lane=INTERACTIVE, deadline_includes_queue=True):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.payload = payload
+        self.lane = lane
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.deadline = Deadline(deadline_seconds, started=deadline_includes_queue)
+        self.future = asyncio.get_running_loop().create_future()
+
+    def cancel(self, reason):
+        """Cancels the job (e.g. because nobody waits for its result anymore), see Deadline.cancel()."""
+        if self.status in (QUEUED, RUNNING):
+            self.deadline.cancel(reason)
+
+    def to_dict(self):
+        """Returns the JSON-serializable status of the job."""
+        return {
+            "job_id": self.id,
+            "filename": self.filename,
+            "lane": self.lane,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class Lane:
+    """
+    A priority lane of the job queue.
+
+    Attributes:
+        name: Name of the lane.
+        weight: Share of the workers the lane gets when other lanes have jobs queued too.
+        max_queue: Maximum number of queued (not yet running) jobs.
+        max_concurrency: Maximum number of jobs of the lane running at once (None = all the workers).
+        deadline_seconds: Deadline of the jobs of the lane (None = the deadline of the queue, 0 = no deadline).
+        deadline_includes_queue: Count the deadline from the submission of the jobs (True), or from their start
+                                 (False: for lanes where a long wait is expected, like batches).
+    """
+
+    def __init__(self, name, weight=1, max_queue=32, max_concurrency=None, deadline_seconds=None,
+                 deadline_includes_queue=True):
+        self.name = name
+        self.weight = max(0.001, float(weight))
+        self.max_queue = max(1, int(max_queue))
+        self.max_concurrency = int(max_concurrency) if max_concurrency else None
+        self.deadline_seconds = deadline_seconds
+        self.deadline_includes_queue = bool(deadline_includes_queue)
+        self.queue = deque()
+        self.running = 0
+        self.virtual_time = 0.0  # Advanced by 1 / weight every time a job of the lane is started
+
+    def ready(self):
+        """True if the lane has a job that may start now."""
+        return bool(self.queue) and (self.max_concurrency is None or self.running < self.max_concurrency)
+
+
+class JobQueue:
+    """
+    Bounded queue of jobs in priority lanes, processed by a fixed number of worker tasks.
+
+    Attributes:
+        handler: Coroutine function called with the Job, returning the (JSON-serializable) result.
+        workers: Number of worker tasks.
+        max_queue: Default maximum number of queued (not yet running) jobs of a lane.
+        keep_finished: Number of finished jobs kept, to be queried through get().
+        deadline_seconds: Time allowed to a job from its submission to its end (0 or None = no deadline).
+        lanes: Lane by name: INTERACTIVE and BULK (see DEFAULT_LANES), plus any other configured lane.
+        listeners: Callables called with the job status (dict) every time a job changes status.
+    """
+
+    def __init__(self, handler, workers=1, max_queue=32, keep_finished=256, deadline_seconds=None, lanes=None):
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.max_queue = max(1, int(max_queue))
+        self.keep_finished = int(keep_finished)
+        self.deadline_seconds = float(deadline_seconds or 0) or None
+        self.lanes = {name: Lane(name, **{"max_queue": self.max_queue, **(options or {})})
+                      for name, options in {**DEFAULT_LANES, **(lanes or {})}.items()}
+        self.listeners = []
+
+        self.jobs = OrderedDict()  # job id -> Job, oldest first
+        self._tasks = []
+        self._wakeup = None  # Set when a job may be started (job queued, or a worker / lane slot freed)
+        self._virtual_time = 0.0  # Virtual time of the last started job
+        self._average_duration = 1.0  # Exponentially weighted average of the job durations, in seconds
+
+    @classmethod
+    def from_config(cls, config, handler):
+        """Creates a JobQueue from the "Jobs" section of config.yaml."""
+        return cls(
+            handler,
+            workers=config.get("Jobs", "workers", 1),
+            max_queue=config.get("Jobs", "max_queue", 32),
+            keep_finished=config.get("Jobs", "keep_finished", 256),
+            deadline_seconds=config.get("Jobs", "deadline_seconds", 120),
+            lanes=config.get("Jobs", "lanes"),
+        )
+
+    def start(self):
+        """Starts the worker tasks on the current event loop."""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self.workers)]
+        metrics.gauge("meterreader_job_queue_depth", "Jobs waiting in the queue", function=lambda: self.depth)
+        logger.info("Job queue started with %i worker(s), lanes: %s", self.workers,
+                    ", ".join(f"{lane.name} (weight {lane.weight:g}, max. {lane.max_queue} queued"
+                              f"{f', {lane.max_concurrency} running' if lane.max_concurrency else ''})"
+                              for lane in self.lanes.values()))
+
+    async def stop(self):
+        """Stops the worker tasks. Jobs still queued are failed."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for lane in self.lanes.values():
+            while lane.queue:
+                self._finish(lane.queue.popleft(), error="Server shutting down")
+
+    @property
+    def depth(self):
+        """Number of jobs waiting in the queue (all lanes)."""
+        return sum(len(lane.queue) for lane in self.lanes.values())
+
+    def lane_depth(self, lane):
+        """Number of jobs waiting in a lane."""
+        return len(self._lane(lane).queue)
+
+    def retry_after(self, lane=INTERACTIVE):
+        """Estimated number of seconds until a lane of the queue has room again."""
+        lane = self._lane(lane)
+        workers = min(self.workers, lane.max_concurrency or self.workers)
+        return max(1, round(self._average_duration * (len(lane.queue) + 1) / workers))
+
+    def full(self, lane=INTERACTIVE):
+        """True if a lane of the queue is full."""
+        lane = self._lane(lane)
+        return len(lane.queue) >= lane.max_queue
+
+    def submit(self, filename, payload, overflow=False, lane=INTERACTIVE):
+        """
+        Queues a new job.
+
+        Args:
+            filename (str): Name of the uploaded file.
+            payload: Data passed to the handler.
+            overflow (bool): If the lane is full, queue the job anyway instead of refusing it.
+                             Only for jobs whose data is held outside of memory (e.g. in the upload spool),
+                             or whose number is bounded by the caller (batch uploads).
+            lane (str): Priority lane of the job (INTERACTIVE, BULK).
+
+        Returns:
+            Job: The queued job.
+
+        Raises:
+            QueueFull: If the lane is full (and overflow is False).
+        """
+        queue_lane = self._lane(lane)
+        if self.full(lane) and not overflow:
+            raise QueueFull(self.retry_after(lane))
+        deadline_seconds = self.deadline_seconds if queue_lane.deadline_seconds is None else queue_lane.deadline_seconds
+        job = Job(filename, payload, deadline_seconds, lane=queue_lane.name,
+                  deadline_includes_queue=queue_lane.deadline_includes_queue)
+        if not queue_lane.queue and not queue_lane.running:
+            # An idle lane does not get credit for the time it was idle: it starts at the current virtual time
+            queue_lane.virtual_time = max(queue_lane.virtual_time, self._virtual_time)
+        queue_lane.queue.append(job)
+        self.jobs[job.id] = job
+        self._prune_finished()
+        self._notify(job)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    def get(self, job_id):
+        """Returns the job with the given id, or None."""
+        return self.jobs.get(job_id)
+
+    def _lane(self, name):
+        try:
+            return self.lanes[name]
+        except KeyError:
+            raise ValueError(f"Unknown job lane '{name}', expected one of {', '.join(self.lanes)}") from None
+
+    async def _next_job(self):
+        """
+        Waits for the next job to start: from the ready lane that is the furthest behind its fair share
+        (lowest virtual time), so each lane gets the workers in proportion to its weight.
+        """
+        while True:
+            ready = [lane for lane in self.lanes.values() if lane.ready()]
+            if ready:
+                lane = min(ready, key=lambda lane: lane.virtual_time)
+                lane.running += 1
+                self._virtual_time = lane.virtual_time
+                lane.virtual_time += 1 / lane.weight
+                return lane, lane.queue.popleft()
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    async def _worker(self, worker_no):
+        while True:
+            lane, job = await self._next_job()
+            try:
+                job.status = RUNNING
+                job.started_at = time.time()
+                job.deadline.start()
+                JOB_QUEUE_WAIT.observe(job.started_at - job.submitted_at, lane=lane.name)
+                self._notify(job)
+                result = await self.handler(job)
+                self._finish(job, result=result)
+            except JobAborted as ex:
+                logger.warning("Job %s (%s) aborted in worker %i: %s", job.id, job.filename, worker_no, ex)
+                JOBS_ABORTED.inc(reason=ex.reason, stage=ex.stage)
+                self._finish(job, error=str(ex), exception=ex)
+            except asyncio.CancelledError:
+                self._finish(job, error="Server shutting down")
+                raise
+            except Exception as ex:
+                logger.error("Job %s (%s) failed in worker %i: %s", job.id, job.filename, worker_no, ex)
+                self._finish(job, error=str(ex), exception=ex)
+            finally:
+                # Keep the worker (and the lane slot) busy until an abandoned stage of the job is done
+                await job.deadline.settle()
+                lane.running -= 1
+                self._wakeup.set()  # A lane slot is free (the bulk lane may be waiting for it)
+
+    def _finish(self, job, result=None, error=None, exception=None):
+        job.finished_at = time.time()
+        job.payload = None  # Release the image data
+        if error is None:
+            job.status = DONE
+            job.result = result
+            if not job.future.done():
+                job.future.set_result(result)
+        else:
+            job.status = FAILED
+            job.error = error
+            if not job.future.done():
+                job.future.set_exception(exception or RuntimeError(error))  # The error of the handler is passed on as is
+        JOBS_FINISHED.inc(status=job.status)
+        if job.started_at:
+            JOB_DURATION.observe(job.finished_at - job.started_at)
+            self._average_duration = 0.8 * self._average_duration + 0.2 * (job.finished_at - job.started_at)
+        # Nobody may be waiting on the future (asynchronous uploads): mark the exception as retrieved
+        if job.future.done() and not job.future.cancelled():
+            job.future.exception()
+        self._notify(job)
+
+    def _prune_finished(self):
+        """Forgets the oldest finished jobs, keeping at most `keep_finished` of them."""
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in (DONE, FAILED)]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self.jobs[job_id]
+
+    def _notify(self, job):
+        status = job.to_dict()
+        for listener in self.listeners:
+            try:
+                listener(status)
+            except Exception as ex:
+                logger.error("Error in job listener: %s", ex)
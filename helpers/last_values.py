@@ -0,0 +1,167 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Last value published per MQTT topic, kept in memory and written behind to disk.
+#
+# The MQTT client re-publishes the last value of the meter when Home Assistant comes back online, so the
+# values must survive a restart. Publishing only updates the in-memory map; a background thread writes the
+# whole map to a single compact JSON file ({"<topic>": [<epoch timestamp>, <value>], ...}):
+#   - coalescing: updates arriving within "MQTT: last_value_flush_seconds" are written at once
+#   - atomic: written to a temporary file, fsync'ed, then renamed over the previous file, so a crash leaves
+#     either the old or the new file, never a truncated one
+#
+# The file is kept out of the served "static" folder ("MQTT: last_value_directory", default "data"). When there is
+# no file yet, the last values kept by earlier versions in "static" (last_values.json, or the Last_Value_<topic>.yaml
+# files) are imported.
+#
+import os
+import glob
+import json
+import time
+import logging
+import tempfile
+import threading
+
+import yaml
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+FILENAME = "last_values.json"
+LEGACY_DIRECTORY = "static"  # Directory of the last values of earlier versions (served by the web server)
+
+
+def _legacy_key(topic):
+    """Key of a topic in the Last_Value_<topic>.yaml files ("/" replaced by "_")."""
+    return topic.replace("/", "_")
+
+
+class LastValueStore:
+    """
+    In-memory map of the last value published per topic, persisted by a background thread.
+
+    Attributes:
+        path: Path of the JSON file.
+        flush_interval: Seconds during which updates are coalesced before they are written.
+
+    Args:
+        legacy_directories: Directories the last values are imported from when there is no JSON file yet.
+    """
+
+    def __init__(self, directory, flush_interval=1.0, legacy_directories=()):
+        self.path = os.path.join(directory, FILENAME)
+        self.flush_interval = float(flush_interval)
+        self._lock = threading.Lock()
+        self._values = {}  # topic -> [timestamp, value]
+        self._dirty = threading.Event()
+        self._stopping = threading.Event()
+        self._load([directory, *[legacy for legacy in legacy_directories if legacy != directory]])
+        self._thread = threading.Thread(target=self._write_behind, name="last-value-store", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates the store from the "MQTT" section of config.yaml."""
+        return cls(
+            config.get("MQTT", "last_value_directory") or "data",
+            flush_interval=config.get("MQTT", "last_value_flush_seconds", 1.0),
+            legacy_directories=[LEGACY_DIRECTORY],
+        )
+
+    def get(self, topic):
+        """
+        Returns the last value published to a topic.
+
+        Returns:
+            dict: "timestamp" (epoch), "timestamp_str" and "value" (None if nothing was published yet).
+        """
+        with self._lock:
+            timestamp, value = self._values.get(topic) or self._values.get(_legacy_key(topic)) or (0, None)
+        return {"timestamp": timestamp, "timestamp_str": time.ctime(timestamp), "value": value}
+
+    def set(self, topic, value, timestamp=None):
+        """Records the value published to a topic. Never touches the disk."""
+        with self._lock:
+            self._values[topic] = [int(timestamp if timestamp is not None else time.time()), value]
+            if _legacy_key(topic) != topic:
+                self._values.pop(_legacy_key(topic), None)  # Imported from a Last_Value_*.yaml file
+        self._dirty.set()
+
+    def flush(self):
+        """Writes the values to disk now (blocking)."""
+        with self._lock:
+            data = json.dumps(self._values, separators=(",", ":"))
+        self._write(data)
+
+    def close(self):
+        """Stops the background thread, writing the pending updates first."""
+        self._stopping.set()
+        self._dirty.set()
+        self._thread.join(timeout=10)
+        if self._dirty.is_set():
+            self.flush()  # Updated while the thread was writing
+
+    def _load(self, directories):
+        """Loads the JSON file of the first directory that has one, else imports the Last_Value_*.yaml files."""
+        for directory in directories:
+            path = os.path.join(directory, FILENAME)
+            try:
+                with open(path, "r") as file:
+                    self._values = {topic: list(entry) for topic, entry in json.load(file).items()}
+            except FileNotFoundError:
+                continue
+            except (ValueError, TypeError, OSError) as ex:
+                logger.error("Error loading the last values from %s: %s", path, ex)
+                return
+            if path != self.path:
+                logger.info("Imported %i last value(s) from %s", len(self._values), path)
+                self._dirty.set()
+            return
+        for directory in directories:
+            for yaml_file in glob.glob(os.path.join(directory, "Last_Value_*.yaml")):
+                try:
+                    with open(yaml_file, "r") as file:
+                        data = yaml.safe_load(file) or {}
+                    key = os.path.basename(yaml_file)[len("Last_Value_"):-len(".yaml")]
+                    self._values[key] = [int(data.get("timestamp", 0)), data.get("value")]
+                except Exception as ex:
+                    logger.warning("Ignoring last value file %s: %s", yaml_file, ex)
+            if self._values:
+                logger.info("Imported %i last value(s) from the Last_Value_*.yaml files", len(self._values))
+                self._dirty.set()
+                return
+
+    def _write_behind(self):
+        while not self._stopping.is_set():
+            self._dirty.wait()
+            self._stopping.wait(self.flush_interval)  # Coalesce the updates of the next moments
+            self._dirty.clear()
+            try:
+                self.flush()
+            except Exception as ex:
+                logger.error("Error writing the last values to %s: %s", self.path, ex)
+                self._dirty.set()
+                self._stopping.wait(self.flush_interval)
+
+    def _write(self, data):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=".last_values.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)  # Make the rename durable
+        finally:
+            os.close(dir_fd)
@@ -0,0 +1,170 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Several meters (electricity, gas, water, ...) read by the same server.
+#
+# Each meter of the "Meters" section of config.yaml has:
+#   - device_id: its Home Assistant object id (values published to <MQTT topic>/<device_id>/state), or a full
+#                state topic; the readings are stored under it
+#   - weights / confidence: optional overrides of "YOLO: weights" and of the detection thresholds
+#   - roi_margin: optional, search the frame around the last one found first (fixed camera)
+#   - plausibility: optional overrides of the "Plausibility" section (helpers/plausibility.py), e.g. the
+#                   maximum rate of a water meter is not that of an electricity meter
+#   - its own MeterReader (frame ROI) and the last result processed for it
+#
+# The models are shared: the meters using the same weights file use the same loaded model, so adding a meter
+# only costs the memory of the weights it overrides.
+#
+# An upload is routed to a meter by, in this order: the form field "Meters: form_field", the request header
+# "Meters: header", the regular expression "Meters: filename_pattern" (group "meter") applied to the file name,
+# else the default meter. Without a "Meters" section there is a single meter, "HomeAssistant: device_id".
+#
+import os
+import re
+import logging
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+
+class UnknownMeter(ValueError):
+    """Raised when an upload names a meter that is not configured."""
+
+
+class Meter:
+    """
+    A configured meter.
+
+    Attributes:
+        id: Id of the meter, as given with the uploads.
+        device_id: Home Assistant object id (or full state topic) the values are published to.
+        weights: Weights files overriding "YOLO: weights".
+        confidence: Confidence thresholds overriding the defaults of MeterReader.
+        roi_margin: Margin of the frame region searched first (0 = disabled).
+        plausibility: Settings overriding the "Plausibility" section for this meter.
+        reader: MeterReader of the meter (None until MeterRegistry.load_readers()).
+        last_result: Last result processed for the meter (None if none yet).
+    """
+
+    def __init__(self, meter_id, device_id=None, weights=None, confidence=None, roi_margin=0.0, plausibility=None):
+        self.id = meter_id
+        self.device_id = device_id or meter_id
+        self.weights = dict(weights or {})
+        self.confidence = dict(confidence or {})
+        self.roi_margin = float(roi_margin or 0.0)
+        self.plausibility = dict(plausibility or {})
+        self.reader = None
+        self.last_result = None
+
+    def to_dict(self):
+        return {"id": self.id, "device_id": self.device_id, "last_result": self.last_result}
+
+
+class MeterRegistry:
+    """
+    The configured meters, and the rules routing the uploads to them.
+
+    Attributes:
+        meters: Meters by id, in the order of config.yaml.
+        default: Meter of the uploads that do not name one.
+        form_field: Form field naming the meter of an upload ("" = not used).
+        header: Request header naming the meter of an upload ("" = not used).
+        filename_pattern: Compiled regular expression finding the meter in a file name (None = not used).
+        models: Models used by the readers of the meters, by weights path (see load_readers()).
+    """
+
+    def __init__(self, meters, default_id=None, form_field="meter", header="X-Meter-Id", filename_pattern=None):
+        if not meters:
+            raise ValueError("Meters: at least one meter is needed")
+        self.meters = {meter.id: meter for meter in meters}
+        self.default = self.meters.get(default_id) if default_id else meters[0]
+        if self.default is None:
+            raise ValueError(f"Meters: the default meter '{default_id}' is not configured")
+        self.form_field = form_field or ""
+        self.header = header or ""
+        self.filename_pattern = re.compile(filename_pattern) if filename_pattern else None
+        self.models = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates the registry from the "Meters" section of config.yaml (no models are loaded)."""
+        settings = config.get("Meters", "meters") or {}
+        if settings:
+            meters = [Meter(meter_id, **(meter_settings or {})) for meter_id, meter_settings in settings.items()]
+        else:
+            device_id = config.get("HomeAssistant", "device_id") or "meter"
+            meters = [Meter(device_id, device_id)]  # Single meter: the setup before the "Meters" section
+        return cls(
+            meters,
+            default_id=config.get("Meters", "default"),
+            form_field=config.get("Meters", "form_field", "meter"),
+            header=config.get("Meters", "header", "X-Meter-Id"),
+            filename_pattern=config.get("Meters", "filename_pattern", ""),
+        )
+
+    def load_readers(self, config, models=None):
+        """
+        Creates the MeterReader of every meter, loading each weights file once.
+
+        Args:
+            models (dict, optional): Models already loaded, by weights path, reused if the meters use them
+                                     (e.g. those of the registry replaced on a reload of config.yaml).
+
+        Returns:
+            dict: The models used by the meters, by weights path (also kept in `models`).
+        """
+        from predicter.predictions import MeterReader
+
+        loaded = {} if models is None else dict(models)
+        for meter in self.meters.values():
+            meter.reader = MeterReader(config, weights=meter.weights, confidence=meter.confidence,
+                                       roi_margin=meter.roi_margin, models=loaded)
+        used = {path for meter in self.meters.values() for path in meter.reader.model_paths.values()}
+        self.models = {path: model for path, model in loaded.items() if path in used}
+        logger.info("%i meter(s) share %i loaded model(s): %s", len(self.meters), len(self.models), ", ".join(self.meters))
+        return self.models
+
+    def __iter__(self):
+        return iter(self.meters.values())
+
+    def __len__(self):
+        return len(self.meters)
+
+    def get(self, meter_id=None):
+        """Returns a meter by id (the default meter if None). Raises UnknownMeter."""
+        if not meter_id:
+            return self.default
+        meter = self.meters.get(meter_id)
+        if meter is None:
+            raise UnknownMeter(f"Unknown meter '{meter_id}', expected one of {', '.join(self.meters)}")
+        return meter
+
+    def from_filename(self, filename):
+        """Returns the meter named in a file name by the filename pattern, or None."""
+        if self.filename_pattern is None or not filename:
+            return None
+        match = self.filename_pattern.search(filename)
+        meter_id = match and match.groupdict().get("meter")
+        return self.meters.get(meter_id) if meter_id else None
+
+    def resolve(self, form=None, headers=None, filename=None):
+        """
+        Routes an upload to its meter: form field, then header, then file name, then the default meter.
+
+        Args:
+            form (Mapping, optional): Form fields of the request.
+            headers (Mapping, optional): Headers of the request.
+            filename (str, optional): Name of the uploaded file.
+
+        Returns:
+            Meter: The meter of the upload.
+
+        Raises:
+            UnknownMeter: If the form field or the header names a meter that is not configured.
+        """
+        meter_id = (form.get(self.form_field) if form is not None and self.form_field else None) or \
+                   (headers.get(self.header) if headers is not None and self.header else None)
+        if meter_id:
+            return self.get(meter_id.strip())
+        return self.from_filename(filename) or self.default
@@ -0,0 +1,218 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Minimal metrics registry, exported in the Prometheus text format on GET /metrics.
+#
+# Three kinds of metrics, all optionally labelled:
+#   - Counter:    monotonically increasing count (e.g. jobs that timed out)
+#   - Gauge:      current value, set explicitly or read from a function when exported (e.g. queue depth)
+#   - Histogram:  distribution of observed values in cumulative buckets (e.g. job durations)
+#
+# Metrics are kept per process: with several worker processes (helpers/workers.py) each worker exports its
+# own values, labelled with the "worker" index, and the scraper sums them up.
+#
+# Usage:
+#    from helpers import metrics
+#    JOB_TIMEOUTS = metrics.counter("meterreader_job_timeouts_total", "Jobs aborted by their deadline", ["stage"])
+#    JOB_TIMEOUTS.inc(stage="frame")
+#
+import math
+import threading
+
+# Default buckets of the histograms, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    """
+    Base class of the metrics: a name, a help text, label names and one value per label combination.
+    Thread safe (values are updated from worker threads).
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """Returns the (suffix, label values, extra labels, value) of the samples to export."""
+        with self._lock:
+            return [("", key, (), value) for key, value in self._values.items()]
+
+    def render(self, const_labels=()):
+        """Returns the metric in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            labels = _format_labels((*self.labelnames, *(name for name, _ in const_labels)),
+                                    (*key, *(value for _, value in const_labels)), extra)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """A count that only goes up."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """A value that goes up and down. Unlabelled gauges may read their value from a function instead."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        if self.function is not None:
+            return self.function()
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        if self.function is not None:
+            return [("", (), (), self.function())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    """Counts observed values in cumulative buckets, with their sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def snapshot(self, **labels):
+        """Returns (cumulative counts per bucket, sum, count) of the observations."""
+        with self._lock:
+            counts, total = self._values.get(self._key(labels), ([0] * len(self.buckets), 0.0))
+            cumulative, running = [], 0
+            for count in counts:
+                running += count
+                cumulative.append(running)
+            return cumulative, total, running
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in items:
+            running = 0
+            for bound, count in zip(self.buckets, counts):
+                running += count
+                samples.append(("_bucket", key, (("le", _format_value(bound)),), running))
+            samples.append(("_sum", key, (), total))
+            samples.append(("_count", key, (), running))
+        return samples
+
+
+class Registry:
+    """A set of metrics, exported together."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.const_labels = ()  # Labels added to every sample, e.g. (("worker", "0"),)
+
+    def register(self, metric):
+        """Registers a metric, or returns the one already registered under the same name."""
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError(f"Metric {metric.name} is already registered as a {existing.kind}")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        """Returns all the metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render(self.const_labels) for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# Content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def counter(name, documentation, labelnames=()):
+    """Returns the counter registered under `name`, creating it if needed."""
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), function=None):
+    """Returns the gauge registered under `name`, creating it if needed."""
+    return REGISTRY.register(Gauge(name, documentation, labelnames, function))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Returns the histogram registered under `name`, creating it if needed."""
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def render():
+    """Returns the metrics of this process in the Prometheus text format."""
+    return REGISTRY.render()
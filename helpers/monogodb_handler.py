@@ -1,7 +1,10 @@
 import os
-import gridfs
-from pymongo import MongoClient
+from datetime import datetime, timezone
+import threading
+from pymongo import MongoClient, UpdateOne, ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import CollectionInvalid, DuplicateKeyError
 from bson import ObjectId  # Import ObjectId to check and convert
+from bson.errors import InvalidId
 from io import BytesIO
 import cv2  # Required if image is in numpy array format
 from PIL import Image  # Optional for PIL image objects
@@ -10,6 +13,7 @@ from PIL import Image  # Optional for PIL image objects
 
 # Import your custom modules
 import helpers.config as config 
+from helpers.storage import create_store
 
 # Make sure to use the same logger as therest of hte application
 import logging
@@ -17,6 +21,26 @@ logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename
 logger = logging.getLogger(logger_name)
 
 
+# Fields of a metadata document that reference files stored in GridFS.
+# "file_name_*" are written by server.process_image, the others by older versions of the application.
+IMAGE_REFERENCE_FIELDS = ("filename", "file_name_image", "file_name_counter", "file_name_digits", "file_name_original",
+                          "detected_object_file", "marked_image", "scaled_imagepath")
+IMAGE_REFERENCE_PROJECTION = {field: 1 for field in IMAGE_REFERENCE_FIELDS}
+
+# Number of metadata entries deleted per bulk operation when pruning
+PRUNE_BATCH_SIZE = 500
+
+# Maximum number of metadata entries returned by one page of get_metadata_page
+METADATA_PAGE_MAX_LIMIT = 500
+
+
+# Rollup buckets maintained for the readings time-series, and the function giving the start of a bucket
+ROLLUP_BUCKETS = {
+    "hour": lambda ts: ts.replace(minute=0, second=0, microsecond=0),
+    "day": lambda ts: ts.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+
+
 # Helper function to make metadata JSON serializable
 def convert_to_serializable(data):
     """
@@ -45,14 +69,27 @@ class MongoDBHandler:
         mongodb_database = self.config.get("MongoDB", "database", "meterreader")
         mongodb_collection = self.config.get("MongoDB", "collection", "image_metadata")
 
-        self.client = MongoClient(mongodb_uri)
+        # Connect on first use: the handler may be created before the worker processes are forked
+        self.client = MongoClient(mongodb_uri, connect=False)
         self.db = self.client[mongodb_database]
-        self.fs = gridfs.GridFS(self.db)
+        self.store = create_store(self.config, self.db)
         self.collection = self.db[mongodb_collection]
 
+        # Time-series collection for the accepted readings, and the pre-aggregated consumption per hour / day
+        self.readings_collection_name = self.config.get("MongoDB", "readings_collection", "readings")
+        self.readings_collection = self.db[self.readings_collection_name]
+        self.rollup_collection = self.db[self.config.get("MongoDB", "rollup_collection", "readings_rollup")]
+        # Last reading of every meter ({_id: meter_id, value, timestamp}), shared by all the worker processes:
+        # the consumption is computed against it, atomically
+        self.last_readings_collection = self.db[self.config.get("MongoDB", "last_readings_collection", "readings_last")]
+        self._readings_store_ready = False
+        self._last_readings = {}  # meter_id -> (value, timestamp) of the last accepted reading
+        self._reading_locks = {}  # meter_id -> threading.Lock, guarding the cached last reading of the meter
+        self._seeded_meters = set()  # Meters whose last reading document is known to exist
+
     def insert_image(self, filename, image_object):
         """
-        Store an image in GridFS.
+        Store an image in the image store (GridFS or local filesystem, see "Storage" in config.yaml).
         :param filename: Name of the image file.
         :param image_object: Image object from YOLOv11 (e.g., numpy array or PIL image).
         :return: The ID of the stored file.
@@ -72,25 +109,23 @@ class MongoDBHandler:
                 raise ValueError("Failed to encode the image to bytes")
             data = encoded_image.tobytes()
 
-        # Store the binary data in GridFS
-        return self.fs.put(data, filename=filename)
+        # Store the binary data in the configured image store (GridFS by default)
+        return self.store.put(data=data, filename=filename)
 
     def insert_file_from_path(self, file_path):
         """
-        Insert a file into GridFS, replacing an existing file with the same filename if it exists.
+        Insert a file into the image store, replacing an existing file with the same filename if it exists.
         :param file_path: Path to the file to be stored.
-        :return: The ID of the stored file in GridFS.
+        :return: The ID of the stored file.
         """
         try:
             filename = os.path.basename(file_path)
 
             # Check for existing file with the same filename and delete it
-            existing_file = self.fs.find_one({"filename": filename})
-            if existing_file:
-                self.fs.delete(existing_file._id)
-                logger.warning(f"Replaced existing file with filename '{filename}' in GridFS.")
+            if self.store.delete([filename])["deleted_files_count"]:
+                logger.warning(f"Replaced existing file with filename '{filename}' in the image store.")
 
-            # Insert the new file into GridFS
+            # Insert the new file into the image store
             with open(file_path, "rb") as file:
                 file_content = file.read()
             file_id = self.insert_image(filename, file_content)
@@ -112,7 +147,7 @@ class MongoDBHandler:
 
     def get_image_data(self, filename):
         """
-        Retrieve an image's binary data from GridFS by filename.
+        Retrieve an image's binary data from the image store by filename.
         
         Args:
             filename (str): Name of the image file.
@@ -121,15 +156,174 @@ class MongoDBHandler:
             tuple: (binary data of the image, content type)
         
         Raises:
-            FileNotFoundError: If the file is not found in GridFS.
+            FileNotFoundError: If the file is not found in the image store.
         """
-        file_obj = self.fs.find_one({"filename": filename})
-        if file_obj:
-            # Attempt to determine content type (default to 'image/jpeg' if not provided)
-            content_type = file_obj.content_type if hasattr(file_obj, "content_type") else "image/jpeg"
-            return file_obj.read(), content_type  # Return binary data and content type
-        else:
-            raise FileNotFoundError(f"File '{filename}' not found in GridFS.")
+        return self.store.read(filename)  # Return binary data and content type
+
+    def open_image(self, filename):
+        """
+        Open an image stored in the image store for incremental (chunk by chunk) reading.
+
+        Unlike get_image_data, nothing is read until the caller reads from the returned object,
+        so large files are never fully buffered in memory.
+
+        Args:
+            filename (str): Name of the image file.
+
+        Returns:
+            File-like object exposing `length`, `chunk_size`, `upload_date` and `content_type`
+            (and `path` when the file is stored on the local filesystem).
+
+        Raises:
+            FileNotFoundError: If the file is not found in the image store.
+        """
+        return self.store.open(filename)
+
+    def _ensure_readings_store(self):
+        """
+        Create the readings time-series collection (meter id as metaField) and the rollup index,
+        the first time a reading is stored. Done lazily, so creating the handler never blocks on the database.
+        """
+        if self._readings_store_ready:
+            return
+        if self.readings_collection_name not in self.db.list_collection_names():
+            try:
+                self.db.create_collection(
+                    self.readings_collection_name,
+                    timeseries={"timeField": "timestamp", "metaField": "meter_id", "granularity": "minutes"},
+                )
+                logger.info(f"Created time-series collection '{self.readings_collection_name}'")
+            except CollectionInvalid:
+                pass  # Created in the meantime by another process
+        self.rollup_collection.create_index(
+            [("meter_id", ASCENDING), ("bucket", ASCENDING), ("start", ASCENDING)], unique=True
+        )
+        self._readings_store_ready = True
+
+    def _get_last_reading(self, meter_id):
+        """
+        Return (value, timestamp) of the last accepted reading for a meter, or (None, None).
+        """
+        with self._reading_locks.setdefault(meter_id, threading.Lock()):
+            if meter_id not in self._last_readings:
+                last = (self.last_readings_collection.find_one({"_id": meter_id})
+                        or self.readings_collection.find_one({"meter_id": meter_id}, sort=[("timestamp", DESCENDING)]))
+                self._last_readings[meter_id] = (last["value"], last["timestamp"].replace(tzinfo=timezone.utc)) if last else (None, None)
+            return self._last_readings[meter_id]
+
+    def _seed_last_reading(self, meter_id):
+        """
+        Create the last reading document of a meter from its time-series, if it does not exist yet
+        (readings stored before there was one).
+        """
+        if meter_id in self._seeded_meters:
+            return
+        if self.last_readings_collection.find_one({"_id": meter_id}, {"_id": 1}) is None:
+            last = self.readings_collection.find_one({"meter_id": meter_id}, sort=[("timestamp", DESCENDING)])
+            if last:
+                try:
+                    self.last_readings_collection.update_one(
+                        {"_id": meter_id},
+                        {"$setOnInsert": {"value": last["value"], "timestamp": last["timestamp"]}},
+                        upsert=True,
+                    )
+                except DuplicateKeyError:
+                    pass  # Created in the meantime by another process
+        self._seeded_meters.add(meter_id)
+
+    def get_last_reading(self, meter_id):
+        """
+        Return (value, timestamp) of the last accepted reading for a meter, or (None, None). Cached.
+        """
+        return self._get_last_reading(meter_id)
+
+    def invalidate_last_readings(self):
+        """
+        Forget the cached last readings, e.g. when another process stored readings. They are re-read on next use.
+        """
+        self._last_readings.clear()
+
+    def insert_reading(self, meter_id, value, timestamp=None, filename=None):
+        """
+        Store an accepted meter reading in the time-series collection, and update the hourly
+        and daily consumption rollups incrementally.
+
+        The consumption of a bucket is the sum of the increases between consecutive readings,
+        so a bucket never has to be recomputed from the raw readings. The increase is computed against the
+        last reading document of the meter, updated atomically: concurrent inserts (threads or worker
+        processes) never count the same increase twice.
+
+        :param meter_id: Id of the meter (metaField of the time-series).
+        :param value: The meter value.
+        :param timestamp: datetime (UTC) of the reading. Defaults to now.
+        :param filename: Name of the image the value was read from.
+        """
+        self._ensure_readings_store()
+        timestamp = timestamp or datetime.now(tz=timezone.utc)
+
+        with self._reading_locks.setdefault(meter_id, threading.Lock()):
+            self._seed_last_reading(meter_id)
+            self.readings_collection.insert_one(
+                {"timestamp": timestamp, "meter_id": meter_id, "value": value, "filename": filename}
+            )
+
+            # Move the shared last reading to this one, unless a more recent reading was stored in the meantime
+            # (by this or another process): the increase is counted once, against the reading it follows
+            try:
+                previous = self.last_readings_collection.find_one_and_update(
+                    {"_id": meter_id, "timestamp": {"$lte": timestamp}},
+                    {"$set": {"value": value, "timestamp": timestamp}},
+                    upsert=True, return_document=ReturnDocument.BEFORE,
+                )
+                in_order = True
+            except DuplicateKeyError:
+                previous, in_order = None, False  # Older than the last reading
+
+            # Only count increases of in-order readings as consumption (a lower value is a misread or a meter reset)
+            consumption = 0
+            if previous is not None and value >= previous["value"]:
+                consumption = value - previous["value"]
+            if in_order:
+                self._last_readings[meter_id] = (value, timestamp)
+            else:
+                self._last_readings.pop(meter_id, None)  # Re-read on next use
+
+        self.rollup_collection.bulk_write([
+            UpdateOne(
+                {"meter_id": meter_id, "bucket": bucket, "start": start_of(timestamp)},
+                {
+                    "$inc": {"consumption": consumption, "count": 1},
+                    "$min": {"first_value": value},
+                    "$max": {"last_value": value, "last_timestamp": timestamp},
+                },
+                upsert=True,
+            )
+            for bucket, start_of in ROLLUP_BUCKETS.items()
+        ], ordered=False)
+
+    def get_readings(self, meter_id, start, end, bucket="hour"):
+        """
+        Return the consumption rollups of a meter between two dates.
+
+        :param meter_id: Id of the meter.
+        :param start: datetime, start of the period (inclusive).
+        :param end: datetime, end of the period (exclusive).
+        :param bucket: "hour" or "day".
+        :return: List of dictionaries (start, consumption, count, first_value, last_value), oldest first.
+        """
+        if bucket not in ROLLUP_BUCKETS:
+            raise ValueError(f"Unknown bucket '{bucket}', expected one of {', '.join(ROLLUP_BUCKETS)}")
+
+        cursor = self.rollup_collection.find(
+            {"meter_id": meter_id, "bucket": bucket, "start": {"$gte": ROLLUP_BUCKETS[bucket](start), "$lt": end}},
+            {"_id": 0, "start": 1, "consumption": 1, "count": 1, "first_value": 1, "last_value": 1},
+        ).sort([("start", ASCENDING)])
+
+        readings = []
+        for rollup in cursor:
+            rollup["start"] = rollup["start"].replace(tzinfo=timezone.utc).isoformat()
+            readings.append(rollup)
+        return readings
 
     def get_image_metadata(self, limit=16):
         """
@@ -141,18 +335,90 @@ class MongoDBHandler:
             self.collection.find().sort([("processed_at", -1)]).limit(limit)
         )
 
-    def get_metadata_by_filename(self, filename):
+    def get_metadata_by_filename(self, filename, fields=None):
         """
         Retrieve metadata for a specific image by its filename.
         :param filename: Name of the image file.
+        :param fields: List of fields to return (default: all).
         :return: Metadata dictionary for the image, or None if not found.
         """
         try:
-            metadata = self.collection.find_one({"filename": filename})
+            projection = {field: 1 for field in fields} if fields else None
+            metadata = self.collection.find_one({"filename": filename}, projection)
             return metadata
         except Exception as e:
             raise Exception(f"An error occurred while fetching metadata for '{filename}': {e}")
 
+    def ensure_indexes(self):
+        """
+        Create the indexes used by the metadata queries (lookup by filename, range queries on processed_at).
+        `_id` is always indexed. Creating an index that already exists is a no-op.
+        """
+        self.collection.create_index([("filename", ASCENDING)])
+        self.collection.create_index([("processed_at", DESCENDING)])
+        self.collection.create_index([("meter", ASCENDING), ("_id", DESCENDING)])
+
+    def get_metadata_page(self, after=None, limit=16, fields=None, since=None, meter=None, include_untagged=False):
+        """
+        Fetch one page of metadata, most recent first, using an index-backed range query on `_id`
+        (keyset pagination) instead of skip/offset.
+
+        :param after: Cursor returned with the previous page (string `_id` of its last entry), or None for the first page.
+        :param limit: Maximum number of entries to return (1 .. METADATA_PAGE_MAX_LIMIT).
+        :param fields: Optional list of fields to return (`_id` and `filename` are always included).
+        :param since: Optional datetime (or ISO 8601 string, naive dates are taken as UTC); only entries processed
+                      at or after it are returned.
+        :param meter: Optional id of a meter; only its entries are returned.
+        :param include_untagged: Also return the entries without a meter (processed before there were several meters).
+        :return: Tuple (list of JSON-serializable entries, cursor of the next page or None).
+        :raises ValueError: If the cursor or `since` is invalid.
+        """
+        limit = max(1, min(int(limit), METADATA_PAGE_MAX_LIMIT))
+
+        query = {}
+        if after:
+            try:
+                query["_id"] = {"$lt": ObjectId(after)}
+            except InvalidId:
+                raise ValueError(f"Invalid cursor '{after}'")
+        if since:
+            query["processed_at"] = {"$gte": self._processed_at_key(since)}
+        if meter:
+            query["meter"] = {"$in": [meter, None]} if include_untagged else meter
+
+        projection = None
+        if fields:
+            projection = {field: 1 for field in fields}
+            projection["filename"] = 1
+
+        # Fetch one extra entry to know if there is a next page
+        entries = list(self.collection.find(query, projection).sort([("_id", DESCENDING)]).limit(limit + 1))
+        has_more = len(entries) > limit
+        entries = entries[:limit]
+
+        # Metadata documents are flat: `_id` is the only field that is not JSON-serializable
+        for entry in entries:
+            entry["_id"] = str(entry["_id"])
+
+        next_cursor = entries[-1]["_id"] if has_more else None
+        return entries, next_cursor
+
+    @staticmethod
+    def _processed_at_key(since):
+        """
+        Convert a date to the format of the stored `processed_at` (UTC, ISO 8601 with microseconds), so that the
+        string comparison of the query orders the dates chronologically, whatever the time zone of `since`.
+        """
+        if isinstance(since, str):
+            try:
+                since = datetime.fromisoformat(since.replace("Z", "+00:00"))
+            except ValueError:
+                raise ValueError(f"Invalid date '{since}', expected ISO 8601 format")
+        if not isinstance(since, datetime):
+            raise ValueError(f"Invalid date '{since}'")
+        since = since.replace(tzinfo=timezone.utc) if since.tzinfo is None else since.astimezone(timezone.utc)
+        return since.isoformat(timespec="microseconds")
+
     def get_grouped_metadata(self, limit=16):
         """
         Fetch metadata from MongoDB, group by filename, and ensure the result is JSON-serializable.
@@ -162,75 +428,158 @@ class MongoDBHandler:
         """
         try:
             # Fetch the metadata documents from MongoDB, sorted by the most recent
-            raw_metadata = list(self.collection.find().sort([("_id", -1)]).limit(limit))
-
-            # Convert raw MongoDB documents into JSON-serializable format
-            metadata = convert_to_serializable(raw_metadata)
+            entries, _ = self.get_metadata_page(limit=limit)
 
             # Group metadata by filename
-            grouped_metadata = {}
-            for item in metadata:
-                filename = item['filename']
-                grouped_metadata[filename] = item  # Directly store the metadata object
-
-            return grouped_metadata
+            return {entry["filename"]: entry for entry in entries}
 
         except Exception as ex:
             raise Exception(f"Error fetching grouped metadata: {ex}")
         
+    def delete_files(self, filenames):
+        """
+        Delete files from the image store in bulk (for GridFS: `$in` queries on the file ids
+        instead of one lookup and delete per file).
+
+        :param filenames: Iterable of filenames to delete.
+        :return: Dictionary with the number of deleted files and the number of bytes reclaimed.
+        """
+        return self.store.delete(filenames)
+
+    def delete_entries(self, entries):
+        """
+        Delete metadata entries and all GridFS files they reference.
+
+        :param entries: List of metadata documents (at least `_id` and the IMAGE_REFERENCE_FIELDS).
+        :return: Dictionary with deleted metadata / file counts and the number of bytes reclaimed.
+        """
+        if not entries:
+            return {"deleted_metadata_count": 0, "deleted_files_count": 0, "reclaimed_bytes": 0}
+
+        ids_to_delete = [entry["_id"] for entry in entries]
+        filenames_to_delete = [entry.get(field) for entry in entries for field in IMAGE_REFERENCE_FIELDS]
+
+        file_result = self.delete_files(filenames_to_delete)
+        delete_result = self.collection.delete_many({"_id": {"$in": ids_to_delete}})
+
+        return {
+            "deleted_metadata_count": delete_result.deleted_count,
+            "deleted_files_count": file_result["deleted_files_count"],
+            "reclaimed_bytes": file_result["reclaimed_bytes"],
+        }
+
+    def _delete_in_batches(self, cursor, batch_size=PRUNE_BATCH_SIZE):
+        """
+        Consume a cursor of metadata entries and delete them batch by batch,
+        so only `batch_size` documents are held in memory at a time.
+
+        :param cursor: Cursor returning metadata documents projected on IMAGE_REFERENCE_PROJECTION.
+        :return: Dictionary with the accumulated deletion counts.
+        """
+        totals = {"deleted_metadata_count": 0, "deleted_files_count": 0, "reclaimed_bytes": 0}
+        batch = []
+        for entry in cursor:
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                for key, value in self.delete_entries(batch).items():
+                    totals[key] += value
+                batch = []
+        if batch:
+            for key, value in self.delete_entries(batch).items():
+                totals[key] += value
+        return totals
+
+    def get_storage_bytes(self):
+        """
+        Return the total number of bytes stored in the image store.
+        """
+        return self.store.total_bytes()
+
     def prune_old_entries(self, retain_count=16):
         """
         Deletes all images and related files from GridFS, and metadata from the collection, 
         except for the latest `retain_count` entries.
         
         :param retain_count: Number of latest entries to retain (default: 16).
+        :return: Dictionary with deleted metadata / file counts and the number of bytes reclaimed.
         """
         try:
-            # Sort by _id and fetch the IDs and file references of entries to delete
-            all_entries = list(self.collection.find({}, {"_id": 1, "filename": 1, "detected_object_file": 1, 
-                                                        "marked_image": 1, "scaled_imagepath": 1})
-                                .sort([("_id", -1)]))  # Latest first
-            entries_to_delete = all_entries[retain_count:]  # Skip the latest `retain_count`
-
-            # Extract IDs and all related filenames to delete
-            ids_to_delete = [entry["_id"] for entry in entries_to_delete]
-            filenames_to_delete = []
-            
-            for entry in entries_to_delete:
-                # Collect all filenames associated with this entry
-                filenames_to_delete.append(entry.get("filename"))
-                filenames_to_delete.append(entry.get("detected_object_file"))
-                filenames_to_delete.append(entry.get("marked_image"))
-                filenames_to_delete.append(entry.get("scaled_imagepath"))
-            
-            # Remove None values or duplicates
-            filenames_to_delete = list(filter(None, set(filenames_to_delete)))
-
-            deleted_files_count = 0
-
-            if ids_to_delete:
-                # Delete GridFS files associated with the entries
-                for filename in filenames_to_delete:
-                    try:
-                        grid_out = self.fs.find_one({"filename": filename})
-                        if grid_out:
-                            self.fs.delete(grid_out._id)
-                            deleted_files_count += 1
-                    except Exception as ex:
-                        self.logger.log_message(f"Error deleting GridFS file '{filename}': {ex}")
-
-                # Delete metadata entries from the collection
-                delete_result = self.collection.delete_many({"_id": {"$in": ids_to_delete}})
-                logger.info(f"Pruned {delete_result.deleted_count} old entries from the database, and deleted {deleted_files_count} files from GridFS.")
-                
-                return {"deleted_metadata_count": delete_result.deleted_count, "deleted_files_count": deleted_files_count}
+            # Latest first; the retained entries are skipped by the server, not loaded into Python
+            cursor = (self.collection.find({}, IMAGE_REFERENCE_PROJECTION)
+                      .sort([("_id", -1)])
+                      .skip(retain_count))
+            result = self._delete_in_batches(cursor)
+
+            if result["deleted_metadata_count"]:
+                logger.info(f"Pruned {result['deleted_metadata_count']} old entries from the database, and deleted "
+                            f"{result['deleted_files_count']} files ({result['reclaimed_bytes']} bytes) from GridFS.")
             else:
                 logger.info("No entries to prune from MongoDB")
-                return {"deleted_metadata_count": 0, "deleted_files_count": 0}
+            return result
         except Exception as ex:
             logger.error(f"Error pruning old entries: {ex}")
             raise Exception(f"Error pruning old entries: {ex}")
 
+    def prune_entries_older_than(self, max_age):
+        """
+        Deletes all entries (and their GridFS files) created before now - `max_age`.
+
+        The creation time is taken from the ObjectId, so the query is served by the `_id` index.
+
+        :param max_age: datetime.timedelta, maximum age of the entries to keep.
+        :return: Dictionary with deleted metadata / file counts and the number of bytes reclaimed.
+        """
+        try:
+            cutoff_id = ObjectId.from_datetime(datetime.now(tz=timezone.utc) - max_age)
+            cursor = self.collection.find({"_id": {"$lt": cutoff_id}}, IMAGE_REFERENCE_PROJECTION)
+            return self._delete_in_batches(cursor)
+        except Exception as ex:
+            logger.error(f"Error pruning entries by age: {ex}")
+            raise Exception(f"Error pruning entries by age: {ex}")
+
+    def prune_to_storage_quota(self, max_bytes, batch_size=PRUNE_BATCH_SIZE):
+        """
+        Deletes the oldest entries (and their GridFS files) until the GridFS storage used
+        is at or below `max_bytes`.
+
+        :param max_bytes: Maximum number of bytes to keep in GridFS.
+        :return: Dictionary with deleted metadata / file counts and the number of bytes reclaimed.
+        """
+        totals = {"deleted_metadata_count": 0, "deleted_files_count": 0, "reclaimed_bytes": 0}
+        try:
+            excess_bytes = self.get_storage_bytes() - max_bytes
+            while excess_bytes > 0:
+                entries = list(self.collection.find({}, IMAGE_REFERENCE_PROJECTION)
+                               .sort([("_id", 1)])  # Oldest first
+                               .limit(batch_size))
+                if not entries:
+                    break
+
+                # Look up the size of all files referenced by this batch in one query
+                filenames = list(filter(None, {entry.get(field) for entry in entries for field in IMAGE_REFERENCE_FIELDS}))
+                sizes = self.store.sizes(filenames)
+
+                # Select just enough of the oldest entries to get below the quota
+                selected = []
+                selected_bytes = 0
+                for entry in entries:
+                    selected.append(entry)
+                    # Several fields may reference the same file ("filename" and "file_name_image"): count it once
+                    selected_bytes += sum(sizes.get(name, 0) for name in {entry.get(field) for field in IMAGE_REFERENCE_FIELDS} if name)
+                    if selected_bytes >= excess_bytes:
+                        break
+
+                result = self.delete_entries(selected)
+                for key, value in result.items():
+                    totals[key] += value
+                excess_bytes -= result["reclaimed_bytes"]
+                if result["deleted_metadata_count"] == 0:
+                    break
+            return totals
+        except Exception as ex:
+            logger.error(f"Error pruning entries to storage quota: {ex}")
+            raise Exception(f"Error pruning entries to storage quota: {ex}")
+
 def main():
     # used to test the MongoDB Handler
 
@@ -0,0 +1,194 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# asyncio variant of the MQTT client, running on the event loop of the server.
+#
+# HomeAssistant_MQTT_Client (helpers/mqtt_client.py) runs paho in its own network thread: its callbacks
+# (on_message -> discovery, on_publish -> acknowledgements) run on that thread, concurrently with the
+# request handlers, and its constructor waits up to 5 seconds for the connection.
+#
+# AsyncHomeAssistant_MQTT_Client drives paho from the event loop instead (paho's "external event loop"
+# socket callbacks): the socket is watched with loop.add_reader / add_writer, the keepalive is serviced by
+# a task, so every callback runs on the event loop and nothing is shared between threads. Only the TCP
+# connection itself (DNS lookup, connect) runs in a thread, while paho is not used by the loop.
+#   - start() returns at once: the connection is made in the background, retried with an exponential
+#     backoff ("MQTT: reconnect_min_seconds" to "reconnect_max_seconds")
+#   - send_value / send_discovery are coroutines; send_value(..., wait=True) waits for the acknowledgement
+#     (False is returned if the message is dropped from the full outbound queue, or after the timeout)
+#   - the outbound queue, its metrics and the last value store are the ones of HomeAssistant_MQTT_Client
+#
+# Used by server.py when "MQTT: client" is "asyncio" in config.yaml (the MQTT publisher process of the
+# multi-process mode keeps the threaded client).
+#
+import os
+import asyncio
+import logging
+
+import paho.mqtt.client as mqtt
+
+from helpers.mqtt_client import HomeAssistant_MQTT_Client
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+
+# pylint: disable=C0103
+class AsyncHomeAssistant_MQTT_Client(HomeAssistant_MQTT_Client):
+    """
+    MQTT client for Home Assistant, living on an asyncio event loop.
+
+    Create it anywhere, then `await start()` on the event loop that will use it, and
+    `await disconnect_mqtt()` on shutdown. All the other methods must be called from that loop.
+    """
+
+    def __init__(self, config):
+        """
+        Initializes the client, without connecting (see start()).
+
+        Args:
+            config: Configuration object.
+        """
+        self._configure(config)
+        self.outbound.on_drop = self._dropped
+        self.connected_event = asyncio.Event()
+        self.client = None
+        self._loop = None
+        self._task = None
+        self._ack_waiters = {}  # seq -> Future resolved with True when the broker acknowledges the message
+
+    async def start(self):
+        """Starts connecting to the broker in the background. Returns at once."""
+        self._loop = asyncio.get_running_loop()
+        self._create_client()
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+        self.client.connect_async(self.mqtt_broker, self.mqtt_port, 60)
+        self._task = asyncio.create_task(self._run(), name="mqtt-client")
+
+    async def _run(self):
+        """Connects, waits for the connection to drop, reconnects after a backoff delay; until cancelled."""
+        delay = self.reconnect_min_seconds
+        while True:
+            self.connected_event.clear()
+            logger.debug("Connecting to MQTT Broker %s:%s...", self.mqtt_broker, self.mqtt_port)
+            try:
+                # Blocking DNS lookup and TCP connection: the loop leaves paho alone meanwhile
+                await asyncio.to_thread(self.client.reconnect)
+            except (OSError, mqtt.WebsocketConnectionError) as ex:
+                logger.warning("Cannot connect to MQTT broker %s:%s (%s), retrying in %i seconds",
+                               self.mqtt_broker, self.mqtt_port, ex, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnect_max_seconds)
+                continue
+            # Connected (or waiting for the CONNACK): service the keepalive until the connection drops
+            while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                await asyncio.sleep(1)
+            if self.connected_event.is_set():
+                delay = self.reconnect_min_seconds  # The session was established: start the backoff over
+            else:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnect_max_seconds)
+
+    def _call_in_loop(self, func, *args):
+        """Runs func now if on the event loop, else schedules it there (paho calls from the connect thread)."""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call_in_loop(self._loop.add_reader, sock, self.client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call_in_loop(self._loop.remove_reader, sock)
+        self._call_in_loop(self._loop.remove_writer, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call_in_loop(self._loop.add_writer, sock, self.client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call_in_loop(self._loop.remove_writer, sock)
+
+    def on_connect(self, client, userdata, flags, rc):
+        """Callback for when the client connects to the broker: also (re)sends the discovery messages."""
+        super().on_connect(client, userdata, flags, rc)
+        if rc == 0 and (self.devices or self.HA_devices):
+            self._queue_discovery()
+
+    def _acknowledged(self, message):
+        super()._acknowledged(message)
+        waiter = self._ack_waiters.pop(message.seq, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(True)
+
+    def _dropped(self, message):
+        """Called by the outbound queue when it drops a message to make room: its waiter gets False."""
+        waiter = self._ack_waiters.pop(message.seq, None)
+        if waiter is not None:
+            self._call_in_loop(lambda: waiter.done() or waiter.set_result(False))
+
+    async def send_value(self, state_topic, value, retain_flag=False, wait=False, timeout=None):
+        """
+        Sends a new value to Home Assistant.
+
+        Args:
+            wait: True to return only once the broker acknowledged the value (may take until the next
+                  connection), False to return as soon as the value is queued.
+            timeout: Maximum number of seconds to wait for the acknowledgement (None: no limit).
+
+        Returns:
+            bool or None: With `wait`, True if the broker acknowledged the value, False if it was dropped from
+                          the full outbound queue or not acknowledged within `timeout` (it stays queued then).
+        """
+        message = self._queue_value(state_topic, value, retain_flag)
+        if not wait:
+            return None
+        if message.seq not in self.outbound:
+            return True  # Acknowledged already
+        waiter = self._ack_waiters.setdefault(message.seq, self._loop.create_future())
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            self._ack_waiters.pop(message.seq, None)
+            return False
+
+    async def send_discovery(self):
+        """Sends discovery messages for all configured devices."""
+        self._queue_discovery()
+
+    async def wait_for_publish(self, timeout=5.0):
+        """Waits until the broker acknowledged all the queued messages (or the timeout). Returns True if it did."""
+        deadline = self._loop.time() + timeout
+        while len(self.outbound) and self._loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        return not len(self.outbound)
+
+    async def disconnect_mqtt(self):
+        """Disconnects the MQTT client from the broker."""
+        if self.client is None:
+            return
+        if self.connected_event.is_set():
+            for device_id in self.devices:
+                self.publish_availability(device_id, "offline")
+            if not await self.wait_for_publish(timeout=5):
+                logger.warning("Disconnecting with %i unacknowledged MQTT message(s)", len(self.outbound))
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self.client.disconnect()
+        self.client.loop_write()  # Sends the DISCONNECT packet and closes the socket
+        for waiter in self._ack_waiters.values():
+            waiter.cancel()
+        self._ack_waiters.clear()
+        self.outbound.close()
+        await asyncio.to_thread(self.last_values.close)
+        logger.info("Disconnected from MQTT Broker!")
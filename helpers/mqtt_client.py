@@ -16,24 +16,165 @@
 #   https://www.home-assistant.io/integrations/sensor.mqtt/
 #   https://www.home-assistant.io/integrations/mqtt/#sensors
 #
+# Outbound messages go through an OutboundQueue: send_value never blocks nor loses a reading while the broker
+# is unreachable. The queue is bounded ("MQTT: outbound_max_messages", the oldest messages are dropped beyond
+# it) and optionally kept in SQLite ("MQTT: outbound_queue_file"), so unacknowledged messages survive a restart.
+# Messages are handed to paho while connected, at most "MQTT: max_inflight" at a time, and removed from the
+# queue when the broker acknowledges them (on_publish, by mid). paho reconnects with an exponential backoff and
+# re-sends the messages in flight; the queued ones follow. Delivery is at least once.
+#
+# For tests, helpers/mqtt_standin_broker.py is a minimal local broker that can also withhold acknowledgements:
+#    >python -m helpers.mqtt_standin_broker --port 1883
+#
 import os
 import json
 import time
+import sqlite3
 import logging
 import threading
-import yaml
+from collections import OrderedDict
 from typing import Dict
 
 import paho.mqtt.client as mqtt
 
 # Import your custom modules
 import helpers.config as config
+from helpers.last_values import LastValueStore
+from helpers.meters import MeterRegistry
+from helpers import metrics
 
 
 # Set up logging
 logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
 logger = logging.getLogger(logger_name)
 
+MQTT_PUBLISH_LATENCY = metrics.histogram("meterreader_mqtt_publish_latency_seconds",
+                                         "Time from queuing an MQTT message to its acknowledgement by the broker")
+MQTT_DROPPED = metrics.counter("meterreader_mqtt_dropped_total", "MQTT messages dropped because the outbound queue was full")
+
+OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    seq       INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic     TEXT NOT NULL,
+    payload   TEXT,
+    qos       INTEGER NOT NULL,
+    retain    INTEGER NOT NULL,
+    queued_at REAL NOT NULL
+);
+"""
+
+
+class OutboundMessage:
+    """
+    A message waiting to be published, or waiting for its acknowledgement.
+
+    Attributes:
+        seq: Sequence number of the message in the queue.
+        mid: paho message id once handed to paho, None while queued.
+    """
+
+    def __init__(self, seq, topic, payload, qos, retain, queued_at):
+        self.seq = seq
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = bool(retain)
+        self.queued_at = queued_at
+        self.mid = None
+
+
+class OutboundQueue:
+    """
+    Bounded FIFO of the messages not acknowledged yet, optionally backed by a SQLite file. Thread safe.
+
+    Attributes:
+        max_messages: Maximum number of messages; the oldest is dropped to make room for a new one.
+        path: SQLite file keeping the messages across restarts, or None (memory only).
+        on_drop: Called with each OutboundMessage dropped to make room, or None. Runs in the thread queuing
+                 the new message, with the queue locked: it must not block.
+    """
+
+    def __init__(self, max_messages=1000, path=None):
+        self.max_messages = max(1, int(max_messages))
+        self.path = path or None
+        self.on_drop = None
+        self._lock = threading.Lock()
+        self._messages = OrderedDict()  # seq -> OutboundMessage, oldest first
+        self._next_seq = 1
+        self._db = None
+        if self.path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(OUTBOX_SCHEMA)
+            for row in self._db.execute("SELECT seq, topic, payload, qos, retain, queued_at FROM outbox ORDER BY seq"):
+                self._messages[row[0]] = OutboundMessage(*row)
+                self._next_seq = row[0] + 1
+            if self._messages:
+                logger.info("%i unacknowledged MQTT message(s) to replay from %s", len(self._messages), self.path)
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates the queue from the "MQTT" section of config.yaml."""
+        return cls(
+            max_messages=config.get("MQTT", "outbound_max_messages", 1000),
+            path=config.get("MQTT", "outbound_queue_file", ""),
+        )
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __contains__(self, seq):
+        return seq in self._messages
+
+    def put(self, topic, payload, qos, retain):
+        """Queues a message, dropping the oldest one if the queue is full. Returns the OutboundMessage."""
+        with self._lock:
+            while len(self._messages) >= self.max_messages:
+                seq, dropped = self._messages.popitem(last=False)
+                self._delete(seq)
+                MQTT_DROPPED.inc()
+                logger.warning("MQTT outbound queue full, dropped the message to %s queued at %s",
+                               dropped.topic, time.ctime(dropped.queued_at))
+                if self.on_drop is not None:
+                    self.on_drop(dropped)
+            if self._db is not None:
+                seq = self._db.execute("INSERT INTO outbox (topic, payload, qos, retain, queued_at) VALUES (?, ?, ?, ?, ?)",
+                                       (topic, payload, qos, int(retain), time.time())).lastrowid
+            else:
+                seq = self._next_seq
+            self._next_seq = seq + 1
+            message = OutboundMessage(seq, topic, payload, qos, retain, time.time())
+            self._messages[seq] = message
+            return message
+
+    def unsent(self, limit):
+        """Returns up to `limit` of the oldest messages not handed to paho yet."""
+        with self._lock:
+            result = []
+            for message in self._messages.values():
+                if len(result) >= limit:
+                    break
+                if message.mid is None:
+                    result.append(message)
+            return result
+
+    def ack(self, message):
+        """Removes an acknowledged message."""
+        with self._lock:
+            if self._messages.pop(message.seq, None) is not None:
+                self._delete(message.seq)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _delete(self, seq):
+        if self._db is not None:
+            self._db.execute("DELETE FROM outbox WHERE seq = ?", (seq,))
+
+
 # pylint: disable=w1203
 # pylint: disable=C0103
 class HomeAssistant_MQTT_Client:
@@ -54,6 +195,7 @@ class HomeAssistant_MQTT_Client:
         HAisOnline: Boolean indicating if Home Assistant is online.
         client: Paho MQTT client object.
         connected_event: Threading event to signal connection status.
+        outbound: OutboundQueue of the messages not acknowledged by the broker yet.
     """
 
     def __init__(self, config):
@@ -63,6 +205,23 @@ class HomeAssistant_MQTT_Client:
         Args:
             config: Configuration object.
         """
+        self._configure(config)
+
+        # Connect to the MQTT broker (in the background: paho retries with a backoff until it succeeds)
+        self.connected_event = threading.Event()
+        self.connect_mqtt()
+
+        # Wait for connection to be established (with timeout)
+        self.connected_event.wait(timeout=5)
+
+        # Send discovery messages for devices (if any)
+        if (self.devices or self.HA_devices) and self.HAisOnline:
+            self.send_discovery()
+        else:
+            logger.info("No devices defined in config.yaml - not sending discovery messages")
+
+    def _configure(self, config):
+        """Reads the settings of the "MQTT" section of config.yaml and creates the queues (no connection yet)."""
         self.config = config
         self.mqtt_broker = self.config.get('MQTT', 'broker')
         self.mqtt_port = int(self.config.get('MQTT', 'port'))
@@ -71,42 +230,58 @@ class HomeAssistant_MQTT_Client:
         self.mqtt_password = self.config.get('MQTT', 'password')
         self.qos = int(self.config.get('MQTT', 'qos', default=1))
         self.birth_topic = self.config.get('MQTT', 'birth_topic', default="homeassistant/status")
+        self.client_id = self.config.get('MQTT', 'client_id', default="MQTT_Client.py")  # Must be unique per broker
 
         self.devices: Dict[str, Dict] = self.config.get('MQTT', 'devices') or {}
         self.HA_device = self.config.get('HomeAssistant', 'device_id') or ""
-        self.yaml_last_value_dir = self.config.get('MQTT', 'last_value_directory') or "static"
+        # Devices whose last value is re-published with the discovery messages: one per meter (helpers/meters.py)
+        self.HA_devices = [meter.device_id for meter in MeterRegistry.from_config(self.config)] \
+            if (self.config.get('Meters', 'meters') or self.HA_device) else []
+        self.last_values = LastValueStore.from_config(self.config)  # Last value per topic, written behind to disk
         self.HAisOnline = False
 
-        # Connect to the MQTT broker
-        self.connect_mqtt()
-
-        # Wait for connection to be established (with timeout)
-        self.connected_event = threading.Event()
-        self.connected_event.wait(timeout=5)
-
-        # Send discovery messages for devices (if any)
-        if (self.devices or self.HA_device) and self.HAisOnline:
-            self.send_discovery()
-        else:
-            logger.info("No devices defined in config.yaml - not sending discovery messages")
+        # Outbound messages, handed to paho while connected and removed once acknowledged
+        self.outbound = OutboundQueue.from_config(self.config)
+        self.max_inflight = max(1, int(self.config.get('MQTT', 'max_inflight', default=20)))
+        self.reconnect_min_seconds = int(self.config.get('MQTT', 'reconnect_min_seconds', default=1))
+        self.reconnect_max_seconds = int(self.config.get('MQTT', 'reconnect_max_seconds', default=60))
+        self._inflight = {}         # mid -> OutboundMessage handed to paho, waiting for its acknowledgement
+        self._early_acks = set()    # mids acknowledged before publish() returned
+        self._inflight_lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._drain_again = False
+        self.client = None
+        self.message_handlers = {}  # topic filter -> (callback, qos), see subscribe()
+        metrics.gauge("meterreader_mqtt_outbound_depth", "MQTT messages not acknowledged by the broker yet",
+                      function=lambda: len(self.outbound))
+        metrics.gauge("meterreader_mqtt_inflight", "MQTT messages sent, waiting for their acknowledgement",
+                      function=lambda: len(self._inflight))
+        metrics.gauge("meterreader_mqtt_connected", "1 while connected to the MQTT broker",
+                      function=lambda: int(self.connected_event.is_set()))
 
     def connect_mqtt(self):
         """Sets up the MQTT client and connects to the broker."""
 
         logger.debug("Connecting to MQTT Broker...")
-        self.client = mqtt.Client(client_id="MQTT_Client.py", clean_session=True, userdata=None, protocol=mqtt.MQTTv311, transport="tcp")
+        self._create_client()
+        self.client.connect_async(self.mqtt_broker, self.mqtt_port, 60)
+        self.client.loop_start()
+        self.HAisOnline = True
+
+    def _create_client(self):
+        """Creates the paho client and assigns the callbacks."""
+        self.client = mqtt.Client(client_id=self.client_id, clean_session=True, userdata=None, protocol=mqtt.MQTTv311, transport="tcp")
         self.client.enable_logger()
         self.client.username_pw_set(self.mqtt_username, self.mqtt_password)
 
+        self.client.reconnect_delay_set(min_delay=self.reconnect_min_seconds, max_delay=self.reconnect_max_seconds)
+
         # Assign callbacks
         self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
         self.client.on_publish = self.on_publish
 
-        self.client.connect(self.mqtt_broker, self.mqtt_port, 60)
-        self.client.loop_start()
-        self.HAisOnline = True
-
     def on_connect(self, client, userdata, flags, rc):
         """Callback for when the client connects to the broker."""
 
@@ -114,21 +289,50 @@ class HomeAssistant_MQTT_Client:
         if rc == 0:
             logger.info("Connected to MQTT Broker!")
             self.client.subscribe(self.birth_topic)
+            for topic_filter, (_, qos) in list(self.message_handlers.items()):
+                self.client.subscribe(topic_filter, qos)
             self.HAisOnline = True
             self.connected_event.set()  # Signal successful connection
+            self._drain()  # Messages queued while disconnected
         else:
             logger.error(f"Failed to connect, return code {rc}")
             self.HAisOnline = False
 
+    def on_disconnect(self, client, userdata, rc):
+        """Callback for when the connection to the broker is lost (paho reconnects on its own)."""
+        self.connected_event.clear()
+        if rc != 0:
+            logger.warning(f"Disconnected from MQTT broker (code {rc}), {len(self.outbound)} message(s) kept for later")
+
+    def subscribe(self, topic_filter, callback, qos=None):
+        """
+        Subscribes to a topic filter ("+" / "#" wildcards), now and after every reconnection.
+
+        Args:
+            topic_filter (str): Topic filter.
+            callback (callable): Called with each message received on a matching topic (paho MQTTMessage).
+                                 Runs on the thread of the MQTT client: it must not block.
+            qos (int, optional): QoS of the subscription (default: "MQTT: qos").
+        """
+        self.message_handlers[topic_filter] = (callback, self.qos if qos is None else qos)
+        if self.client is not None and self.client.is_connected():
+            self.client.subscribe(topic_filter, self.message_handlers[topic_filter][1])
+
     def on_message(self, client, userdata, msg):
         """Callback for when a message is received."""
         try:
+            for topic_filter, (callback, _) in list(self.message_handlers.items()):
+                if mqtt.topic_matches_sub(topic_filter, msg.topic):
+                    logger.debug(f"Received {len(msg.payload)} bytes on topic: {msg.topic}")
+                    callback(msg)
+                    return
+
             logger.info(f"Received message: {msg.payload.decode()} on topic: {msg.topic}")
 
             if msg.topic == self.birth_topic:
                 if msg.payload.decode() == "online":
-                    if self.devices or self.HA_device:
-                        self.send_discovery()
+                    if self.devices or self.HA_devices:
+                        self._queue_discovery()
                     self.HAisOnline = True
                 elif msg.payload.decode() == "offline":
                     for device_id in self.devices:
@@ -140,65 +344,117 @@ class HomeAssistant_MQTT_Client:
             logger.error(f"Error processing message: {e}")
 
     def on_publish(self, client, userdata, mid):
-        """Callback for when a message is published."""
+        """Callback for when a message is published (QoS 0) or acknowledged by the broker (QoS 1 / 2)."""
         logger.debug(f"Message {mid} has been published.")
+        with self._inflight_lock:
+            message = self._inflight.pop(mid, None)
+            if message is None:
+                self._early_acks.add(mid)  # publish() has not returned the mid yet
+                return
+        self._acknowledged(message)
+        self._drain()
+
+    def _acknowledged(self, message):
+        self.outbound.ack(message)
+        MQTT_PUBLISH_LATENCY.observe(max(0.0, time.time() - message.queued_at))
+
+    def publish(self, topic, payload, qos=None, retain=False):
+        """
+        Queues a message and publishes it as soon as possible. Never blocks.
+
+        Returns:
+            OutboundMessage: The queued message.
+        """
+        message = self.outbound.put(topic, payload, self.qos if qos is None else qos, retain)
+        self._drain()
+        return message
+
+    def _drain(self):
+        """
+        Hands the queued messages to paho while connected, keeping at most `max_inflight` of them
+        unacknowledged. Called from any thread; concurrent calls are folded into the running one.
+        """
+        while True:
+            if not self._drain_lock.acquire(blocking=False):
+                self._drain_again = True  # The running drain goes round once more
+                return
+            try:
+                self._drain_again = False
+                self._drain_once()
+            finally:
+                self._drain_lock.release()
+            if not self._drain_again:
+                return
+
+    def _drain_once(self):
+        if not self.client.is_connected():
+            return
+        for message in self.outbound.unsent(self.max_inflight - len(self._inflight)):
+            info = self.client.publish(message.topic, payload=message.payload, qos=message.qos, retain=message.retain)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                # Disconnected meanwhile: paho keeps the message and sends it once reconnected
+                logger.debug(f"Message to {message.topic} handed to paho while disconnected (rc {info.rc})")
+            with self._inflight_lock:
+                message.mid = info.mid
+                acknowledged = info.mid in self._early_acks
+                if acknowledged:
+                    self._early_acks.discard(info.mid)
+                else:
+                    self._inflight[info.mid] = message
+            if acknowledged:
+                self._acknowledged(message)
+                self._drain_again = True
+
+    def wait_for_publish(self, timeout=5.0):
+        """Waits until the broker acknowledged all the queued messages (or the timeout). Returns True if it did."""
+        deadline = time.monotonic() + timeout
+        while len(self.outbound) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return not len(self.outbound)
 
     def publish_availability(self, device_id: str, payload: str):
         """Publishes availability message for a device."""
         if device_id in self.devices:
             availability_topic = f"{self.mqtt_topic}/{device_id}/status"
-            self.client.publish(availability_topic, payload=payload, qos=self.qos, retain=False)
+            self.publish(availability_topic, payload=payload, qos=self.qos, retain=False)
             logger.debug(f"Published availability: {payload} to {availability_topic}")
         else:
             logger.warning(f"Device {device_id} not found in devices list.")
 
     def send_discovery(self):
         """Sends discovery messages for all configured devices."""
+        self._queue_discovery()
+
+    def _queue_discovery(self):
         for device_id, device_info in self.devices.items():
             config_topic = f"{self.mqtt_topic}/{device_id}/config"
             payload_str = json.dumps(device_info)
-            self.client.publish(config_topic, payload=payload_str, qos=self.qos, retain=False)
+            self.publish(config_topic, payload=payload_str, qos=self.qos, retain=False)
             logger.debug(f"Published discovery message for {device_id} to {config_topic}")
             self.publish_availability(device_id, "online")
-        if self.HA_device: # Handle a single Device defined in config.ymal (configured in HA configuration.ymal)
-            # Check if state_topic is a full topic path or just an object_id            
-            last_message_sent = self.load_mqtt_data(self.HA_device)
-            logger.debug(f"Last known message published to {self.HA_device}: {last_message_sent}")
-            self.send_value(self.HA_device, last_message_sent.get("value"), retain_flag=False)
-
-    def save_mqtt_data(self, data, topic):
-        """Saves the MQTT data to a YAML file."""
-        yaml_file = f"{self.yaml_last_value_dir}/Last_Value_{topic.replace("/","_")}.yaml"
-        try:
-            with open(yaml_file, 'w') as f:
-                yaml.dump(data, f)
-        except Exception as e:
-            print(f"Error saving data to YAML: {e}")
-
-    def load_mqtt_data(self, topic):
-        """Loads the last MQTT data from the YAML file."""
-        yaml_file = f"{self.yaml_last_value_dir}/Last_Value_{topic.replace("/","_")}.yaml"
-        try:
-            with open(yaml_file, 'r') as f:
-                return yaml.safe_load(f)
-        except FileNotFoundError:
-            print("YAML file not found. Returning default data.")
-            return {
-                "timestamp": 0,
-                "timestamp_str": str(time.ctime(0)),  # Epoch time
-                "value": None,
-            }
-        except Exception as e:
-            print(f"Error loading data from YAML: {e}")
-            return None
-
+        for device in self.HA_devices: # Devices of the meters defined in config.ymal (configured in HA configuration.ymal)
+            last_message_sent = self.last_values.get(self.state_topic(device))
+            if last_message_sent.get("value") is None:
+                logger.debug(f"No value published to {device} yet, nothing to re-publish")
+                continue
+            logger.debug(f"Last known message published to {device}: {last_message_sent}")
+            self._queue_value(device, last_message_sent.get("value"), retain_flag=False)
+
+    def state_topic(self, state_topic):
+        """Returns the full state topic of an object_id (full topic paths are returned as is)."""
+        if not state_topic.startswith(self.mqtt_topic):  # Not a full path
+            state_topic = f"{self.mqtt_topic}/{state_topic}/state"  # Assemble full path
+        return state_topic
 
     def send_value(self, state_topic, value, retain_flag=False):
         """Sends a new value to Home Assistant."""
+        self._queue_value(state_topic, value, retain_flag)
+
+    def _queue_value(self, state_topic, value, retain_flag=False):
+        """Queues a value for Home Assistant and records it as the last value. Returns the OutboundMessage."""
 
         # Check if state_topic is a full topic path or just an object_id
-        if not state_topic.startswith(self.mqtt_topic):  # Not a full path
-            state_topic = f"{self.mqtt_topic}/{state_topic}/state"  # Assemble full path
+        state_topic = self.state_topic(state_topic)
 
         epoch_timestamp = int(time.time())
 
@@ -215,19 +471,24 @@ class HomeAssistant_MQTT_Client:
         }
         json_payload_str = json.dumps(data)
 
-        
-        self.client.publish(state_topic, payload=json_payload_str, qos=self.qos, retain=retain_flag)
+        # Queued, published as soon as the broker is reachable
+        message = self.publish(state_topic, payload=json_payload_str, qos=self.qos, retain=retain_flag)
         logger.info(f"Published value: {json_payload_str} to topic: {state_topic} Retain={retain_flag}")
 
-        self.save_mqtt_data(data, state_topic)
+        self.last_values.set(state_topic, mqtt_value, epoch_timestamp)  # In memory, written behind to disk
+        return message
 
     def disconnect_mqtt(self):
         """Disconnects the MQTT client from the broker."""
         if self.devices:
             for device_id in self.devices:
                 self.publish_availability(device_id, "offline")
+        if self.client.is_connected() and not self.wait_for_publish(timeout=5):
+            logger.warning(f"Disconnecting with {len(self.outbound)} unacknowledged MQTT message(s)")
         self.client.disconnect(reasoncode=0, properties=None)
         self.client.loop_stop()
+        self.outbound.close()
+        self.last_values.close()
         logger.info("Disconnected from MQTT Broker!")
 
 def main():
@@ -0,0 +1,166 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Image ingestion over MQTT: cameras that hold an MQTT connection (e.g. ESP32-CAM) publish their images instead
+# of POSTing them to /file.
+#
+# MQTTImageIngest subscribes to "MQTT: image_topic" (e.g. "meterreader/+/image") with the MQTT client of the
+# server, and queues every image received like an HTTP upload (same job queue, spool and meters). The payload is:
+#   - either the JPEG itself: the meter is the level of the topic matched by "+" (e.g. meterreader/gas/image)
+#   - or a JSON object {"image": "<base64 JPEG>", "meter": "<meter id>", "filename": "<name>"} ("meter" and
+#     "filename" are optional)
+# When the job is done, the result is published to "MQTT: result_topic" (default "meterreader/{meter}/result"):
+#   {"filename": ..., "meter": ..., "job_id": ..., "status": "done" | "failed" | ..., "value": ..., "error": ...}
+#
+# The ingestion is opt-in: it is disabled while image_topic is empty (the default). In the multi-process mode the MQTT connection belongs to the
+# publisher process, which has no job queue: the ingestion is only available when the server runs as one process.
+#
+# To try it with the stand-in broker (helpers/mqtt_standin_broker.py):
+#    >mosquitto_pub -h localhost -t meterreader/my_meter/image -f meter.jpg
+#
+import os
+import json
+import time
+import base64
+import asyncio
+import logging
+import binascii
+from datetime import datetime
+
+from helpers import metrics
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+MQTT_IMAGES = metrics.counter("meterreader_mqtt_images_total", "Images received over MQTT, by outcome", ["outcome"])
+
+
+class MQTTImageIngest:
+    """
+    Queues the images published on an MQTT topic, and publishes their results.
+
+    Attributes:
+        client: HomeAssistant_MQTT_Client (or its asyncio variant) subscribing and publishing.
+        submit: Coroutine function (filename, content, meter_id) queuing an image, returning its Job.
+        topic: Topic filter of the images.
+        result_topic: Topic of the results, "{meter}" is replaced by the id of the meter.
+        max_image_size: Images larger than this are refused (bytes).
+    """
+
+    def __init__(self, client, submit, topic="meterreader/+/image", result_topic="meterreader/{meter}/result",
+                 qos=1, max_image_size=10 * 1024 * 1024):
+        self.client = client
+        self.submit = submit
+        self.topic = topic
+        self.result_topic = result_topic
+        self.qos = qos
+        self.max_image_size = max_image_size
+        self._loop = None
+        levels = topic.split("/")
+        self._meter_level = levels.index("+") if "+" in levels else None  # Level of the topic naming the meter
+
+    @classmethod
+    def from_config(cls, config, client, submit):
+        """
+        Creates the ingestion from the "MQTT" section of config.yaml.
+
+        Returns:
+            MQTTImageIngest or None: None if disabled, or if the MQTT connection is not held by this process.
+        """
+        topic = config.get("MQTT", "image_topic", "")
+        if not topic:
+            return None
+        if not hasattr(client, "subscribe"):
+            # The workers only forward what they publish to the MQTT publisher process (helpers/workers.py)
+            logger.warning("MQTT image ingestion on %s is disabled: not available with several worker processes "
+                           "(set \"Server: workers: 1\" to use it)", topic)
+            return None
+        return cls(
+            client,
+            submit,
+            topic=topic,
+            result_topic=config.get("MQTT", "result_topic", "meterreader/{meter}/result"),
+            qos=int(config.get("MQTT", "qos", 1)),
+            max_image_size=int(float(config.get("MQTT", "image_max_mb", 10)) * 1024 * 1024),
+        )
+
+    def start(self):
+        """Subscribes to the image topic. Called on the event loop running the job queue."""
+        self._loop = asyncio.get_running_loop()
+        self.client.subscribe(self.topic, self.on_message, qos=self.qos)
+        logger.info("Receiving images on MQTT topic %s", self.topic)
+
+    def on_message(self, msg):
+        """Message handler: called on the thread of the MQTT client, hands the image over to the event loop."""
+        asyncio.run_coroutine_threadsafe(self.ingest(msg.topic, msg.payload), self._loop)
+
+    def topic_meter(self, topic):
+        """Id of the meter named by the level of the topic matched by "+" (None if the filter has no "+")."""
+        levels = topic.split("/")
+        if self._meter_level is None or self._meter_level >= len(levels):
+            return None
+        return levels[self._meter_level]
+
+    def parse(self, topic, payload):
+        """
+        Extracts the image and its metadata from a message.
+
+        Returns:
+            tuple: (filename, image content, meter id or None).
+
+        Raises:
+            ValueError: If the payload is not an image, or a JSON object without a valid "image".
+        """
+        meter_id = self.topic_meter(topic)
+        filename = None
+        if payload[:1] == b"{":
+            try:
+                envelope = json.loads(payload)
+                content = base64.b64decode(envelope["image"], validate=True)
+            except (ValueError, KeyError, TypeError, binascii.Error) as ex:
+                raise ValueError(f"Invalid JSON image message: {ex}")
+            meter_id = envelope.get("meter") or meter_id
+            filename = envelope.get("filename")
+        else:
+            content = bytes(payload)
+        if not content:
+            raise ValueError("Empty image")
+        if len(content) > self.max_image_size:
+            raise ValueError(f"Image of {len(content)} bytes, larger than {self.max_image_size} bytes")
+        if not filename:
+            filename = f"mqtt_{meter_id or 'image'}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.jpg"
+        return filename, content, meter_id
+
+    async def ingest(self, topic, payload):
+        """Queues the image of a message; its result is published when the job is done."""
+        meter_id = self.topic_meter(topic)
+        try:
+            filename, content, meter_id = self.parse(topic, payload)
+            job = await self.submit(filename, content, meter_id)
+        except Exception as ex:
+            logger.warning("Image received on %s refused: %s", topic, ex)
+            MQTT_IMAGES.inc(outcome="refused")
+            self.publish_result(meter_id, {"topic": topic, "status": "refused", "error": str(ex)})
+            return
+        MQTT_IMAGES.inc(outcome="queued")
+        meter_id = job.payload.get("meter") or meter_id
+        logger.info("Image %s received on %s queued as job %s", filename, topic, job.id)
+        job.future.add_done_callback(lambda _: self.publish_result(meter_id, job.to_dict()))
+
+    def publish_result(self, meter_id, status):
+        """Publishes the status of a job (see Job.to_dict()) to the result topic of its meter."""
+        if not self.result_topic:
+            return
+        result = status.get("result") or {}
+        message = {
+            "filename": status.get("filename"),
+            "meter": result.get("meter") or meter_id,
+            "job_id": status.get("job_id"),
+            "status": status.get("status"),
+            "value": result.get("value"),
+            "error": status.get("error"),
+            "timestamp": int(time.time()),
+        }
+        topic = self.result_topic.replace("{meter}", message["meter"] or "default")
+        self.client.publish(topic, json.dumps(message), qos=self.qos, retain=False)
@@ -0,0 +1,188 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Minimal MQTT 3.1.1 broker, standing in for the real one in tests of the MQTT client.
+#
+# Supports CONNECT, PUBLISH (QoS 0 and 1, retained messages), SUBSCRIBE (exact topics, "+" and "#"),
+# PINGREQ and DISCONNECT. QoS 2 publications are delivered as QoS 1. No authentication, no persistence.
+#
+# The acknowledgements can be withheld (--withhold-acks, or StandinBroker.withhold_acks = True) to simulate
+# a broker that stalls, and the broker can be stopped and restarted to test the reconnection / replay:
+#    >python -m helpers.mqtt_standin_broker --port 1883 --log-level DEBUG
+#
+import os
+import asyncio
+import logging
+import argparse
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+# Control packet types
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 12, 13, 14
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _packet(packet_type, flags, body):
+    return bytes([packet_type << 4 | flags]) + _encode_length(len(body)) + body
+
+
+def _string(data, offset):
+    length = int.from_bytes(data[offset:offset + 2], "big")
+    return data[offset + 2:offset + 2 + length].decode("utf-8"), offset + 2 + length
+
+
+def topic_matches(topic_filter, topic):
+    """True if a topic matches a subscription filter ("+" one level, "#" all the remaining levels)."""
+    filter_levels, topic_levels = topic_filter.split("/"), topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels) or (level != "+" and level != topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class StandinBroker:
+    """
+    Minimal asyncio MQTT broker.
+
+    Attributes:
+        host, port: Address the broker listens on (port 0 picks a free port, see `port` after start()).
+        withhold_acks: True to receive QoS 1 publications without acknowledging them.
+        received: (topic, payload, qos, retain) of every publication received, in order.
+    """
+
+    def __init__(self, host="127.0.0.1", port=1883, withhold_acks=False):
+        self.host = host
+        self.port = port
+        self.withhold_acks = withhold_acks
+        self.received = []
+        self.retained = {}          # topic -> payload
+        self._sessions = {}         # writer -> set of topic filters
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("MQTT stand-in broker listening on %s:%i", self.host, self.port)
+
+    async def stop(self):
+        """Stops listening and drops all the connections (as a broker crash would)."""
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._sessions):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def has_subscriber(self, topic):
+        """True if a connected client subscribed to a filter matching `topic`."""
+        return any(topic_matches(topic_filter, topic) for filters in self._sessions.values() for topic_filter in filters)
+
+    async def _read_packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0F, await reader.readexactly(length)
+
+    async def _handle(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        self._sessions[writer] = set()
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == CONNECT:
+                    logger.debug("CONNECT from %s", peer)
+                    writer.write(_packet(CONNACK, 0, b"\x00\x00"))
+                elif packet_type == PUBLISH:
+                    await self._on_publish(writer, flags, body)
+                elif packet_type == PUBACK:
+                    pass  # Deliveries to the subscribers are fire and forget
+                elif packet_type == SUBSCRIBE:
+                    self._on_subscribe(writer, body)
+                elif packet_type == PINGREQ:
+                    writer.write(_packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    break
+                else:
+                    logger.warning("Unsupported MQTT packet type %i from %s", packet_type, peer)
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass  # Closed by the client, or the broker is stopping
+        finally:
+            self._sessions.pop(writer, None)
+            writer.close()
+            logger.debug("Connection from %s closed", peer)
+
+    async def _on_publish(self, writer, flags, body):
+        qos, retain = (flags >> 1) & 0x03, bool(flags & 0x01)
+        topic, offset = _string(body, 0)
+        packet_id = None
+        if qos:
+            packet_id, offset = body[offset:offset + 2], offset + 2
+        payload = body[offset:]
+        self.received.append((topic, payload, qos, retain))
+        logger.debug("PUBLISH %s (QoS %i, retain %s): %r", topic, qos, retain, payload)
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for subscriber, filters in list(self._sessions.items()):
+            if any(topic_matches(topic_filter, topic) for topic_filter in filters):
+                subscriber.write(_packet(PUBLISH, 0, len(topic.encode()).to_bytes(2, "big") + topic.encode() + payload))
+        if qos and not self.withhold_acks:
+            writer.write(_packet(PUBACK, 0, packet_id))
+
+    def _on_subscribe(self, writer, body):
+        packet_id, offset, granted = body[:2], 2, bytearray()
+        while offset < len(body):
+            topic_filter, offset = _string(body, offset)
+            offset += 1  # Requested QoS
+            self._sessions[writer].add(topic_filter)
+            granted.append(0)
+            for topic, payload in self.retained.items():
+                if topic_matches(topic_filter, topic):
+                    writer.write(_packet(PUBLISH, 1, len(topic.encode()).to_bytes(2, "big") + topic.encode() + payload))
+        writer.write(_packet(SUBACK, 0, packet_id + bytes(granted)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Minimal MQTT broker for testing the MQTT client")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--withhold-acks", action="store_true", help="Never acknowledge QoS 1 publications")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(message)s")
+    broker = StandinBroker(args.host, args.port, withhold_acks=args.withhold_acks)
+    try:
+        asyncio.run(broker.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Output sinks of the accepted readings: MQTT (Home Assistant), HTTP webhooks and an append-only file.
+#
+# The readings accepted by the plausibility filter (helpers/plausibility.py) are handed to the OutputFanout,
+# which queues them to every configured sink and returns at once. Each sink has:
+#   - its own bounded queue: when a sink falls behind, its oldest readings are dropped, the others are not affected
+#   - its own worker task(s) and retry policy (max_attempts, exponential backoff from retry_min_seconds to
+#     retry_max_seconds)
+#   - its metrics: meterreader_output_latency_seconds{sink} (from the reading being queued to its delivery),
+#     meterreader_output_total{sink,outcome} (delivered, retried, failed, dropped) and
+#     meterreader_output_queue_depth{sink}
+# so a slow or unreachable sink never delays another one, nor the processing of the uploads.
+#
+# Sinks ("Outputs" section of config.yaml):
+#   - mqtt: the value to the state topic of the meter in Home Assistant (the MQTT client has its own
+#           outbound queue, see helpers/mqtt_client.py)
+#   - webhooks: a JSON POST of the reading (Reading.to_dict()) per URL, over keep-alive connections reused
+#               from a pool (max_connections requests in flight per webhook)
+#   - file: one line per reading appended to a file, InfluxDB line protocol or CSV
+#
+# New sinks subclass OutputSink and implement deliver() (and close(), if they hold resources).
+#
+import os
+import csv
+import json
+import time
+import queue
+import asyncio
+import logging
+import http.client
+import urllib.parse
+
+from helpers import metrics
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+OUTPUT_LATENCY = metrics.histogram("meterreader_output_latency_seconds",
+                                   "Time from a reading being queued to its delivery, by sink", ["sink"])
+OUTPUT_TOTAL = metrics.counter("meterreader_output_total", "Readings handled by the output sinks, by outcome",
+                               ["sink", "outcome"])
+OUTPUT_DEPTH = metrics.gauge("meterreader_output_queue_depth", "Readings waiting in the queue of each sink",
+                             ["sink"])
+
+
+class OutputSink:
+    """
+    Base class of the output sinks: a bounded queue of readings, delivered by worker tasks with retries.
+
+    Attributes:
+        name: Name of the sink, in the logs and the metrics.
+        queue_size: Readings kept while the sink falls behind (the oldest are dropped beyond).
+        concurrency: Readings delivered at the same time (1 keeps them in order).
+        max_attempts: Deliveries of a reading attempted before it is given up.
+        retry_min_seconds, retry_max_seconds: Bounds of the exponential backoff between attempts.
+    """
+
+    def __init__(self, name, queue_size=1000, concurrency=1, max_attempts=5, retry_min_seconds=1.0,
+                 retry_max_seconds=60.0):
+        self.name = name
+        self.queue_size = max(1, int(queue_size))
+        self.concurrency = max(1, int(concurrency))
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_min_seconds = float(retry_min_seconds)
+        self.retry_max_seconds = float(retry_max_seconds)
+        self._queue = None
+        self._tasks = []
+
+    @staticmethod
+    def retry_settings(settings, queue_size):
+        """Keyword arguments of the OutputSink constructor, from the settings of a sink in config.yaml."""
+        return {
+            "queue_size": settings.get("queue_size", queue_size),
+            "max_attempts": settings.get("max_attempts", 5),
+            "retry_min_seconds": settings.get("retry_min_seconds", 1),
+            "retry_max_seconds": settings.get("retry_max_seconds", 60),
+        }
+
+    def start(self):
+        """Starts the worker tasks. Called on the event loop of the server."""
+        self._queue = asyncio.Queue(self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker(), name=f"output-{self.name}-{index}")
+                       for index in range(self.concurrency)]
+
+    def submit(self, reading):
+        """Queues a reading. Never waits: the oldest reading is dropped when the queue is full."""
+        if self._queue is None:
+            logger.warning("Output %s is not started, reading %s dropped", self.name, reading.value)
+            OUTPUT_TOTAL.inc(sink=self.name, outcome="dropped")
+            return
+        if self._queue.full():
+            dropped, _ = self._queue.get_nowait()
+            self._queue.task_done()
+            logger.warning("Output %s is falling behind, reading %s dropped", self.name, dropped.value)
+            OUTPUT_TOTAL.inc(sink=self.name, outcome="dropped")
+        self._queue.put_nowait((reading, time.monotonic()))
+        OUTPUT_DEPTH.set(self._queue.qsize(), sink=self.name)
+
+    async def deliver(self, reading):
+        """Delivers a reading. Raises an exception to have it retried."""
+        raise NotImplementedError
+
+    async def close(self):
+        """Releases the resources of the sink, once its workers are stopped."""
+
+    async def _worker(self):
+        while True:
+            reading, queued_at = await self._queue.get()
+            OUTPUT_DEPTH.set(self._queue.qsize(), sink=self.name)
+            try:
+                await self._deliver_with_retries(reading, queued_at)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver_with_retries(self, reading, queued_at):
+        delay = self.retry_min_seconds
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                await self.deliver(reading)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                if attempt == self.max_attempts:
+                    logger.error("Output %s: reading %s of %s given up after %i attempt(s): %s",
+                                 self.name, reading.value, reading.meter.id, attempt, ex)
+                    OUTPUT_TOTAL.inc(sink=self.name, outcome="failed")
+                    return
+                logger.warning("Output %s: delivery of reading %s failed (%s), retrying in %.1f seconds",
+                               self.name, reading.value, ex, delay)
+                OUTPUT_TOTAL.inc(sink=self.name, outcome="retried")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.retry_max_seconds)
+            else:
+                OUTPUT_LATENCY.observe(time.monotonic() - queued_at, sink=self.name)
+                OUTPUT_TOTAL.inc(sink=self.name, outcome="delivered")
+                return
+
+    async def stop(self, timeout=5.0):
+        """Delivers the queued readings (up to the timeout), then stops the workers and closes the sink."""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Output %s stopped with %i undelivered reading(s)", self.name, self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        await self.close()
+
+
+class MQTTSink(OutputSink):
+    """Publishes the readings to the state topic of their meter in Home Assistant."""
+
+    def __init__(self, client, name="mqtt", **kwargs):
+        super().__init__(name, **kwargs)
+        self.client = client
+
+    async def deliver(self, reading):
+        # Queued by the MQTT client: never waits for the broker
+        result = self.client.send_value(reading.meter.device_id, float(reading.value))
+        if asyncio.iscoroutine(result):
+            await result
+
+
+class WebhookSink(OutputSink):
+    """
+    POSTs the readings as JSON to a URL.
+
+    The requests are made with http.client in worker threads, over keep-alive connections kept in a pool:
+    at most `max_connections` requests are in flight, each reusing an idle connection if there is one.
+    """
+
+    def __init__(self, url, name=None, headers=None, timeout=5.0, max_connections=4, **kwargs):
+        super().__init__(name or f"webhook:{urllib.parse.urlsplit(url).netloc}", concurrency=max_connections, **kwargs)
+        self.url = url
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"Outputs: unsupported webhook URL {url}")
+        self._connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self._host = parts.netloc
+        self._path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        self.headers = {"Content-Type": "application/json", **(headers or {})}
+        self.timeout = float(timeout)
+        self._idle = queue.LifoQueue()  # Idle keep-alive connections (the most recently used first)
+
+    async def deliver(self, reading):
+        body = json.dumps(reading.to_dict()).encode("utf-8")
+        await asyncio.to_thread(self._post, body)
+
+    def _post(self, body):
+        try:
+            connection, reused = self._idle.get_nowait(), True
+        except queue.Empty:
+            connection, reused = self._connection_class(self._host, timeout=self.timeout), False
+        try:
+            connection.request("POST", self._path, body=body, headers=self.headers)
+            response = connection.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            connection.close()
+            if not reused:
+                raise
+            return self._post(body)  # The server closed the idle connection: once more on a new one
+        except Exception:
+            connection.close()
+            raise
+        response.read()
+        if response.will_close:
+            connection.close()
+        else:
+            self._idle.put(connection)
+        if response.status >= 400:
+            raise OSError(f"HTTP {response.status} {response.reason} from {self.url}")
+
+    async def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class FileSink(OutputSink):
+    """
+    Appends the readings to a file, one line each: InfluxDB line protocol ("line") or CSV ("csv").
+
+    Line protocol: <measurement>,meter=<id>,device_id=<device id> value=<value>i,confidence=<c> <timestamp ns>
+    CSV: timestamp,meter,device_id,value,confidence,filename (with a header line when the file is created)
+    """
+
+    CSV_FIELDS = ("timestamp", "meter", "device_id", "value", "confidence", "filename")
+
+    def __init__(self, path, name="file", format="line", measurement="meter_reading", **kwargs):
+        super().__init__(name, **kwargs)
+        if format not in ("line", "csv"):
+            raise ValueError(f"Outputs: unknown file format '{format}', expected 'line' or 'csv'")
+        self.path = path
+        self.format = format
+        self.measurement = measurement
+        self._file = None
+
+    @staticmethod
+    def _escape(value):
+        """Escapes a measurement, tag key or tag value of the line protocol."""
+        return str(value).replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+    def format_line(self, reading):
+        """Returns the line protocol line of a reading."""
+        tags = f"meter={self._escape(reading.meter.id)},device_id={self._escape(reading.meter.device_id)}"
+        fields = f"value={int(reading.value)}i,confidence={float(reading.confidence or 0):.3f}"
+        nanoseconds = int(reading.timestamp.timestamp()) * 1_000_000_000 + reading.timestamp.microsecond * 1000
+        return f"{self._escape(self.measurement)},{tags} {fields} {nanoseconds}\n"
+
+    async def deliver(self, reading):
+        await asyncio.to_thread(self._append, reading)
+
+    def _append(self, reading):
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            self._file = open(self.path, "a", encoding="utf-8", newline="")
+            if new_file and self.format == "csv":
+                csv.writer(self._file).writerow(self.CSV_FIELDS)
+        if self.format == "csv":
+            csv.writer(self._file).writerow([reading.timestamp.isoformat(), reading.meter.id, reading.meter.device_id,
+                                             reading.value, reading.confidence, reading.filename])
+        else:
+            self._file.write(self.format_line(reading))
+        self._file.flush()
+
+    async def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class OutputFanout:
+    """
+    Hands every accepted reading to all the output sinks, without waiting for any of them.
+
+    Attributes:
+        sinks: The configured OutputSink objects.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    @classmethod
+    def from_config(cls, config, mqtt_client):
+        """Creates the sinks of the "Outputs" section of config.yaml (MQTT only, without the section)."""
+        queue_size = int(config.get("Outputs", "queue_size", 1000))
+        sinks = []
+        mqtt_settings = config.get("Outputs", "mqtt") or {}
+        if mqtt_settings.get("enabled", True):
+            sinks.append(MQTTSink(mqtt_client, **OutputSink.retry_settings(mqtt_settings, queue_size)))
+        for settings in config.get("Outputs", "webhooks") or []:
+            sinks.append(WebhookSink(
+                settings["url"],
+                name=settings.get("name"),
+                headers=settings.get("headers"),
+                timeout=settings.get("timeout_seconds", 5),
+                max_connections=settings.get("max_connections", 4),
+                **OutputSink.retry_settings(settings, queue_size),
+            ))
+        file_settings = config.get("Outputs", "file") or {}
+        if file_settings.get("path"):
+            sinks.append(FileSink(
+                file_settings["path"],
+                format=file_settings.get("format", "line"),
+                measurement=file_settings.get("measurement", "meter_reading"),
+                **OutputSink.retry_settings(file_settings, queue_size),
+            ))
+        logger.info("Output sinks: %s", ", ".join(sink.name for sink in sinks) or "none")
+        return cls(sinks)
+
+    def __iter__(self):
+        return iter(self.sinks)
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+
+    def publish(self, reading):
+        """Queues a reading to every sink. Returns at once."""
+        for sink in self.sinks:
+            sink.submit(reading)
+
+    async def stop(self, timeout=5.0):
+        """Delivers the queued readings (up to the timeout per sink, concurrently), and stops the sinks."""
+        await asyncio.gather(*(sink.stop(timeout) for sink in self.sinks))
@@ -0,0 +1,214 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Plausibility filter and publish coalescing of the meter readings.
+#
+# A misread digit produces a spike in Home Assistant, and a burst of photos of the same meter produces as many
+# publishes (and entries of the HA recorder) for the same value. Before a reading is published and stored in
+# the readings time-series, the ReadingFilter checks it against the last accepted reading of its meter:
+#   - monotonic: a meter never goes backwards, lower readings are rejected
+#   - maximum rate: the increase may not exceed "max_rate_per_hour" times the hours elapsed, plus "tolerance"
+# A real meter reset / replacement would be rejected forever: after "accept_after" consecutive rejected
+# readings that agree with each other, the new value is accepted as the new baseline.
+#
+# The plausible readings of a meter arriving within "coalesce_seconds" of the first one are coalesced: only
+# the reading with the best confidence (that of its least certain digit, the latest one on ties) is published,
+# at the end of the window.
+#
+# Rejections are recorded in the metadata of the image ("plausibility") and counted by the
+# "meterreader_readings_total" metric. The last accepted reading is that of the readings store (MongoDB), so
+# all the worker processes check against the same baseline, or the last one accepted by this process if it is
+# more recent (the store is only updated once the reading is published). The readings of a meter are checked
+# one at a time; the coalescing window is per process.
+#
+# Configured in the "Plausibility" section of config.yaml, with per meter overrides ("Meters: meters: <id>:
+# plausibility").
+#
+import os
+import asyncio
+import logging
+
+from helpers import metrics
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+# Verdicts
+ACCEPTED = "accepted"
+REJECTED = "rejected"
+
+READINGS = metrics.counter("meterreader_readings_total", "Readings checked by the plausibility filter, by verdict",
+                           ["meter", "verdict"])
+PUBLISHED = metrics.counter("meterreader_readings_published_total",
+                            "Readings published (one per coalescing window)", ["meter"])
+
+DEFAULT_SETTINGS = {
+    "monotonic": True,
+    "max_rate_per_hour": 0,
+    "tolerance": 1,
+    "accept_after": 3,
+    "coalesce_seconds": 0,
+}
+
+
+class Reading:
+    """A reading of a meter, waiting to be published (see helpers/outputs.py)."""
+
+    def __init__(self, meter, value, confidence, timestamp, filename):
+        self.meter = meter
+        self.value = value
+        self.confidence = confidence
+        self.timestamp = timestamp
+        self.filename = filename
+
+    def to_dict(self):
+        return {
+            "meter": self.meter.id,
+            "device_id": self.meter.device_id,
+            "value": self.value,
+            "confidence": self.confidence,
+            "timestamp": self.timestamp.isoformat(),
+            "filename": self.filename,
+        }
+
+
+class ReadingFilter:
+    """
+    Checks the readings against the last accepted one of their meter, and coalesces the bursts.
+
+    Attributes:
+        enabled: False to publish every reading (no checks, no coalescing).
+        settings: Default settings (see DEFAULT_SETTINGS), overridden per meter by Meter.plausibility.
+        publish: Coroutine function (Reading) publishing and storing an accepted reading.
+        last_reading: Function (meter) returning (value, timestamp) of its last accepted reading. Blocking.
+    """
+
+    def __init__(self, publish, last_reading, enabled=True, **settings):
+        self.publish = publish
+        self.last_reading = last_reading
+        self.enabled = bool(enabled)
+        self.settings = {**DEFAULT_SETTINGS, **settings}
+        self._pending = {}     # meter id -> best Reading of the open coalescing window
+        self._windows = {}     # meter id -> task publishing the best reading at the end of the window
+        self._rejected = {}    # meter id -> (last rejected Reading, number of consecutive rejections)
+        self._accepted = {}    # meter id -> (value, timestamp) of the last reading accepted by this filter
+        self._locks = {}       # meter id -> asyncio.Lock, serializing the checks of the readings of a meter
+
+    @classmethod
+    def from_config(cls, config, publish, last_reading):
+        """Creates the filter from the "Plausibility" section of config.yaml."""
+        return cls(publish, last_reading, enabled=config.get("Plausibility", "enabled", True), **cls.config_settings(config))
+
+    @staticmethod
+    def config_settings(config):
+        """Settings of the "Plausibility" section of config.yaml."""
+        return {key: config.get("Plausibility", key, default) for key, default in DEFAULT_SETTINGS.items()}
+
+    def reconfigure(self, config):
+        """Applies the "Plausibility" section of a reloaded config.yaml (open coalescing windows are kept)."""
+        self.enabled = bool(config.get("Plausibility", "enabled", True))
+        self.settings = {**DEFAULT_SETTINGS, **self.config_settings(config)}
+
+    def settings_for(self, meter):
+        return {**self.settings, **meter.plausibility}
+
+    def check(self, value, timestamp, last_value, last_timestamp, settings):
+        """
+        Checks a value against a previous one.
+
+        Returns:
+            str or None: Why the value is not plausible, None if it is.
+        """
+        if last_value is None:
+            return None
+        if settings["monotonic"] and value < last_value:
+            return f"lower than the last accepted value {last_value}"
+        max_rate = float(settings["max_rate_per_hour"] or 0)
+        if max_rate > 0:
+            hours = max(0.0, (timestamp - last_timestamp).total_seconds() / 3600) if last_timestamp else 0.0
+            max_increase = max_rate * hours + float(settings["tolerance"] or 0)
+            if value - last_value > max_increase:
+                return f"increase of {value - last_value} from {last_value} above the maximum of {max_increase:.1f}"
+        return None
+
+    async def submit(self, meter, value, confidence, timestamp, filename):
+        """
+        Checks a reading, and publishes it (now or at the end of its coalescing window) if it is plausible.
+
+        Returns:
+            tuple: (verdict, reason) — ACCEPTED or REJECTED, and why it was rejected (None if accepted).
+        """
+        reading = Reading(meter, value, confidence, timestamp, filename)
+        if not self.enabled:
+            await self.publish(reading)
+            return ACCEPTED, None
+
+        settings = self.settings_for(meter)
+        lock = self._locks.setdefault(meter.id, asyncio.Lock())
+        async with lock:
+            last_value, last_timestamp = await asyncio.to_thread(self.last_reading, meter)
+            accepted = self._accepted.get(meter.id)
+            if accepted is not None and (last_timestamp is None or accepted[1] >= last_timestamp):
+                last_value, last_timestamp = accepted  # Not in the store yet (coalesced, or being published)
+            reason = self.check(value, timestamp, last_value, last_timestamp, settings)
+            if reason is not None and self._confirms_rejected(reading, settings):
+                logger.warning("Meter %s: accepting %s as the new baseline after %i consistent rejected readings",
+                               meter.id, value, int(settings["accept_after"]))
+                reason = None
+            if reason is not None:
+                logger.warning("Meter %s: reading %s of %s rejected: %s", meter.id, value, filename, reason)
+                READINGS.inc(meter=meter.id, verdict=REJECTED)
+                return REJECTED, reason
+
+            self._rejected.pop(meter.id, None)
+            self._accepted[meter.id] = (value, timestamp)
+            READINGS.inc(meter=meter.id, verdict=ACCEPTED)
+            window = float(settings["coalesce_seconds"] or 0)
+            if window <= 0:
+                await self._publish(reading)
+                return ACCEPTED, None
+
+            best = self._pending.get(meter.id)
+            if best is None or reading.confidence >= best.confidence:  # Ties: the latest
+                self._pending[meter.id] = reading
+            if meter.id not in self._windows:
+                self._windows[meter.id] = asyncio.create_task(self._publish_after(meter.id, window))
+            return ACCEPTED, None
+
+    def _confirms_rejected(self, reading, settings):
+        """Counts the consecutive rejected readings agreeing with each other; True once there are enough."""
+        accept_after = int(settings["accept_after"] or 0)
+        previous, count = self._rejected.get(reading.meter.id, (None, 0))
+        if previous is not None and self.check(reading.value, reading.timestamp, previous.value, previous.timestamp, settings) is None:
+            count += 1
+        else:
+            count = 1
+        self._rejected[reading.meter.id] = (reading, count)
+        if accept_after and count >= accept_after:
+            self._rejected.pop(reading.meter.id, None)
+            return True
+        return False
+
+    async def _publish_after(self, meter_id, window):
+        try:
+            await asyncio.sleep(window)
+        finally:
+            self._windows.pop(meter_id, None)
+            reading = self._pending.pop(meter_id, None)
+            if reading is not None:
+                await self._publish(reading)
+
+    async def _publish(self, reading):
+        try:
+            await self.publish(reading)
+            PUBLISHED.inc(meter=reading.meter.id)
+        except Exception as ex:
+            logger.error("Error publishing the reading %s of meter %s: %s", reading.value, reading.meter.id, ex)
+
+    async def close(self):
+        """Publishes the readings of the open coalescing windows now."""
+        tasks = list(self._windows.values())
+        for task in tasks:
+            task.cancel()  # Publishes right away
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,134 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Retention engine: periodically removes old image metadata and the GridFS files that belong to it.
+#
+# Three policies are enforced (each one is disabled when set to 0), configured in the "Retention"
+# section of config.yaml:
+#   - max_count:       keep at most this many metadata entries (the most recent ones)
+#   - max_age_days:    delete entries older than this number of days
+#   - max_storage_mb:  delete the oldest entries until GridFS uses at most this many MB
+#
+# The schedule is opt-in ("Retention: enabled: true"): by default the policies only run when POST /prune_db
+# is called. The engine runs as an asyncio task on the server's event loop; the (blocking) database work is
+# done in a worker thread, so uploads are not delayed while a prune is running.
+#
+import os
+import asyncio
+import logging
+from datetime import timedelta
+
+# Import your custom modules
+import helpers.config as config
+from helpers.monogodb_handler import MongoDBHandler
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+
+class RetentionEngine:
+    """
+    Enforces the retention policies defined in config.yaml on the MongoDB metadata collection and GridFS.
+
+    Attributes:
+        db_handler: MongoDBHandler used to delete entries and files.
+        max_count: Maximum number of metadata entries to keep (0 = unlimited).
+        max_age: Maximum age of the entries (timedelta), or None.
+        max_bytes: Maximum number of bytes stored in GridFS (0 = unlimited).
+        interval_seconds: Time between two scheduled runs (0 = no schedule, manual runs only).
+        last_report: Result of the last run.
+        listeners: Callables called (on the event loop) with the result of every scheduled run.
+    """
+
+    def __init__(self, config, db_handler):
+        """
+        Initializes the RetentionEngine.
+
+        Args:
+            config: Configuration object.
+            db_handler: MongoDBHandler instance.
+        """
+        self.db_handler = db_handler
+        self.enabled = bool(config.get("Retention", "enabled", False))  # Opt in: the schedule deletes data
+        self.interval_seconds = float(config.get("Retention", "interval_seconds", 3600))
+        self.max_count = int(config.get("Retention", "max_count", 16) or 0)
+        max_age_days = float(config.get("Retention", "max_age_days", 0) or 0)
+        self.max_age = timedelta(days=max_age_days) if max_age_days > 0 else None
+        self.max_bytes = int(float(config.get("Retention", "max_storage_mb", 0) or 0) * 1024 * 1024)
+
+        self.last_report = None
+        self.listeners = []
+        self._task = None
+
+    def run_once(self):
+        """
+        Applies all enabled policies once (blocking).
+
+        Returns:
+            dict: Number of deleted metadata entries and files, and the number of bytes reclaimed.
+        """
+        report = {"deleted_metadata_count": 0, "deleted_files_count": 0, "reclaimed_bytes": 0}
+
+        def add(result):
+            for key, value in result.items():
+                report[key] += value
+
+        if self.max_age:
+            add(self.db_handler.prune_entries_older_than(self.max_age))
+        if self.max_count:
+            add(self.db_handler.prune_old_entries(retain_count=self.max_count))
+        if self.max_bytes:
+            add(self.db_handler.prune_to_storage_quota(self.max_bytes))
+
+        logger.info("Retention run finished: %i entries, %i files, %i bytes reclaimed",
+                    report["deleted_metadata_count"], report["deleted_files_count"], report["reclaimed_bytes"])
+        self.last_report = report
+        return report
+
+    async def run_forever(self):
+        """Runs the retention policies every `interval_seconds` until cancelled."""
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                report = await asyncio.to_thread(self.run_once)
+            except Exception as ex:
+                logger.error("Error in scheduled retention run: %s", ex)
+                continue
+            for listener in self.listeners:
+                try:
+                    listener(report)
+                except Exception as ex:
+                    logger.error("Error in retention listener: %s", ex)
+
+    def start(self):
+        """Starts the scheduled runs on the current event loop (if enabled)."""
+        if not self.enabled or self.interval_seconds <= 0:
+            logger.info("Scheduled retention is disabled")
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self.run_forever())
+            logger.info("Scheduled retention started, running every %i seconds", self.interval_seconds)
+
+    async def stop(self):
+        """Stops the scheduled runs."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def main():
+    """
+        Runs the retention policies defined in config.yaml once, e.g. from a cron job.
+    """
+    config_instance = config.ConfigLoader("config.yaml")
+    db_handler = MongoDBHandler(config_instance)
+    engine = RetentionEngine(config_instance, db_handler)
+    print(engine.run_once())
+
+if __name__ == "__main__":
+    main()
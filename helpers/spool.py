@@ -0,0 +1,318 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Crash-safe on-disk spool for uploaded images.
+#
+# An upload is appended to the spool (image written and fsync'ed, then indexed in SQLite) before the
+# upload is acknowledged. Workers claim an entry with a lease before processing it, and remove it when done.
+# Entries that were not completed (server restart, MongoDB down, ...) are replayed, so no reading is lost.
+# Entries parked as FAILED are kept for inspection, and deleted after "Spool: failed_ttl_hours". Data files
+# without an entry (crash between writing the file and indexing it) are deleted on startup.
+#
+# Every entry records the pid of the process that appended (and queued) it, until it is released after a failure
+# or recovered on startup: with several worker processes, the others leave it alone as long as that process is
+# alive, instead of replaying it too.
+#
+# Layout of the spool directory ("Spool: directory" in config.yaml):
+#   spool.sqlite    index of the entries (WAL mode, synchronous=FULL)
+#   data/<uuid>     content of the uploaded images
+#
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+# Entry states
+PENDING = "pending"
+CLAIMED = "claimed"
+FAILED = "failed"
+
+# Data files younger than this may belong to an upload being appended (file written, entry not indexed yet)
+ORPHAN_GRACE_SECONDS = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS spool (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename    TEXT NOT NULL,
+    data_file   TEXT NOT NULL,
+    meta        TEXT,
+    state       TEXT NOT NULL DEFAULT 'pending',
+    lease_until REAL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    last_error  TEXT,
+    created_at  REAL NOT NULL,
+    owner       INTEGER
+);
+CREATE INDEX IF NOT EXISTS spool_state ON spool (state, id);
+"""
+
+
+class SpoolEntry:
+    """
+    An entry of the spool.
+
+    Attributes:
+        id: Id of the entry.
+        filename: Name of the uploaded file.
+        meta: Dictionary of metadata stored with the upload.
+        attempts: Number of times the entry was claimed.
+        owner: Pid of the process that appended the entry and queued it, or None (released or recovered).
+        created_at: time.time() of the upload.
+    """
+
+    def __init__(self, entry_id, filename, meta, attempts, owner=None, created_at=None):
+        self.id = entry_id
+        self.filename = filename
+        self.meta = json.loads(meta) if meta else {}
+        self.attempts = attempts
+        self.owner = owner
+        self.created_at = created_at
+
+    def owner_alive(self):
+        """True if the entry is owned by a process that is still running (and has it queued)."""
+        if self.owner is None:
+            return False
+        try:
+            os.kill(self.owner, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True  # Running, under another user
+        return True
+
+
+class UploadSpool:
+    """
+    Durable spool of uploaded images, indexed in SQLite.
+
+    All methods are blocking (they fsync), call them from a worker thread when on the event loop.
+
+    Attributes:
+        directory: Spool directory.
+        lease_seconds: How long a claimed entry is reserved for the worker that claimed it.
+        max_attempts: Number of failed attempts after which an entry is parked as FAILED.
+        max_entries: Maximum number of entries (pending or claimed) the spool accepts.
+        failed_ttl_seconds: How long FAILED entries are kept, from their upload (None: forever).
+    """
+
+    def __init__(self, directory, lease_seconds=300, max_attempts=5, max_entries=1000, failed_ttl_seconds=None):
+        self.directory = os.path.abspath(directory)
+        self.data_dir = os.path.join(self.directory, "data")
+        os.makedirs(self.data_dir, exist_ok=True)
+
+        self.lease_seconds = float(lease_seconds)
+        self.max_attempts = int(max_attempts)
+        self.max_entries = int(max_entries)
+        self.failed_ttl_seconds = float(failed_ttl_seconds) if failed_ttl_seconds else None
+
+        self._lock = threading.Lock()
+        self._connect()
+        # SQLite connections must not be shared with a forked process (multi-process serving): reconnect
+        os.register_at_fork(after_in_child=self._connect)
+
+    def _connect(self):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.directory, "spool.sqlite"), check_same_thread=False,
+                                   isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.executescript(SCHEMA)
+        if "owner" not in {row[1] for row in self._db.execute("PRAGMA table_info(spool)")}:
+            self._db.execute("ALTER TABLE spool ADD COLUMN owner INTEGER")  # Spool created by an older version
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates the spool from the "Spool" section of config.yaml, or returns None if it is disabled."""
+        if not config.get("Spool", "enabled", True):
+            return None
+        return cls(
+            config.get("Spool", "directory", "./data/spool"),
+            lease_seconds=config.get("Spool", "lease_seconds", 300),
+            max_attempts=config.get("Spool", "max_attempts", 5),
+            max_entries=config.get("Spool", "max_entries", 1000),
+            failed_ttl_seconds=float(config.get("Spool", "failed_ttl_hours", 168) or 0) * 3600,
+        )
+
+    def append(self, filename, data, meta=None):
+        """
+        Durably stores an upload. Once this returns, the upload survives a crash.
+        The entry is owned by the calling process (which is expected to queue it) until it is released.
+
+        Args:
+            filename (str): Name of the uploaded file.
+            data (bytes): Content of the file.
+            meta (dict, optional): JSON-serializable metadata stored with the upload.
+
+        Returns:
+            int: Id of the new entry.
+        """
+        data_file = uuid.uuid4().hex
+        data_path = os.path.join(self.data_dir, data_file)
+        with open(data_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        fd = os.open(self.data_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO spool (filename, data_file, meta, created_at, owner) VALUES (?, ?, ?, ?, ?)",
+                (filename, data_file, json.dumps(meta) if meta else None, time.time(), os.getpid()),
+            )
+            return cursor.lastrowid
+
+    def count(self):
+        """Number of entries waiting or being processed (FAILED entries not included)."""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM spool WHERE state != ?", (FAILED,)).fetchone()[0]
+
+    def is_full(self):
+        """True if the spool does not accept new entries."""
+        return self.count() >= self.max_entries
+
+    def claim(self, entry_id):
+        """
+        Reserves an entry for processing, for `lease_seconds`.
+
+        Returns:
+            bool: True if the entry was claimed, False if it is unknown, done, or leased to another worker.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE spool SET state = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE id = ? AND (state = ? OR (state = ? AND lease_until < ?))",
+                (CLAIMED, now + self.lease_seconds, entry_id, PENDING, CLAIMED, now),
+            )
+            return cursor.rowcount == 1
+
+    def read(self, entry_id):
+        """Returns the content of the uploaded file of an entry."""
+        with self._lock:
+            row = self._db.execute("SELECT data_file FROM spool WHERE id = ?", (entry_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"Spool entry {entry_id} not found")
+        with open(os.path.join(self.data_dir, row[0]), "rb") as file:
+            return file.read()
+
+    def complete(self, entry_id):
+        """Removes a processed entry (and its data) from the spool."""
+        with self._lock:
+            row = self._db.execute("SELECT data_file FROM spool WHERE id = ?", (entry_id,)).fetchone()
+            self._db.execute("DELETE FROM spool WHERE id = ?", (entry_id,))
+        if row:
+            try:
+                os.unlink(os.path.join(self.data_dir, row[0]))
+            except FileNotFoundError:
+                pass
+
+    def release(self, entry_id, error=None, retry=True):
+        """
+        Gives a claimed entry back after a failure. It is retried later (by any process: it has no owner
+        anymore), unless `retry` is False or it failed `max_attempts` times, in which case it is parked as FAILED.
+        """
+        with self._lock:
+            self._db.execute(
+                "UPDATE spool SET state = CASE WHEN ? AND attempts < ? THEN ? ELSE ? END, "
+                "lease_until = NULL, owner = NULL, last_error = ? WHERE id = ?",
+                (1 if retry else 0, self.max_attempts, PENDING, FAILED, error, entry_id),
+            )
+
+    def pending(self, include_claimed=False, limit=None):
+        """
+        Returns the entries waiting to be processed, oldest first.
+
+        Args:
+            include_claimed (bool): Also return claimed entries, whatever their lease
+                                    (on startup: the leases were held by the previous process).
+            limit (int, optional): Maximum number of entries.
+
+        Returns:
+            list of SpoolEntry.
+        """
+        query = "SELECT id, filename, meta, attempts, owner, created_at FROM spool WHERE state = ? OR (state = ? AND (? OR lease_until < ?)) ORDER BY id"
+        params = [PENDING, CLAIMED, 1 if include_claimed else 0, time.time()]
+        if limit:
+            query += " LIMIT ?"
+            params.append(int(limit))
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        return [SpoolEntry(*row) for row in rows]
+
+    def purge_failed(self):
+        """
+        Deletes the FAILED entries (and their data) uploaded more than `failed_ttl_seconds` ago.
+
+        Returns:
+            int: Number of entries deleted.
+        """
+        if self.failed_ttl_seconds is None:
+            return 0
+        with self._lock:
+            rows = self._db.execute("SELECT id, data_file FROM spool WHERE state = ? AND created_at < ?",
+                                    (FAILED, time.time() - self.failed_ttl_seconds)).fetchall()
+            self._db.executemany("DELETE FROM spool WHERE id = ?", [(row[0],) for row in rows])
+        for _, data_file in rows:
+            try:
+                os.unlink(os.path.join(self.data_dir, data_file))
+            except FileNotFoundError:
+                pass
+        if rows:
+            logger.info("Deleted %i failed upload(s) from the spool", len(rows))
+        return len(rows)
+
+    def sweep_orphans(self):
+        """
+        Deletes the data files that have no entry (written by an append interrupted before the entry was indexed).
+
+        Returns:
+            int: Number of files deleted.
+        """
+        cutoff = time.time() - ORPHAN_GRACE_SECONDS
+        candidates = []
+        with os.scandir(self.data_dir) as files:
+            for file in files:
+                if file.is_file() and file.stat().st_mtime < cutoff:
+                    candidates.append(file.name)
+        with self._lock:
+            indexed = {row[0] for row in self._db.execute("SELECT data_file FROM spool")}
+        orphans = [name for name in candidates if name not in indexed]
+        for name in orphans:
+            try:
+                os.unlink(os.path.join(self.data_dir, name))
+            except FileNotFoundError:
+                pass
+        if orphans:
+            logger.info("Deleted %i data file(s) without a spool entry", len(orphans))
+        return len(orphans)
+
+    def recover(self):
+        """
+        Called on startup: makes all unfinished entries PENDING again and returns them, oldest first.
+        Also deletes the expired FAILED entries and the data files without an entry.
+        """
+        with self._lock:
+            self._db.execute("UPDATE spool SET state = ?, lease_until = NULL WHERE state = ?", (PENDING, CLAIMED))
+            self._db.execute("UPDATE spool SET owner = NULL WHERE owner IS NOT NULL")  # Their processes are gone
+        self.purge_failed()
+        self.sweep_orphans()
+        entries = self.pending()
+        if entries:
+            logger.info("Recovered %i unfinished upload(s) from the spool", len(entries))
+        return entries
+
+    def close(self):
+        """Closes the SQLite index."""
+        with self._lock:
+            self._db.close()
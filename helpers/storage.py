@@ -0,0 +1,332 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Image storage backends.
+#
+# The application stores the uploaded and annotated images through an ImageStore. Two implementations exist,
+# selected with "Storage: backend" in config.yaml:
+#   - GridFSStore:     images are stored in MongoDB GridFS (default)
+#   - LocalFileStore:  images are stored in a content-addressed directory tree on the local filesystem.
+#                      Avoids a MongoDB round trip per image on single-node installs, and allows the
+#                      files to be served straight from disk.
+#
+# Layout of the LocalFileStore (root directory from "Storage: root"):
+#   objects/ab/cd/abcd...   file content, named by its SHA-256 (identical images are stored once)
+#   names/xy/<filename>     hard link to the object, looked up by filename (xy = first byte of the name's SHA-1)
+#   tmp/                    temporary files, atomically renamed into place
+#
+import os
+import abc
+import uuid
+import hashlib
+import logging
+import mimetypes
+import tempfile
+from datetime import datetime, timezone
+
+import gridfs
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+# Attempts of LocalFileStore.put() to link an object removed concurrently (written again each time)
+PUT_ATTEMPTS = 3
+
+
+class ImageStore(abc.ABC):
+    """
+    Interface of the image storage backends.
+
+    Files returned by `open` are file-like objects (read, seek, close) that also expose
+    `length`, `chunk_size`, `upload_date`, `content_type` and `_id`. Backends storing files on
+    the local disk also expose `path`, so the file can be served without copying it through Python.
+    """
+
+    @abc.abstractmethod
+    def put(self, filename, data, content_type=None):
+        """Stores `data` (bytes) under `filename`. Returns the id of the stored file."""
+
+    @abc.abstractmethod
+    def open(self, filename):
+        """Opens a stored file for reading. Raises FileNotFoundError if it does not exist."""
+
+    def read(self, filename):
+        """Returns (data, content_type) of a stored file. Raises FileNotFoundError if it does not exist."""
+        file_obj = self.open(filename)
+        try:
+            return file_obj.read(), file_obj.content_type or "image/jpeg"
+        finally:
+            file_obj.close()
+
+    @abc.abstractmethod
+    def delete(self, filenames):
+        """Deletes files in bulk. Returns a dictionary with `deleted_files_count` and `reclaimed_bytes`."""
+
+    @abc.abstractmethod
+    def sizes(self, filenames):
+        """Returns a dictionary filename -> size in bytes, for the files that exist."""
+
+    @abc.abstractmethod
+    def total_bytes(self):
+        """Returns the total number of bytes stored."""
+
+
+class GridFSStore(ImageStore):
+    """
+    Stores images in MongoDB GridFS.
+    """
+
+    def __init__(self, db):
+        """
+        Args:
+            db: pymongo Database holding the "fs.files" and "fs.chunks" collections.
+        """
+        self.fs = gridfs.GridFS(db)
+        self.files_collection = db["fs.files"]
+        self.chunks_collection = db["fs.chunks"]
+
+    def put(self, filename, data, content_type=None):
+        return self.fs.put(data, filename=filename, contentType=content_type or mimetypes.guess_type(filename)[0])
+
+    def open(self, filename):
+        file_obj = self.fs.find_one({"filename": filename})
+        if file_obj is None:
+            raise FileNotFoundError(f"File '{filename}' not found in GridFS.")
+        return file_obj
+
+    def delete(self, filenames):
+        filenames = list(filter(None, set(filenames)))
+        if not filenames:
+            return {"deleted_files_count": 0, "reclaimed_bytes": 0}
+
+        files = list(self.files_collection.find({"filename": {"$in": filenames}}, {"_id": 1, "length": 1}))
+        file_ids = [file["_id"] for file in files]
+        if not file_ids:
+            return {"deleted_files_count": 0, "reclaimed_bytes": 0}
+
+        # Same order as GridFS.delete: first the file documents, then their chunks
+        delete_result = self.files_collection.delete_many({"_id": {"$in": file_ids}})
+        self.chunks_collection.delete_many({"files_id": {"$in": file_ids}})
+
+        reclaimed_bytes = sum(file.get("length", 0) for file in files)
+        return {"deleted_files_count": delete_result.deleted_count, "reclaimed_bytes": reclaimed_bytes}
+
+    def sizes(self, filenames):
+        sizes = {}
+        for file in self.files_collection.find({"filename": {"$in": list(filenames)}}, {"filename": 1, "length": 1}):
+            sizes[file["filename"]] = sizes.get(file["filename"], 0) + file.get("length", 0)
+        return sizes
+
+    def total_bytes(self):
+        result = list(self.files_collection.aggregate([{"$group": {"_id": None, "total": {"$sum": "$length"}}}]))
+        return result[0]["total"] if result else 0
+
+
+class LocalStoredFile:
+    """
+    A file opened from the LocalFileStore, with the same attributes as a GridFS GridOut.
+    """
+
+    def __init__(self, filename, path, chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._file = open(path, "rb")
+        stat = os.fstat(self._file.fileno())
+        self.length = stat.st_size
+        self.upload_date = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+        self.content_type = mimetypes.guess_type(filename)[0]
+        self._id = f"{stat.st_ino:x}-{stat.st_size:x}-{int(stat.st_mtime):x}"
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def close(self):
+        self._file.close()
+
+
+class LocalFileStore(ImageStore):
+    """
+    Stores images in a content-addressed directory tree on the local filesystem.
+
+    Writes are atomic: the content is written to a temporary file, flushed to disk and renamed into place,
+    so a crash never leaves a truncated image behind. Filenames are hard links to the content objects;
+    the root directory must be on a filesystem supporting hard links.
+    """
+
+    def __init__(self, root, chunk_size=256 * 1024):
+        """
+        Args:
+            root (str): Root directory of the store (created if needed).
+            chunk_size (int): Size of the chunks used when streaming files.
+        """
+        self.root = os.path.abspath(root)
+        self.chunk_size = chunk_size
+        self.objects_dir = os.path.join(self.root, "objects")
+        self.names_dir = os.path.join(self.root, "names")
+        self.tmp_dir = os.path.join(self.root, "tmp")
+        for directory in (self.objects_dir, self.names_dir, self.tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:4], digest)
+
+    def _name_path(self, filename):
+        if not filename or os.path.basename(filename) != filename or filename in (".", ".."):
+            raise ValueError(f"Invalid filename '{filename}'")
+        shard = hashlib.sha1(filename.encode("utf-8")).hexdigest()[:2]
+        return os.path.join(self.names_dir, shard, filename)
+
+    @staticmethod
+    def _fsync_dir(directory):
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def put(self, filename, data, content_type=None):
+        name_path = self._name_path(filename)
+        digest = hashlib.sha256(data).hexdigest()
+        object_path = self._object_path(digest)
+
+        # Link the object to a temporary name first. The object may be removed between the check and the link,
+        # by a concurrent delete / overwrite of the last name sharing it: it is then written again
+        tmp_link = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        for attempt in range(PUT_ATTEMPTS):
+            if not os.path.exists(object_path):
+                self._write_object(object_path, data)
+            try:
+                os.link(object_path, tmp_link)
+                break
+            except FileNotFoundError:
+                if attempt == PUT_ATTEMPTS - 1:
+                    raise
+                logger.debug("Object %s removed while storing %s, writing it again", digest, filename)
+
+        try:
+            # Object previously referenced by this name, which may become unreferenced (a name already linked to
+            # this object shares it with the temporary link: it is not read back)
+            previous_object_path = self._unreferenced_object_path(name_path)
+
+            # Atomically (re)point the name at the object
+            os.makedirs(os.path.dirname(name_path), exist_ok=True)
+            os.replace(tmp_link, name_path)
+        except BaseException:
+            os.unlink(tmp_link)
+            raise
+        self._fsync_dir(os.path.dirname(name_path))
+
+        if previous_object_path and previous_object_path != object_path:
+            self._remove_if_unreferenced(previous_object_path)
+        return digest
+
+    def _write_object(self, object_path, data):
+        """Writes the content of an object atomically (temporary file, fsync, rename)."""
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, object_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._fsync_dir(os.path.dirname(object_path))
+
+    def _unreferenced_object_path(self, name_path):
+        """
+        Returns the path of the object a name links to, if that name is its only reference, else None.
+        The name does not record its object: it is found by hashing the file, only when the name is its last link.
+        """
+        try:
+            if os.stat(name_path).st_nlink > 2:
+                return None  # Other names share the object, it stays referenced
+            with open(name_path, "rb") as file:
+                return self._object_path(hashlib.file_digest(file, "sha256").hexdigest())
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _remove_if_unreferenced(object_path):
+        """
+        Removes an object no name links to anymore. Returns the number of bytes reclaimed.
+        """
+        try:
+            stat = os.stat(object_path)
+            if stat.st_nlink == 1:
+                os.unlink(object_path)
+                return stat.st_size
+        except FileNotFoundError:
+            pass
+        return 0
+
+    def open(self, filename):
+        try:
+            return LocalStoredFile(filename, self._name_path(filename), self.chunk_size)
+        except (FileNotFoundError, ValueError):
+            raise FileNotFoundError(f"File '{filename}' not found in {self.root}.")
+
+    def delete(self, filenames):
+        deleted_files_count = 0
+        reclaimed_bytes = 0
+        for filename in filter(None, set(filenames)):
+            try:
+                name_path = self._name_path(filename)
+                os.stat(name_path)
+            except (FileNotFoundError, ValueError):
+                continue
+
+            object_path = self._unreferenced_object_path(name_path)
+            os.unlink(name_path)
+            deleted_files_count += 1
+            if object_path:
+                reclaimed_bytes += self._remove_if_unreferenced(object_path)
+        return {"deleted_files_count": deleted_files_count, "reclaimed_bytes": reclaimed_bytes}
+
+    def sizes(self, filenames):
+        sizes = {}
+        for filename in filenames:
+            try:
+                sizes[filename] = os.stat(self._name_path(filename)).st_size
+            except (FileNotFoundError, ValueError):
+                pass
+        return sizes
+
+    def total_bytes(self):
+        total = 0
+        for directory, _, files in os.walk(self.objects_dir):
+            for file in files:
+                total += os.stat(os.path.join(directory, file)).st_size
+        return total
+
+    def relative_path(self, path):
+        """Returns the path of a stored file relative to the root (used for X-Accel-Redirect / X-Sendfile)."""
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+
+def create_store(config, db):
+    """
+    Create the image store selected in config.yaml ("Storage: backend").
+
+    Args:
+        config: Configuration object.
+        db: pymongo Database, used by the GridFS backend.
+
+    Returns:
+        ImageStore: The store instance.
+    """
+    backend = (config.get("Storage", "backend", "gridfs") or "gridfs").lower()
+    if backend == "gridfs":
+        return GridFSStore(db)
+    if backend == "filesystem":
+        root = config.get("Storage", "root", "./data/store")
+        logger.info("Storing images on the local filesystem in %s", root)
+        return LocalFileStore(root)
+    raise ValueError(f"Unknown storage backend '{backend}', expected 'gridfs' or 'filesystem'")
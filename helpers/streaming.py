@@ -0,0 +1,146 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Helpers used to stream stored files (e.g. GridFS images) to HTTP clients chunk by chunk.
+#
+# The functions in this module:
+#   - parse an HTTP "Range" header (single byte range, RFC 9110) against the size of a file
+#   - read a file-like object incrementally, so only one chunk is held in memory at any time
+#   - build the streaming response of a file: 200 (whole file), 206 (requested range) or 416
+#
+import os
+import asyncio
+import logging
+
+from quart import Response
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+DEFAULT_CHUNK_SIZE = 255 * 1024  # Same as the default GridFS chunk size
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised when a Range header cannot be satisfied for the requested file."""
+
+
+def parse_range_header(range_header, file_size):
+    """
+    Parse an HTTP Range header for a single byte range.
+
+    Args:
+        range_header (str): Value of the "Range" header, e.g. "bytes=0-1023", "bytes=1024-" or "bytes=-500".
+        file_size (int): Total size of the file in bytes.
+
+    Returns:
+        tuple or None: (start, end) inclusive byte positions, or None if the header is absent,
+                       malformed (e.g. last byte before the first one) or requests multiple ranges
+                       (the full file is sent in that case).
+
+    Raises:
+        RangeNotSatisfiable: If the range lies outside of the file.
+    """
+    if not range_header:
+        return None
+
+    unit, _, range_spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in range_spec:
+        return None  # Unknown unit or multipart ranges: ignore the header and send everything
+
+    start_str, sep, end_str = range_spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if start_str == "":
+            # Suffix range: the last N bytes of the file
+            suffix_length = int(end_str)
+            if suffix_length <= 0:
+                raise RangeNotSatisfiable(range_header)
+            start = max(file_size - suffix_length, 0)
+            end = file_size - 1
+        else:
+            start = int(start_str)
+            end = int(end_str) if end_str else None
+            if end is not None and end < start:
+                return None  # Invalid range (RFC 9110): ignore the header and send everything
+            end = file_size - 1 if end is None else min(end, file_size - 1)
+    except ValueError:
+        return None
+
+    if start < 0 or start >= file_size:
+        raise RangeNotSatisfiable(range_header)
+
+    return start, end
+
+
+async def iter_file_chunks(file_obj, start=0, length=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Asynchronously read a (blocking) file-like object chunk by chunk.
+
+    The blocking reads are run in a worker thread, so the event loop is not stalled while
+    a chunk is fetched from the database or the disk. The file object is closed when done.
+
+    Args:
+        file_obj: File-like object supporting seek() and read(), e.g. a GridOut.
+        start (int): Byte offset to start reading from.
+        length (int, optional): Number of bytes to read. Defaults to the rest of the file.
+        chunk_size (int): Maximum size of each chunk yielded.
+
+    Yields:
+        bytes: The next chunk of data.
+    """
+    try:
+        if start:
+            await asyncio.to_thread(file_obj.seek, start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            read_size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = await asyncio.to_thread(file_obj.read, read_size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+    finally:
+        try:
+            file_obj.close()
+        except Exception as ex:
+            logger.debug("Error closing streamed file: %s", ex)
+
+
+def file_response(file_obj, file_size, range_header, content_type, headers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Build the response streaming a file chunk by chunk: the whole file (200), the range requested by the
+    "Range" header (206 Partial Content), or 416 Range Not Satisfiable (the file is closed then).
+
+    Args:
+        file_obj: File-like object supporting seek(), read() and close(), e.g. a GridOut.
+        file_size (int): Size of the file in bytes.
+        range_header (str): Value of the "Range" header of the request, or None.
+        content_type (str): MIME type of the file.
+        headers (dict, optional): Other headers of the response (ETag, Last-Modified, ...).
+        chunk_size (int): Maximum size of each chunk sent.
+
+    Returns:
+        Response: The streaming response.
+    """
+    headers = {"Accept-Ranges": "bytes", **(headers or {})}
+    try:
+        byte_range = parse_range_header(range_header, file_size)
+    except RangeNotSatisfiable:
+        file_obj.close()
+        headers["Content-Range"] = f"bytes */{file_size}"
+        return Response(status=416, headers=headers)
+
+    if byte_range is None:
+        start, end, status = 0, file_size - 1, 200
+    else:
+        start, end = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+    length = end - start + 1
+    headers["Content-Length"] = str(max(length, 0))
+
+    body = iter_file_chunks(file_obj, start=start, length=length, chunk_size=chunk_size)
+    return Response(body, status=status, headers=headers, mimetype=content_type)
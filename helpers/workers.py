@@ -0,0 +1,229 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Multi-process serving.
+#
+# Runs the Quart application in several worker processes (hypercorn workers), to use all CPU cores for inference:
+#   - The YOLO models are loaded once in the supervisor process, before the workers are forked, so all workers
+#     share the same (copy-on-write) memory pages instead of loading their own copy of the weights.
+#   - A single MQTT publisher process holds the connection to the broker. The workers send it the values to
+#     publish over a multiprocessing queue (MQTTPublisherProxy), so the workers never fight over the MQTT client id.
+#   - Each worker gets its share of the CPU threads and optional resource limits ("Server" section of config.yaml).
+#   - The worker and publisher processes send their log records to the supervisor, which alone writes (and rotates)
+#     the log files.
+#
+# Usage (also the command of the Docker image):
+#    >python -m helpers.workers
+#
+# With "Server: workers: 1" the application is served in-process, like "hypercorn server:app".
+#
+import os
+import gc
+import signal
+import asyncio
+import logging
+import resource
+import multiprocessing
+from multiprocessing.connection import wait
+
+# Import your custom modules
+import helpers.config as config
+from helpers import custom_logger
+from helpers import metrics
+
+# Make sure to use the same logger as the rest of the application
+logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(logger_name)
+
+# State of the current process, set by the supervisor before the workers are forked
+worker_count = 1         # Number of worker processes
+worker_index = None      # Index of this worker process (None when not running under the supervisor)
+publisher_queue = None   # Queue to the MQTT publisher process (None when the workers publish themselves)
+
+
+def is_primary_worker():
+    """True in the worker running the singleton background tasks (retention), or when running a single process."""
+    return worker_index in (None, 0)
+
+
+class MQTTPublisherProxy:
+    """
+    Stand-in for HomeAssistant_MQTT_Client in the worker processes: the calls are forwarded to the
+    MQTT publisher process, which owns the (single) connection to the broker.
+
+    Only publishing is forwarded (send_value, publish, send_discovery). There is no `subscribe`: the
+    received messages would have to be sent back to the workers. The features subscribing to topics
+    check for it and are disabled with several workers (see MQTTImageIngest.from_config).
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def _forward(self, method, *args, **kwargs):
+        self.queue.put_nowait((method, args, kwargs))
+
+    def send_value(self, state_topic, value, retain_flag=False):
+        """Queues a value to be published to Home Assistant (never blocks)."""
+        self._forward("send_value", state_topic, value, retain_flag=retain_flag)
+
+    def publish(self, topic, payload, qos=None, retain=False):
+        """Queues a message to be published (never blocks). Returns None: the message is queued in the publisher process."""
+        self._forward("publish", topic, payload, qos=qos, retain=retain)
+
+    def send_discovery(self):
+        """Queues the discovery messages of the configured devices (never blocks)."""
+        self._forward("send_discovery")
+
+    def disconnect_mqtt(self):
+        """The connection belongs to the publisher process, which disconnects on shutdown."""
+
+
+def run_mqtt_publisher(queue):
+    """
+    Main function of the MQTT publisher process: connect to the broker and publish what the workers send.
+    Its log records are written by the supervisor (logging set up before the process is forked).
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Stopped by the supervisor, through the queue
+    from helpers.mqtt_client import HomeAssistant_MQTT_Client
+
+    config_instance = config.ConfigLoader("config.yaml")
+    client = HomeAssistant_MQTT_Client(config_instance)
+    logger.info("MQTT publisher process started (pid %i)", os.getpid())
+    while True:
+        message = queue.get()
+        if message is None:
+            break
+        method, args, kwargs = message
+        try:
+            getattr(client, method)(*args, **kwargs)
+        except Exception as ex:
+            logger.error("MQTT publisher: error in %s%s: %s", method, args, ex)
+    client.disconnect_mqtt()
+
+
+def apply_resource_limits(config_instance):
+    """
+    Applies the per-worker limits of the "Server" section of config.yaml to the current process.
+
+    worker_threads: CPU threads used by torch / OpenCV (default: the CPU cores divided between the workers)
+    worker_memory_mb: Limit of the address space of the worker (0 = no limit)
+    worker_nice: Scheduling priority increment (0 = unchanged)
+    """
+    threads = int(config_instance.get("Server", "worker_threads", 0) or 0)
+    threads = threads or max(1, (os.cpu_count() or 1) // worker_count)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    try:
+        import cv2
+        cv2.setNumThreads(threads)
+    except ImportError:
+        pass
+
+    memory_mb = int(config_instance.get("Server", "worker_memory_mb", 0) or 0)
+    if memory_mb > 0:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    nice = int(config_instance.get("Server", "worker_nice", 0) or 0)
+    if nice:
+        os.nice(nice)
+    logger.debug("Worker %s: %i thread(s), memory limit %s MB, nice %i", worker_index, threads, memory_mb or "no", nice)
+
+
+def _run_worker(index, hypercorn_config, sockets, shutdown_event):
+    """Main function of a forked worker process."""
+    global worker_index
+    worker_index = index
+    metrics.REGISTRY.const_labels = (("worker", str(index)),)  # Each worker exports its own metrics
+    from hypercorn.asyncio.run import asyncio_worker
+
+    # The supervisor controls the shutdown (through shutdown_event)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    apply_resource_limits(config.ConfigLoader("config.yaml"))
+    logger.info("Worker %i started (pid %i)", index, os.getpid())
+    asyncio_worker(hypercorn_config, sockets, shutdown_event)
+
+
+def main():
+    """
+    Serves the application with the number of worker processes set in config.yaml ("Server: workers").
+    """
+    global worker_count, publisher_queue
+    from hypercorn.config import Config as HypercornConfig
+
+    config_instance = config.ConfigLoader("config.yaml")
+    worker_count = int(config_instance.get("Server", "workers", 1) or 0) or (os.cpu_count() or 1)
+
+    hypercorn_config = HypercornConfig()
+    hypercorn_config.bind = [config_instance.get("Server", "bind", "0.0.0.0:8099")]
+    hypercorn_config.application_path = "server:app"
+    hypercorn_config.workers = worker_count
+
+    if worker_count == 1:
+        import server
+        from hypercorn.asyncio import serve
+        asyncio.run(serve(server.app, hypercorn_config))
+        return
+
+    ctx = multiprocessing.get_context("fork")
+
+    # 0) Write the log records of all the processes from the supervisor, a single writer per log file
+    custom_logger.setup_logging(logger_name=logger_name, config=config_instance)
+    custom_logger.share_with_children(ctx)
+
+    # 1) Start the MQTT publisher first, so it does not inherit the models
+    publisher_queue = ctx.Queue()
+    publisher = ctx.Process(target=run_mqtt_publisher, args=(publisher_queue,), name="mqtt-publisher")
+    publisher.start()
+
+    # 2) Load the application (and the models) once, then keep the garbage collector from touching the
+    #    shared objects, which would copy their memory pages into every worker
+    import server
+    server.prepare_workers()
+    gc.freeze()
+
+    # 3) Fork the workers, sharing the listening sockets, and restart the ones that die
+    sockets = hypercorn_config.create_sockets()
+    shutdown_event = ctx.Event()
+    processes = {}
+
+    def start_worker(index):
+        process = ctx.Process(target=_run_worker, args=(index, hypercorn_config, sockets, shutdown_event),
+                              name=f"worker-{index}")
+        process.start()
+        processes[index] = process
+
+    def shutdown(*args):
+        shutdown_event.set()
+
+    for index in range(worker_count):
+        start_worker(index)
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    logger.info("Serving on %s with %i workers", hypercorn_config.bind, worker_count)
+
+    while not shutdown_event.is_set():
+        wait([process.sentinel for process in processes.values()], timeout=1)
+        for index, process in list(processes.items()):
+            if not process.is_alive() and not shutdown_event.is_set():
+                logger.error("Worker %i exited with code %s, restarting it", index, process.exitcode)
+                start_worker(index)
+
+    for process in processes.values():
+        process.join()
+    publisher_queue.put(None)
+    publisher.join(timeout=10)
+    for sock in [*sockets.secure_sockets, *sockets.insecure_sockets]:
+        sock.close()
+    logger.info("All workers stopped")
+
+
+if __name__ == "__main__":
+    # Run main() from the imported module, so server.py sees the state set for the workers
+    from helpers import workers
+    workers.main()
@@ -40,24 +40,36 @@ def load_image(filepath):
     Returns:
         image: Loaded image object or None if loading fails.
     """
-    if not os.path.exists(filepath):
-        logger.error(f"File {filepath} does not exist.")
-        return None
-    elif not os.path.isfile(filepath):
-        logger.error(f"Path: {filepath} is not a file.")
-        return None
-    elif not os.access(filepath, os.R_OK):
-        logger.error(f"File {filepath} is not readable.")
-        return None
-
+    # cv2.imread returns None for missing, unreadable or invalid files, no need to check the path first
     try:
         img = cv2.imread(filepath)
+        if img is None:
+            logger.error(f"File {filepath} does not exist, is not readable or is not an image.")
         return img
     except Exception as e:
         logger.error(f"Error: An exception occurred while loading the image. {e}")
         return None
 
 
+def decode_image(buffer):
+    """Decodes an image held in memory (e.g. the body of an upload request).
+
+    Args:
+        buffer (bytes): Encoded image (JPEG, PNG, ...).
+
+    Returns:
+        image: Decoded image object or None if decoding fails.
+    """
+    try:
+        img = cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            logger.error("Error: The buffer could not be decoded as an image.")
+        return img
+    except Exception as e:
+        logger.error(f"Error: An exception occurred while decoding the image. {e}")
+        return None
+
+
 def save_image(image, path):
     """Saves an image to a specified file path, with checks for writeability.
 
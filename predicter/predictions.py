@@ -8,9 +8,20 @@ It uses the YOLO models to detect the frame, counter, and digits on the meter im
 The class is initialized with the configuration parameters and the project path.
 The predict_image method is used to call all three detections in one go and returns the detected value (integer) or None if nothing is detected.
 
+Several meters (helpers/meters.py) each get their own MeterReader, with their own weights, confidence thresholds
+and frame ROI, sharing the loaded models: readers created with the same `models` dictionary load each weights
+file only once.
+
+The readers are called from several inference threads ("Jobs: workers" > 1). The Ultralytics predictors are not
+thread-safe: the predictions of a model are serialized by its lock (model_lock()), shared by all the readers
+using it, and the frame ROI of a reader is kept behind a lock of its own.
+
 """
 import os
 import logging
+import threading
+import weakref
+import numpy as np
 from dotenv import load_dotenv
 
 from ultralytics import YOLO
@@ -26,18 +37,39 @@ from helpers import config as config
 logger_name = os.environ.get("LOGGER_NAME") or os.path.splitext(os.path.basename(__file__))[0]
 logger = logging.getLogger(logger_name)
 
+_model_locks = weakref.WeakKeyDictionary()  # Loaded model -> threading.Lock serializing its predictions
+_model_locks_guard = threading.Lock()
+
+
+def model_lock(model):
+    """Returns the lock serializing the predictions of a (shared) model."""
+    with _model_locks_guard:
+        lock = _model_locks.get(model)
+        if lock is None:
+            lock = _model_locks[model] = threading.Lock()
+        return lock
+
+
 class MeterReader:
     """
     MeterReader is a class that uses pre-trained YOLO models to detect the frame,
     counter, and digits on an electricity meter.
     """
 
-    def __init__(self, config, project_path=""):
+    # Default confidence thresholds of the detections
+    DEFAULT_CONFIDENCE = {"frame": 0.4, "counter": 0.4, "digits": 0.6}
+
+    def __init__(self, config, project_path="", weights=None, confidence=None, roi_margin=0.0, models=None):
         """
         Initializes the MeterReader class, loads YOLO models, and determines the device.
         
         Args:
             project_path (str): The base path for project and model weights.
+            weights (dict, optional): Weights files overriding those of "YOLO: weights" ("frame", "counter", "digits").
+            confidence (dict, optional): Confidence thresholds overriding DEFAULT_CONFIDENCE.
+            roi_margin (float): When > 0, the frame is first searched around the last frame found (a fixed camera),
+                                expanded by this fraction of its size; 0 to always search the whole image.
+            models (dict, optional): Models already loaded, by weights path, shared with other readers (updated).
         """
 
         self.config = config
@@ -51,61 +83,145 @@ class MeterReader:
             self.weights_path = project_path
         else:
             self.weights_path = config.get('YOLO', 'weights_path')
-        self.weights = config.get('YOLO', 'weights')
+        self.weights = {**config.get('YOLO', 'weights'), **(weights or {})}
+        self.confidence = {**self.DEFAULT_CONFIDENCE, **(confidence or {})}
+        self.roi_margin = float(roi_margin or 0.0)
+        self.frame_box = None  # Last frame found (x1, y1, x2, y2), searched first when roi_margin > 0
+        self._frame_lock = threading.Lock()  # Guards frame_box (images of the meter processed at once)
         self.model_paths = {
             "frame": os.path.join(self.weights_path, self.weights['frame']),
             "counter": os.path.join(self.weights_path, self.weights['counter']),
             "digits": os.path.join(self.weights_path, self.weights['digits']),
         }
 
-        # Load models
+        # Load models (or reuse those already loaded for another meter)
         logger.debug("Loading models... from:\n%s\n", self.weights_path)
-        self.model_frame = YOLO(self.model_paths["frame"])
-        self.model_counter = YOLO(self.model_paths["counter"])
-        self.model_digits = YOLO(self.model_paths["digits"])
+        self.models = models if models is not None else {}
+        self.model_frame = self._load_model(self.model_paths["frame"])
+        self.model_counter = self._load_model(self.model_paths["counter"])
+        self.model_digits = self._load_model(self.model_paths["digits"])
         logger.info("Models loaded successfully! - %s", self.weights)
 
-    def detect_frame(self, image_path):
+    def _load_model(self, path):
+        model = self.models.get(path)
+        if model is None:
+            model = self.models[path] = YOLO(path)
+        else:
+            logger.debug("Reusing the model already loaded from %s", path)
+        return model
+
+    def _predict(self, model, image, **kwargs):
+        """Runs a model on an image, one prediction at a time per model (shared by the readers and the threads)."""
+        with model_lock(model):
+            return model(image, device=self.device, verbose=False, **kwargs)
+
+    def warmup(self, paths=None):
+        """
+        Runs the models once on a blank image: the first inference of a model is slow (lazy initialization,
+        memory allocation on the device), better paid before the reader takes its first upload.
+
+        Args:
+            paths (set, optional): Only warm up the models loaded from these weights paths (default: all).
+        """
+        blank = np.zeros((704, 640, 3), dtype=np.uint8)
+        stages = [("frame", self.model_frame, [640, 704]), ("counter", self.model_counter, [640, 704]),
+                  ("digits", self.model_digits, [192, 768])]
+        for stage, model, imgsz in stages:
+            if paths is None or self.model_paths[stage] in paths:
+                self._predict(model, blank, imgsz=imgsz)
+                logger.debug("Warmed up the %s model %s", stage, self.model_paths[stage])
+
+    @staticmethod
+    def scaled_imgsz(imgsz, scale):
+        """Scales an inference size [height, width], keeping multiples of 32 (the stride of the models)."""
+        return [max(32, int(round(size * scale / 32)) * 32) for size in imgsz]
+
+    def detect_frame(self, image, image_name=None, plot=True, imgsz_scale=1.0):
         """
         Detects the frame in the meter image.
         
         Args:
-            image_path (str): Path to the input image.
+            image (str or ndarray): Path to the input image, or the already decoded image.
+            image_name (str, optional): Name of the image, used in log messages and plot titles.
+            plot (bool): Render the annotated image (None is returned otherwise).
+            imgsz_scale (float): Scale of the inference size (lower = faster, less accurate).
         
         Returns:
             tuple: Annotated image with bounding boxes, cropped frame image.
         """
-        image = predict_helpers.load_image(image_path)
-        logger.debug("Processing image: %s, Shape: %s", image_path, image.shape)
-
-        results = self.model_frame(
-            image, device=self.device, imgsz=[640, 704], conf=0.4, iou=0.5, verbose=False
-        )
-        predict_helpers.plot_image(results[0].plot(), "Detected Frame on %s" % os.path.basename(image_path), bgr=True)
+        if isinstance(image, str):
+            image_name = image_name or os.path.basename(image)
+            image = predict_helpers.load_image(image)
+        logger.debug("Processing image: %s, Shape: %s", image_name, image.shape)
+        imgsz = self.scaled_imgsz([640, 704], imgsz_scale)
+
+        # Fixed camera: search the region of the last frame found first, then the whole image
+        roi = self._frame_roi(image)
+        if roi is not None:
+            rx1, ry1, rx2, ry2 = roi
+            results = self._predict(
+                self.model_frame, image[ry1:ry2, rx1:rx2], imgsz=imgsz, conf=self.confidence["frame"], iou=0.5
+            )
+            if results[0].boxes.xyxy.nelement() != 0:
+                x1, y1, x2, y2 = map(int, results[0].boxes.xyxy[0].tolist())
+                x1, y1, x2, y2 = box = (x1 + rx1, y1 + ry1, x2 + rx1, y2 + ry1)
+                frame_plot = results[0].plot() if plot else None  # Plot of the region searched
+                if frame_plot is not None:
+                    predict_helpers.plot_image(frame_plot, "Detected Frame on %s" % image_name, bgr=True)
+                with self._frame_lock:  # The crop uses this image's box, whatever other jobs find meanwhile
+                    self.frame_box = box
+                return frame_plot, image[y1:y2, x1:x2].copy()
+            logger.debug("No frame found in the region of the last one on %s, searching the whole image", image_name)
+
+        results = self._predict(self.model_frame, image, imgsz=imgsz, conf=self.confidence["frame"], iou=0.5)
+        frame_plot = results[0].plot() if plot else None
+        if frame_plot is not None:
+            predict_helpers.plot_image(frame_plot, "Detected Frame on %s" % image_name, bgr=True)
         frame_image = None
-        if results[0].boxes.xyxy is not None:
+        if results[0].boxes.xyxy.nelement() != 0:
             box = results[0].boxes.xyxy[0]
             x1, y1, x2, y2 = map(int, box.tolist())
             frame_image = image[y1:y2, x1:x2].copy()
+            with self._frame_lock:
+                self.frame_box = (x1, y1, x2, y2)
 
-        return results[0].plot(), frame_image
+        return frame_plot, frame_image
 
-    def detect_counter(self, frame_image):
+    def _frame_roi(self, image):
+        """Region of the last frame found, expanded by roi_margin (None if disabled or no frame found yet)."""
+        with self._frame_lock:
+            frame_box = self.frame_box
+        if self.roi_margin <= 0 or frame_box is None:
+            return None
+        x1, y1, x2, y2 = frame_box
+        dx, dy = int((x2 - x1) * self.roi_margin), int((y2 - y1) * self.roi_margin)
+        height, width = image.shape[:2]
+        roi = (max(0, x1 - dx), max(0, y1 - dy), min(width, x2 + dx), min(height, y2 + dy))
+        if roi[2] - roi[0] < 32 or roi[3] - roi[1] < 32:
+            return None  # Image of another size than the previous ones
+        return roi
+
+    def detect_counter(self, frame_image, plot=True, thumbnail=True, imgsz_scale=1.0):
         """
         Detects the counter region from the frame image.
         
         Args:
             frame_image (ndarray): Cropped frame image.
+            plot (bool): Render the annotated image (None is returned otherwise).
+            thumbnail (bool): Generate the thumbnail of the counter (None is returned otherwise).
+            imgsz_scale (float): Scale of the inference size (lower = faster, less accurate).
         
         Returns:
             tuple: Annotated image, binary processed counter image, A thumbnail of the counter image (256 pixels wide)
         """
-        results = self.model_counter(
-            frame_image, device=self.device, imgsz=[640, 704], conf=0.4, iou=0.5, verbose=False
+        results = self._predict(
+            self.model_counter, frame_image, imgsz=self.scaled_imgsz([640, 704], imgsz_scale), conf=self.confidence["counter"], iou=0.5
         )
 
         counter_image = None
-        predict_helpers.plot_image(results[0].plot(), "Detected Counter", bgr=True)
+        counter_plot = results[0].plot() if plot else None
+        if counter_plot is not None:
+            predict_helpers.plot_image(counter_plot, "Detected Counter", bgr=True)
         if results[0].boxes.xyxy.nelement() != 0:
             box = results[0].boxes.xyxy[0]
             x1, y1, x2, y2 = map(int, box.tolist())
@@ -115,20 +231,22 @@ class MeterReader:
             rotated_image = predict_helpers.rotate_image(counter_image, rotation_angle)
             binary_image = predict_helpers.convert_to_binary(rotated_image, invert=True, bgr=True)
             # plot_image(binary_image, "Binary Image will be passed to Dgits Detection")
-            detected_thumbnail = predict_helpers.generate_thumbnail(counter_image)
-            return results[0].plot(), binary_image, detected_thumbnail
+            detected_thumbnail = predict_helpers.generate_thumbnail(counter_image) if thumbnail else None
+            return counter_plot, binary_image, detected_thumbnail
         else:
             return None, None, None
 
-    def detect_digits(self, digits_image):
+    def detect_digits(self, digits_image, plot=True, with_confidence=False):
         """
         Detects digits from the binary processed counter image.
         
         Args:
             digits_image (ndarray): Processed binary image of the counter.
+            plot (bool): Render the annotated image (None is returned otherwise).
+            with_confidence (bool): Also return the confidence of the value (that of its least certain digit).
         
         Returns:
-            tuple: Annotated image, string value, integer value.
+            tuple: Annotated image, string value, integer value (and confidence, 0.0 if no value).
         """
         digit_name_map = {
             "zero": "0", "one": "1", "two": "2", "three": "3", "four": "4",
@@ -137,14 +255,16 @@ class MeterReader:
 
         meter_value_str = ""
         meter_value_int = None
-        results = self.model_digits(
-            digits_image, device=self.device, imgsz=[192, 768], conf=0.6, iou=0.5, verbose=False
-        )
+        confidence = 0.0
+        results = self._predict(self.model_digits, digits_image, imgsz=[192, 768], conf=self.confidence["digits"], iou=0.5)
 
+        digits_plot = results[0].plot() if plot else None
         if results[0].boxes is not None and len(results[0].boxes.xyxy) > 0:
-            predict_helpers.plot_image(results[0].plot(), "Detected Digits", bgr=True)
+            if digits_plot is not None:
+                predict_helpers.plot_image(digits_plot, "Detected Digits", bgr=True)
             boxes = results[0].boxes.xyxy.tolist()  # Convert to list for easier iteration
             class_ids = results[0].boxes.cls.tolist()
+            confidences = results[0].boxes.conf.tolist()
             names = results[0].names
 
             valid_boxes = []
@@ -166,6 +286,7 @@ class MeterReader:
                 valid_boxes.sort(key=lambda box: box[1])  # Sort by the second element (x1)
 
                 num_digits_to_read = min(6, len(valid_boxes))  # Read up to 6 digits, the last digit (after the comma is not relevant)
+                confidence = min(confidences[box[0]] for box in valid_boxes[:num_digits_to_read])
                 for digit_no in range(num_digits_to_read):
                     i, x1, y1, x2, y2 = valid_boxes[digit_no]
                     digit_name = names[int(class_ids[i])]
@@ -191,7 +312,9 @@ class MeterReader:
         else:
             logger.warning("No digits detected.")
 
-        return results[0].plot(), meter_value_str, meter_value_int
+        if with_confidence:
+            return digits_plot, meter_value_str, meter_value_int, confidence if meter_value_int is not None else 0.0
+        return digits_plot, meter_value_str, meter_value_int
     
     def predict_image(self, image_path):
         """
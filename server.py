@@ -1,10 +1,12 @@
 import asyncio
-import io
+import base64
 import json
 import logging
+import mimetypes
 import os
 import sys
-from datetime import datetime, timezone
+import uuid
+from datetime import datetime, timedelta, timezone
 
 # pylint: disable=w1203
 # pylint: disable=C0103
@@ -12,7 +14,9 @@ from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 # Import the Quart modules, used to provide the HTTP Server and rendering of the HTML templates
-from quart import Quart, request, Response, jsonify, abort, render_template, websocket, send_file
+from quart import Quart, request, Response, jsonify, abort, render_template, websocket, send_file, url_for, copy_current_websocket_context, stream_with_context
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import http_date
 from werkzeug.utils import secure_filename
 
 # Import the logging models. Incl. the custom_logger module
@@ -26,17 +30,63 @@ from helpers import config
 # This class is used to interact with the MongoDB database.
 from helpers.monogodb_handler import MongoDBHandler
 
+# Import the RetentionEngine class from the helpers module.
+# This class enforces the retention policies (count, age, storage quota) on MongoDB / GridFS.
+from helpers.retention import RetentionEngine
+
+# Import the JobQueue class from the helpers module.
+# Uploads are queued as jobs and processed by a bounded number of inference workers.
+from helpers.jobs import JobQueue, QueueFull, Deadline, JobAborted, CANCELLED, TIMEOUT, INTERACTIVE, BULK
+
+# Import the UploadSpool class from the helpers module.
+# Uploads are stored in a durable on-disk spool before they are acknowledged, and replayed after a restart.
+from helpers.spool import UploadSpool
+
 # Import the HomeAssistant_MQTT_Client class from the helpers module. 
 # This class is used to send data to Home Assistant.
 from helpers.mqtt_client import HomeAssistant_MQTT_Client
+# Its asyncio variant lives on the event loop of the server ("MQTT: client: asyncio"), connected in startup()
+from helpers.mqtt_async import AsyncHomeAssistant_MQTT_Client
+# Images published by the cameras over MQTT are queued like the HTTP uploads
+from helpers.mqtt_ingest import MQTTImageIngest
+
+# Import the batch upload helpers, extracting the images of multipart / tar / zip uploads while they are received
+from helpers import batch
+
+# Import the multi-process serving helpers: in a worker process, values are published through the MQTT publisher process
+from helpers import workers
+
+# Import the event bus: results processed by any worker process reach the WebSocket clients of all of them
+from helpers import events
+
+# Import the ResponseCache class: the index page and /metadata are rendered once per change of the metadata
+from helpers.cache import ResponseCache
+
+# Import the metrics registry, exported on /metrics
+from helpers import metrics
+
+# Import the load shedding helpers: optional work is dropped while the inference workers are overloaded
+from helpers import degradation
+
+# Import the streaming helpers used to send GridFS files chunk by chunk (with HTTP Range support)
+from helpers import streaming
 
 
 # Import Image manipulation functions and other helpers used by the prediction functions
 from predicter import predict_helpers
 
-# Import the MeterReader class from the predictions module. 
-# The MeterReader class is used to process images and extract meter readings.
-from predicter.predictions import MeterReader
+# Import the MeterRegistry class: the configured meters, each with its MeterReader (models shared between meters)
+# The MeterReader class (predicter/predictions.py) is used to process images and extract meter readings.
+from helpers.meters import MeterRegistry, UnknownMeter
+
+# Import the ReadingFilter class: plausibility checks and coalescing of the readings before they are published
+from helpers.plausibility import ReadingFilter
+
+# Import the OutputFanout class: queues the accepted readings to the output sinks (MQTT, webhooks, file)
+from helpers.outputs import OutputFanout
+
+# Import the HotReloader class: reloads config.yaml when it changes, swapping new meters / models in
+from helpers.hot_reload import HotReloader
 
 
 # Initialize the helper Classes and functions:
@@ -44,32 +94,101 @@ from predicter.predictions import MeterReader
 # Load environment variables if running locally
 load_dotenv()
 
-# 1) Create a CustomLogger object
-logger = custom_logger.setup_logging(logger_name="MeterReader")
-
-# 2) Create a Config object
+# 1) Create a Config object
 config_instance = config.ConfigLoader("config.yaml")
 
+# 2) Create a CustomLogger object (queued, non-blocking: see the "Logging" section of config.yaml)
+logger = custom_logger.setup_logging(logger_name="MeterReader", config=config_instance)
+
 
 # 3) Initialize Mongo db handler a
 db_handler = MongoDBHandler(config_instance) # connects to the Mongo Database
 
-# 4) Initialize the MeterReader object
-meter_reader = MeterReader(config_instance) # Loads the model used for predictions
+# 4) Initialize the meters and their MeterReader objects (each weights file is loaded once, shared between meters)
+meter_registry = MeterRegistry.from_config(config_instance)
+meter_registry.load_readers(config_instance) # Loads the models used for predictions
 
 # 5) Create an instance of the HomeAssistant_MQTT class
-ha_mqtt = HomeAssistant_MQTT_Client(config_instance) 
-
-# 6) Store connected WebSocket clients
+#    (when served by several worker processes, a single publisher process holds the MQTT connection)
+if workers.publisher_queue is not None:
+    ha_mqtt = workers.MQTTPublisherProxy(workers.publisher_queue)
+elif (config_instance.get("MQTT", "client", "thread") or "thread").lower() == "asyncio":
+    ha_mqtt = AsyncHomeAssistant_MQTT_Client(config_instance)  # Connects in the background, see startup()
+else:
+    ha_mqtt = HomeAssistant_MQTT_Client(config_instance)
+
+# 16) Check the readings against the last accepted one of their meter, and coalesce bursts before publishing
+#     (publish_reading is defined below)
+reading_filter = ReadingFilter.from_config(config_instance, lambda reading: publish_reading(reading),
+                                           lambda meter: db_handler.get_last_reading(meter.device_id))
+
+# 17) Create the output sinks of the accepted readings, each with its own queue and retries (started in startup())
+outputs = OutputFanout.from_config(config_instance, ha_mqtt)
+
+# 18) Reload config.yaml when it changes: thresholds, weights and meters are applied without a restart
+#     (None if disabled, apply_config is defined below)
+hot_reloader = HotReloader.from_config(config_instance, lambda: meter_registry,
+                                       lambda config, registry: apply_config(config, registry))
+
+# 6) Store connected WebSocket clients (one bounded queue of pending events per client)
 clients = set()
+ws_queue_size = max(1, int(config_instance.get("WebSocket", "queue_size", 64)))
 
-# 7) Initialize the Quart application object
+# What to do with the original of uploaded images: "disk" (static folder), "store" (image store) or "none"
+persist_original_policy = (config_instance.get("Upload", "persist_original", "disk") or "none").lower()
+
+# References to running background tasks (asyncio only keeps weak references)
+background_tasks = set()
+
+# 9) Create the bounded job queue feeding the inference workers, and report job status over the WebSocket
+#    (the handler is looked up when a job runs, run_upload_job is defined below)
+job_queue = JobQueue.from_config(config_instance, lambda job: run_upload_job(job))
+job_queue.listeners.append(lambda status: broadcast({"type": "job", **status}))
+
+# 14) Create the load shedder, degrading the processing of uploads while the job queue is backed up
+#     (keyed on the interactive lane: a backfill in the bulk lane only takes longer)
+load_shedder = degradation.LoadShedder.from_config(config_instance)
+job_queue.listeners.append(lambda status: status["lane"] == INTERACTIVE
+                           and load_shedder.observe_job(status, job_queue.lane_depth(INTERACTIVE)))
+
+# 15) Receive images over MQTT (None if disabled, or if the MQTT connection belongs to the publisher process)
+#     (submit_mqtt_image is defined below)
+mqtt_ingest = MQTTImageIngest.from_config(config_instance, ha_mqtt, lambda *args: submit_mqtt_image(*args))
+
+# 10) Open the crash-safe upload spool (None if disabled): uploads are stored on disk before they are acknowledged
+upload_spool = UploadSpool.from_config(config_instance)
+spool_retry_interval = float(config_instance.get("Spool", "retry_interval_seconds", 60))
+spooled_jobs = set()  # Ids of the spool entries currently queued or processed
+
+# Header used to let a reverse proxy serve files of the filesystem storage backend (zero-copy), if any
+sendfile_header = config_instance.get("Storage", "sendfile_header", "")
+sendfile_prefix = config_instance.get("Storage", "sendfile_prefix", "/store/")
+
+# 11) Batch uploads (POST /files): size limits, and how many images of a batch are held in memory at once
+batch_max_file_size = int(float(config_instance.get("Batch", "max_file_mb", 10)) * 1024 * 1024)
+batch_zip_memory_size = int(float(config_instance.get("Batch", "zip_memory_mb", 16)) * 1024 * 1024)
+batch_max_in_flight = max(1, int(config_instance.get("Batch", "max_in_flight", 8)))
+batch.BatchUploadRequest.batch_max_content_length = int(float(config_instance.get("Batch", "max_content_mb", 1024)) * 1024 * 1024) or None
+
+# 7) Create the retention engine, pruning old entries and GridFS files on a schedule
+retention_engine = RetentionEngine(config_instance, db_handler)
+retention_engine.listeners.append(lambda report: event_bus.publish({"type": "invalidate"}))
+
+# 12) Create the event bus shared by the worker processes (WebSocket broadcasts, cache invalidation)
+event_bus = events.create_event_bus(config_instance, db_handler, worker_count=workers.worker_count)
+event_bus.subscribe(lambda event: handle_bus_event(event))
+
+# 13) Cache of the rendered index page and /metadata responses, invalidated through the event bus
+response_cache = ResponseCache.from_config(config_instance)
+
+# 8) Initialize the Quart application object
 app = Quart(__name__, 
             static_url_path = '',
             static_folder   = 'static', 
             template_folder = 'templates'
             )
 app.config['MAX_CONTENT_LENGTH'] = 10*1024*1024 # 10MB
+app.request_class = batch.BatchUploadRequest  # Batch uploads (POST /files) have their own limit
 app.logger=logger
 
 
@@ -77,73 +196,173 @@ app.logger=logger
 static_folder_path = f"{app.static_folder}/"
 logger.info(f"Root Path: {app.root_path} - Static Folder: {app.static_folder} - Template Folder: {app.template_folder}")
 
-async def process_image(image_path):
+async def process_image(file_name_image, image, file_content=None, deadline=None, meter=None):
     """
     Wrapper function to call all three detections in one go.
     Returns the detected value (integer) or None if nothing is detected.
+
+    The stages are run against the deadline of the job: when it passes (or the job is cancelled), the
+    detections are abandoned and nothing is persisted (JobAborted). Once the results are being persisted,
+    the job runs to completion.
+
+    Under load, optional work is dropped as decided by the load shedder (helpers/degradation.py):
+    annotated plots, thumbnail, persisted original, then full input resolution.
     
     Args:
-        image_path (str): Path to the input image.
+        file_name_image (str): Name of the uploaded image.
+        image (ndarray): The decoded input image.
+        file_content (bytes, optional): Content of the uploaded file, persisted as defined by the upload policy.
+        deadline (Deadline, optional): Deadline of the job.
+        meter (Meter, optional): Meter of the image (default: the default meter).
     
     Returns:
         int or None: The detected meter value.
     """
 
-    logger.debug("Inside process_Image %s", image_path)
+    logger.debug("Inside process_Image %s", file_name_image)
+    deadline = deadline or Deadline()
+    meter = meter or meter_registry.default
+    meter_reader = meter.reader
+    processed_at = datetime.now(tz=timezone.utc)
     detected_thumbnail = None
+    level = load_shedder.update(job_queue.lane_depth(INTERACTIVE))
+    plot = level < degradation.NO_PLOTS
+    imgsz_scale = load_shedder.imgsz_scale if level >= degradation.REDUCED_RESOLUTION else 1.0
     # Call the detect_frame method
-    frame_plot, frame_image = meter_reader.detect_frame(image_path)
+    # The inference stages are CPU bound: run them in a worker thread, so the event loop stays responsive
+    frame_plot, frame_image = await deadline.run("frame", meter_reader.detect_frame, image, image_name=file_name_image,
+                                                 plot=plot, imgsz_scale=imgsz_scale)
     
     if frame_image is None:
-        logger.debug("No frame detected on image %s", image_path)
+        logger.debug("No frame detected on image %s", file_name_image)
         counter_image = None
         counter_plot = None
     else:
         logger.debug("Frame Shape returned from 'detect_frame': %s", frame_image.shape)
         # Call the detect_counter method
-        counter_plot, counter_image, detected_thumbnail = meter_reader.detect_counter(frame_image)
+        counter_plot, counter_image, detected_thumbnail = await deadline.run(
+            "counter", meter_reader.detect_counter, frame_image,
+            plot=plot, thumbnail=level < degradation.NO_THUMBNAILS, imgsz_scale=imgsz_scale)
     
     if counter_image is None:
-        logger.debug("No counter detected on image %s", image_path)
+        logger.debug("No counter detected on image %s", file_name_image)
         digits_plot = None
         digits_int = 0
         digits_str = ""
+        confidence = 0.0
     else:
         logger.debug("Counter Shape returned from 'detect_counter': %s", counter_image.shape)
         # Call the detect_digits method
-        digits_plot, digits_str, digits_int = meter_reader.detect_digits(counter_image)
-    
-    if digits_int != 0:
-        logger.debug("Detected Meter Value: %i", digits_int)
+        digits_plot, digits_str, digits_int, confidence = await deadline.run(
+            "digits", meter_reader.detect_digits, counter_image, plot=plot, with_confidence=True)
+
+    # Last chance to abort: from here on the results are published and stored
+    deadline.check("persist")
+
+    # Persist the original in the background (or not at all), as defined by the upload policy
+    image_path = None
+    if file_content is not None and level < degradation.NO_ORIGINALS:
+        image_path = persist_original(file_name_image, file_content)
+
+    device_id = meter.device_id
+    plausibility = None
+    if digits_int:
+        logger.debug("Detected Meter Value: %i (confidence %.2f)", digits_int, confidence)
         #
         # This is the key statement in the whole application...
-        # Send a value to Home Assistant
-        device_id = config_instance.get("HomeAssistant", "device_id")
-        ha_mqtt.send_value(device_id, float(digits_int))
+        # Send a plausible value to Home Assistant, and keep it in the readings time-series (see publish_reading)
+        plausibility = await reading_filter.submit(meter, digits_int, confidence, processed_at, file_name_image)
         #
         #
     else:
         digits_int = 0
         digits_str = ""
-        logger.warning("No Digits Value found on image %s", image_path)
+        logger.warning("No Digits Value found on image %s", file_name_image)
 
 
-    # Store image metadata and intermediate files in MongoDB
-    file_name_image = os.path.basename(image_path)
-    
+    # Store image metadata and intermediate files in MongoDB (blocking I/O, run in a worker thread)
+    await asyncio.to_thread(store_results, file_name_image, image_path, frame_plot, counter_plot, digits_plot,
+                            digits_str, digits_int, detected_thumbnail, processed_at,
+                            counter_found=counter_image is not None, degradation_level=level, meter_id=meter.id,
+                            plausibility=plausibility)
+    # (on the meter currently configured: config.yaml may have been reloaded while the image was processed)
+    meter_registry.meters.get(meter.id, meter).last_result = {"file_name_image": file_name_image, "value": digits_int, "value_str": digits_str,
+                         "processed_at": processed_at.isoformat()}
+
+    # Push the new result to the connected browsers of all workers (compact: the thumbnail is fetched by URL, if needed)
+    event_bus.publish(events.reading_event(file_name_image, digits_int, digits_str, processed_at.isoformat(),
+                                           has_thumbnail=bool(detected_thumbnail) and counter_image is not None,
+                                           meter_id=meter.id, device_id=device_id, plausibility=plausibility))
+
+    return file_name_image, digits_int
+# end def    
+
+
+def apply_config(new_config, registry):
+    """
+    Apply a reloaded config.yaml (helpers/hot_reload.py): new plausibility settings, and the new meters with their
+    readers (None if the "YOLO" and "Meters" sections did not change).
+
+    The swap is a single assignment: the jobs started from then on use the new readers, the jobs in flight finish
+    with the readers they started with.
+    """
+    global meter_registry
+    reading_filter.reconfigure(new_config)
+    if registry is None:
+        return
+    for meter in registry:
+        previous = meter_registry.meters.get(meter.id)
+        if previous is not None:
+            meter.last_result = previous.last_result
+            if previous.reader.model_paths["frame"] == meter.reader.model_paths["frame"]:
+                meter.reader.frame_box = previous.reader.frame_box  # Same frame model: keep the region searched first
+    meter_registry = registry
+    if hasattr(ha_mqtt, "HA_devices"):
+        ha_mqtt.HA_devices = [meter.device_id for meter in registry]  # Last values re-published on reconnection
+
+
+async def publish_reading(reading):
+    """
+    Publish an accepted reading (helpers/plausibility.py) to the output sinks, and store it in the readings time-series.
+    """
+    device_id = reading.meter.device_id
+    # Queued to every sink (Home Assistant, webhooks, file): never waits for any of them
+    outputs.publish(reading)
+    # Keep the history of accepted values in the readings time-series (and its hourly / daily rollups)
+    try:
+        await asyncio.to_thread(db_handler.insert_reading, device_id, reading.value,
+                                timestamp=reading.timestamp, filename=reading.filename)
+    except Exception as ex:
+        logger.error("Error storing reading for %s: %s", reading.filename, ex)
+
+
+def store_results(file_name_image, image_path, frame_plot, counter_plot, digits_plot,
+                  digits_str, digits_int, detected_thumbnail, processed_at,
+                  counter_found=None, degradation_level=degradation.FULL, meter_id=None, plausibility=None):
+    """
+    Store the annotated images in the image store and the image metadata in MongoDB.
+    Plots skipped by the load shedder (counter found, but no plot) are recorded as None.
+    The verdict of the plausibility filter, if any, is a (verdict, reason) tuple.
+    """
+    if counter_found is None:
+        counter_found = counter_plot is not None
+
     if frame_plot is not None:
         db_handler.insert_image(file_name_image, frame_plot)
          
     if counter_plot is not None:
         file_name_counter = f"{file_name_image[:-4]}_counter.jpg"
         db_handler.insert_image(file_name_counter, counter_plot)
-        
+    elif counter_found:
+        file_name_counter = None  # Plot skipped under load
     else:
         file_name_counter = f"No Counter found on {file_name_image[:-4]}"
 
     if digits_plot  is not None:
         file_name_digits = f"{file_name_image[:-4]}_digits.jpg"
         db_handler.insert_image(file_name_digits, digits_plot)
+    elif counter_found:
+        file_name_digits = None  # Plot skipped under load
     else:
         file_name_digits = f"No Digits found on {file_name_image[:-4]}"
         detected_thumbnail = None
@@ -156,13 +375,375 @@ async def process_image(image_path):
         "value_str": digits_str,
         "value_int": digits_int,  
         "detected_thumbnail": detected_thumbnail,
-        "processed_at": datetime.now(tz=timezone.utc).isoformat()  # Add UTC timestamp  
+        "processed_at": processed_at.isoformat(timespec="microseconds")  # Add UTC timestamp  
             }
+    if meter_id:
+        image_metadata["meter"] = meter_id
+    if persist_original_policy == "store" and image_path:
+        image_metadata["file_name_original"] = image_path  # Deleted together with the entry by the retention engine
+    if degradation_level:
+        image_metadata["degradation_level"] = degradation_level  # Processed under load, without some optional work
+    if plausibility is not None:
+        image_metadata["plausibility"], reason = plausibility
+        if reason:
+            image_metadata["rejected_reason"] = reason  # Value read, but not published
     logger.debug("Image Data Stored in MongoDB %s: Value: %i", file_name_image, digits_int)
     db_handler.update_image_metadata(file_name_image, image_metadata)
 
-    return file_name_image, digits_int
-# end def    
+
+async def run_upload_job(job):
+    """
+    Job handler: decode an uploaded image, persist the original and run the detections.
+
+    When the upload spool is enabled, the spool entry is claimed (leased) first, completed when the
+    image is processed, and released on failure so it is retried later (e.g. MongoDB down). An invalid
+    image is parked as failed instead: it will never succeed. A job aborted while its client waits for
+    the result (synchronous upload), or cancelled because its client disconnected, is dropped from the
+    spool: the client is told to send the image again, and retrying it as well would store the reading twice.
+
+    Args:
+        job (Job): Job whose payload is a dictionary with the content of the uploaded file ("data",
+                   None if it is only held in the spool), the id of its spool entry ("spool_id"),
+                   the id of its meter ("meter", None for the default meter) and whether the client
+                   waits for the result ("client_waiting").
+
+    Returns:
+        dict: Name of the processed image and the detected value.
+    """
+    filename, file_content, spool_id = job.filename, job.payload.get("data"), job.payload.get("spool_id")
+    client_waiting = job.payload.get("client_waiting", False)
+    # Log the records of the job with the id of the request that submitted it (the job id for replays)
+    request_id = job.payload.get("request_id")
+    custom_logger.request_id.set(job.id if request_id in (None, "-") else request_id)
+
+    if spool_id is not None:
+        if not await asyncio.to_thread(upload_spool.claim, spool_id):
+            # Processed (or being processed) by another worker process, e.g. replayed after a restart: not a failure
+            spooled_jobs.discard(spool_id)
+            logger.info("Spool entry %i of %s already processed or leased by another worker", spool_id, filename)
+            return {"file_name_image": filename, "value": None, "meter": job.payload.get("meter"),
+                    "processed_elsewhere": True}
+        if file_content is None:
+            file_content = await asyncio.to_thread(upload_spool.read, spool_id)
+
+    try:
+        meter = meter_registry.get(job.payload.get("meter"))  # UnknownMeter if removed from config.yaml since
+
+        # Decode the image straight from the request body, without a round trip through the disk
+        # (not started at all if the job expired or was cancelled while waiting in the queue)
+        image = await job.deadline.run("decode", predict_helpers.decode_image, file_content)
+        if image is None:
+            raise ValueError("File is not a valid image")
+
+        # Process the image (this now handles MongoDB interaction)
+        file_name_image, detected_number = await process_image(filename, image, file_content=file_content,
+                                                               deadline=job.deadline, meter=meter)
+    except JobAborted as ex:
+        if spool_id is not None:
+            if ex.reason == CANCELLED or client_waiting:
+                # The upload was never acknowledged (the client went away, or gets the error): it sends it again
+                await asyncio.shield(asyncio.to_thread(upload_spool.complete, spool_id))
+            else:
+                # Timed out (overloaded server, or an image that is slow to process): retried up to "Spool: max_attempts"
+                await asyncio.shield(asyncio.to_thread(upload_spool.release, spool_id, error=str(ex), retry=True))
+        raise
+    except BaseException as ex:
+        if spool_id is not None:
+            # An invalid image will never succeed: park it instead of retrying. Anything else (e.g. MongoDB down)
+            # is retried from the spool, the client waiting for the result is told so (see handle_file_upload)
+            retry = not isinstance(ex, ValueError)
+            await asyncio.shield(asyncio.to_thread(upload_spool.release, spool_id, error=str(ex), retry=retry))
+        raise
+    finally:
+        spooled_jobs.discard(spool_id)
+
+    if spool_id is not None:
+        await asyncio.to_thread(upload_spool.complete, spool_id)
+    return {"file_name_image": file_name_image, "value": detected_number, "meter": meter.id}
+
+
+def submit_upload(filename, file_content=None, spool_id=None, lane=INTERACTIVE, meter_id=None, client_waiting=False):
+    """
+    Queue an upload for the inference workers.
+
+    Interactive uploads are refused when their lane is full, spooled or not: the client gets a 429 right away
+    (the caller drops the spool entry). Spooled bulk uploads (batches, replays) never get refused: if the queue
+    is full they wait (on disk) for room.
+
+    Args:
+        filename (str): Name of the uploaded file.
+        file_content (bytes, optional): Content of the file. May be None for spooled uploads.
+        spool_id (int, optional): Id of the spool entry holding the upload.
+        lane (str): Priority lane: INTERACTIVE (single uploads) or BULK (batches, replays).
+        meter_id (str, optional): Id of the meter of the image (None for the default meter).
+        client_waiting (bool): True if the client waits for the result (a spooled upload aborted past its
+                               deadline is then not retried, see run_upload_job).
+
+    Returns:
+        Job: The queued job.
+
+    Raises:
+        QueueFull: If the lane is full (interactive uploads, and bulk uploads that are not spooled).
+    """
+    request_id = custom_logger.request_id.get()  # Logged with the records of the job
+    if spool_id is None:
+        return job_queue.submit(filename, {"data": file_content, "meter": meter_id, "request_id": request_id}, lane=lane)
+
+    # Only keep the image in memory if it is processed soon, otherwise it is read back from the spool
+    data = file_content if not job_queue.full(lane) else None
+    job = job_queue.submit(filename, {"data": data, "spool_id": spool_id, "meter": meter_id, "request_id": request_id,
+                                      "client_waiting": client_waiting}, overflow=lane != INTERACTIVE, lane=lane)
+    spooled_jobs.add(spool_id)
+    return job
+
+
+async def submit_mqtt_image(filename, file_content, meter_id=None):
+    """
+    Queue an image received over MQTT (helpers/mqtt_ingest.py), like an upload to POST /file.
+
+    Args:
+        filename (str): Name of the image.
+        file_content (bytes): Content of the image.
+        meter_id (str, optional): Id of the meter named by the message (else routed by the file name).
+
+    Returns:
+        Job: The queued job.
+
+    Raises:
+        UnknownMeter: If the meter is not configured.
+        QueueFull: If the queue is full.
+        RuntimeError: If the spool is full.
+    """
+    filename = secure_filename(filename)
+    meter = meter_registry.get(meter_id) if meter_id else meter_registry.resolve(filename=filename)
+    spool_id = await spool_upload(filename, file_content, meter)
+    return await submit_spooled_upload(filename, file_content, spool_id, meter)
+
+
+async def spool_upload(filename, file_content, meter):
+    """
+    Store an interactive upload in the spool (if enabled) before it is acknowledged.
+
+    Checked first: the spool has room, and the interactive lane of the job queue too (so a client is
+    refused with a 429 right away, instead of its upload waiting on disk past its deadline).
+
+    Returns:
+        int or None: Id of the spool entry, None if the spool is disabled.
+
+    Raises:
+        QueueFull: If the interactive lane of the job queue is full.
+        RuntimeError: If the spool is full.
+    """
+    if upload_spool is None:
+        return None
+    if job_queue.full(INTERACTIVE):
+        raise QueueFull(job_queue.retry_after(INTERACTIVE))
+    if await asyncio.to_thread(upload_spool.is_full):
+        raise RuntimeError("Upload spool is full")
+    return await asyncio.to_thread(upload_spool.append, filename, file_content, {"meter": meter.id})
+
+
+async def submit_spooled_upload(filename, file_content, spool_id, meter, client_waiting=False):
+    """
+    Queue an interactive upload stored by spool_upload(). If the lane filled up while the upload was
+    written to the spool, the spool entry is dropped (the upload was not acknowledged) and QueueFull is raised.
+    """
+    try:
+        return submit_upload(filename, file_content, spool_id=spool_id, meter_id=meter.id,
+                             client_waiting=client_waiting)
+    except QueueFull:
+        if spool_id is not None:
+            await asyncio.to_thread(upload_spool.complete, spool_id)
+        raise
+
+
+async def replay_spool():
+    """
+    Queue the spooled uploads not processed yet: on startup (everything left by the previous process),
+    then every "Spool: retry_interval_seconds" (uploads released after a failure, e.g. MongoDB down).
+    Failed uploads older than "Spool: failed_ttl_hours" are deleted at the same interval.
+
+    With several worker processes, the spool is recovered once by the supervisor (prepare_workers)
+    and each worker replays its share of the entries. Entries still owned by the process that received
+    them (queued there, not released yet) are left alone while that process is alive: once it has died,
+    they are replayed by the worker they are assigned to.
+    """
+    if workers.worker_index is None:
+        entries = await asyncio.to_thread(upload_spool.recover)
+    else:
+        entries = await asyncio.to_thread(upload_spool.pending)
+    while True:
+        for entry in entries:
+            if entry.owner_alive():
+                continue  # Queued by the process that received it (this one, or another worker)
+            if workers.worker_index is not None and entry.id % workers.worker_count != workers.worker_index:
+                continue  # Replayed by another worker
+            if entry.id not in spooled_jobs:
+                submit_upload(entry.filename, spool_id=entry.id, lane=BULK, meter_id=entry.meta.get("meter"))
+        await asyncio.sleep(spool_retry_interval)
+        await asyncio.to_thread(upload_spool.purge_failed)
+        entries = await asyncio.to_thread(upload_spool.pending)
+
+
+@app.before_request
+async def assign_request_id():
+    """
+    Give the request an id, logged with its records and those of its jobs: the "X-Request-Id" header of the
+    client (or of a reverse proxy), else a new one. Returned in the "X-Request-Id" header of the response.
+    """
+    client_id = request.headers.get("X-Request-Id", "")
+    custom_logger.request_id.set(secure_filename(client_id)[:64] or uuid.uuid4().hex[:16])
+
+
+@app.after_request
+async def return_request_id(response):
+    response.headers["X-Request-Id"] = custom_logger.request_id.get()
+    return response
+
+
+def wants_async_response():
+    """
+    True if the client asked for an asynchronous upload ("?async=true" or "Prefer: respond-async").
+    """
+    if request.args.get("async", "").lower() in ("1", "true", "yes"):
+        return True
+    return "respond-async" in request.headers.get("Prefer", "")
+
+
+def broadcast(event):
+    """
+    Send an event (dict) to all connected WebSocket clients.
+
+    Each client has a bounded queue, so a slow client never stalls the broadcaster (nor grows memory):
+    when its queue is full, its backlog is dropped and replaced by a "resync" event, telling the page
+    to re-fetch the current state from /metadata.
+    """
+    for client_queue in clients:
+        try:
+            client_queue.put_nowait(event)
+        except asyncio.QueueFull:
+            logger.warning("WebSocket client too slow, dropping %i pending events", client_queue.qsize())
+            while not client_queue.empty():
+                client_queue.get_nowait()
+            client_queue.put_nowait({"type": "resync"})
+
+def handle_bus_event(event):
+    """
+    Apply an event of the event bus, published by this or another worker process.
+    """
+    response_cache.invalidate()  # New or deleted entries: the cached pages are outdated
+    if event.get("origin") != os.getpid():
+        # Readings stored by another process: the last value cached by this process may be outdated
+        db_handler.invalidate_last_readings()
+    if event["type"] == "invalidate":
+        broadcast({"type": "resync"})  # Entries were deleted: the pages re-fetch the current state
+    else:
+        broadcast({key: value for key, value in event.items() if key != "origin"})
+
+
+@app.before_serving
+async def startup():
+    """
+    Start the background tasks once the server is up.
+    """
+    try:
+        await asyncio.to_thread(db_handler.ensure_indexes)
+    except Exception as ex:
+        logger.error("Error creating MongoDB indexes: %s", ex)
+    if isinstance(ha_mqtt, AsyncHomeAssistant_MQTT_Client):
+        await ha_mqtt.start()  # Returns at once, the connection is made in the background
+    outputs.start()
+    if hot_reloader is not None:
+        hot_reloader.start()
+    if mqtt_ingest is not None:
+        mqtt_ingest.start()
+    if workers.is_primary_worker():
+        retention_engine.start()  # Runs in one worker only
+    job_queue.start()
+    event_bus.start()
+    if upload_spool is not None:
+        track_background_task(asyncio.create_task(replay_spool()))
+
+
+@app.after_serving
+async def cleanup():
+    """
+    Stop the background tasks when the server shuts down.
+    """
+    if hot_reloader is not None:
+        await hot_reloader.stop()
+    await retention_engine.stop()
+    for task in list(background_tasks):
+        task.cancel()
+    await job_queue.stop()
+    await event_bus.stop()
+    if upload_spool is not None:
+        upload_spool.close()
+    await reading_filter.close()  # Publishes the readings of the open coalescing windows
+    await outputs.stop()  # Delivers the queued readings, before the MQTT client disconnects
+    # Also flushes the last values (write-behind). The publisher proxy has no connection: the publisher process
+    # disconnects when it stops (helpers/workers.py)
+    if isinstance(ha_mqtt, AsyncHomeAssistant_MQTT_Client):
+        await ha_mqtt.disconnect_mqtt()
+    elif isinstance(ha_mqtt, HomeAssistant_MQTT_Client):
+        await asyncio.to_thread(ha_mqtt.disconnect_mqtt)
+
+
+def prepare_workers():
+    """
+    Called by the supervisor (helpers/workers.py) once the application is loaded, before the worker
+    processes are forked: work that must happen only once for all workers.
+    """
+    if upload_spool is not None:
+        upload_spool.recover()
+
+
+def persist_original(filename, file_content):
+    """
+    Persist the original uploaded image in the background, as defined by "Upload: persist_original":
+        "disk":  written to the static folder (served as /<filename>)
+        "store": written to the image store as <name>_original.<ext>
+        "none":  not persisted
+
+    Args:
+        filename (str): Secure name of the uploaded file.
+        file_content (bytes): Content of the uploaded file.
+
+    Returns:
+        str or None: Path (disk) or filename (store) the original is written to, None if not persisted.
+    """
+    if persist_original_policy == "disk":
+        target = os.path.join(static_folder_path, filename)
+        write = write_file
+    elif persist_original_policy == "store":
+        stem, ext = os.path.splitext(filename)
+        target = f"{stem}_original{ext or '.jpg'}"
+        write = db_handler.insert_image
+    else:
+        return None
+
+    async def write_in_background():
+        try:
+            await asyncio.to_thread(write, target, file_content)
+            logger.debug("Original image %s persisted to %s", filename, target)
+        except Exception as ex:
+            logger.error("Error persisting original image %s: %s", filename, ex)
+
+    track_background_task(asyncio.create_task(write_in_background()))
+    return target
+
+
+def track_background_task(task):
+    """Keep a reference to a background task until it is done (asyncio only keeps weak references)."""
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+def write_file(path, data):
+    """Write bytes to a file (blocking, to be run in a worker thread)."""
+    with open(path, "wb") as file:
+        file.write(data)
+
 
 @app.route("/file", methods=["POST"])
 async def handle_file_upload():
@@ -170,53 +751,296 @@ async def handle_file_upload():
     Handle file upload requests.
 
     This route processes uploaded files and performs any necessary actions.
-    Expected Input: A file to be uploaded via a POST request.
+    Expected Input: A file to be uploaded via a POST request. The meter of the image is named by the
+                    form field "Meters: form_field", the header "Meters: header" or the file name
+                    (see helpers/meters.py), else the default meter.
     Response: JSON response indicating success or failure.
+              With "?async=true" (or "Prefer: respond-async"): 202 Accepted with the job id,
+              the result is available from /jobs/<job_id>.
+              429 Too Many Requests (with Retry-After) when the job queue (or the upload spool) is full.
+              504 Gateway Timeout (the image was not processed in time) or 503 Service Unavailable (the job
+              was aborted), with Retry-After: the upload is not kept, the client sends it again.
+              400 Bad Request if the image is invalid. Any other failure of a synchronous upload (e.g. MongoDB
+              down) is answered with 202 Accepted when the upload is kept in the spool, to be retried later,
+              else with 503 Service Unavailable and Retry-After.
     """
     try:
         logger.debug("Inside Handle file Upload")
         uploaded_file = await request.files
-        logger.info("Request files: %s", uploaded_file)
+        logger.debug("Request files: %s", uploaded_file)
 
         img_list = list(uploaded_file.keys())
         if not img_list:
             logger.error("No files found in the request")
-            return Response(status=400, json={"error": "No file uploaded"})
+            return jsonify({"error": "No file uploaded"}), 400
 
         file = uploaded_file[img_list[0]]
         logger.info("Processing file: %s, MIME type: %s", file.filename, file.content_type)
 
         if not file:
             logger.error("No file uploaded")
-            return Response(status=400, json={"error": "No file uploaded"})
+            return jsonify({"error": "No file uploaded"}), 400
 
         # Verify file content
         file_content = file.read()
         if not file_content:
             logger.error("File content is empty")
-            return Response(status=400, json={"error": "File content is empty"})
+            return jsonify({"error": "File content is empty"}), 400
 
+        # Route the image to its meter
+        filename = secure_filename(file.filename)
         try:
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(static_folder_path, filename)  # Ensure proper path handling
-            file.seek(0)  # Reset file pointer before saving
-            await file.save(filepath)
-            logger.info("File %s uploaded to %s", filename, static_folder_path)
+            meter = meter_registry.resolve(await request.form, request.headers, filename)
+        except UnknownMeter as ex:
+            logger.warning("Upload of %s refused: %s", filename, ex)
+            return jsonify({"error": str(ex)}), 400
+
+        # Store the upload durably in the spool before acknowledging it (survives a restart),
+        # then queue the image for the inference workers, or refuse it if the queue is full
+        respond_async = wants_async_response()
+        try:
+            spool_id = await spool_upload(filename, file_content, meter)
+            job = await submit_spooled_upload(filename, file_content, spool_id, meter, client_waiting=not respond_async)
+        except QueueFull as ex:
+            logger.warning("Upload of %s refused: %s", filename, ex)
+            return jsonify({"error": str(ex)}), 429, {"Retry-After": str(ex.retry_after)}
+        except RuntimeError as ex:
+            logger.warning("Upload of %s refused: %s", filename, ex)
+            return jsonify({"error": str(ex)}), 429, {"Retry-After": str(job_queue.retry_after())}
+
+        if respond_async:
+            # Answer right away, the client polls /jobs/<id> (or listens on the WebSocket) for the result
+            status_url = url_for("get_job", job_id=job.id)
+            return jsonify({**job.to_dict(), "status_url": status_url}), 202, {"Location": status_url}
+
+        # Wait for the job; shielded so a disconnecting client does not cancel the shared future
+        try:
+            result = await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            job.cancel("client disconnected")  # Nobody waits for the result anymore: abort between two stages
+            raise
+        except JobAborted as ex:
+            logger.warning("Upload of %s not processed: %s", filename, ex)
+            status = 504 if ex.reason == TIMEOUT else 503
+            return jsonify({"error": str(ex), "job_id": job.id}), status, {"Retry-After": str(job_queue.retry_after())}
+        except ValueError as ex:
+            logger.warning("Upload of %s not processed: %s", filename, ex)
+            return jsonify({"error": str(ex), "job_id": job.id}), 400
         except Exception as ex:
-            logger.error("Error saving file: %s", ex)
-            return jsonify({"error:":  "Failed to save file"}), 500
-
-        # Process the image (this now handles MongoDB interaction)
-        file_name_image, detected_number = await process_image(filepath)
-
-        return jsonify({"message" : f"File received {file_name_image} - Value {detected_number}"}), 200
+            logger.error("Upload of %s failed: %s", filename, ex)
+            if spool_id is not None:
+                # Kept in the spool and retried later (see run_upload_job): the client must not send it again
+                return jsonify({"message": f"File received {filename} - processing failed, retried later",
+                                "error": str(ex), "job_id": job.id}), 202
+            return jsonify({"error": str(ex), "job_id": job.id}), 503, {"Retry-After": str(job_queue.retry_after())}
+        if result.get("processed_elsewhere"):
+            return jsonify({"message": f"File received {filename} - processed by another worker"}), 200
+        return jsonify({"message" : f"File received {result['file_name_image']} - Value {result['value']}"}), 200
     except Exception as ex:
         logger.error("Error uploading file: %s", ex)
         return jsonify({"error": str(ex)}), 400
     
 
+@app.route("/files", methods=["POST"])
+async def handle_batch_upload():
+    """
+    Handle batch uploads: many images in one request, e.g. to backfill a day of camera images.
+
+    Expected Input: A multipart/form-data request with any number of files, or a tar (.tar, .tar.gz, ...)
+                    or zip archive as the request body (Content-Type application/x-tar, application/gzip,
+                    application/zip, ...). Files that are not images are skipped.
+                    The images are routed to the meter named by the header "Meters: header", else by
+                    their file name, else to the default meter.
+    Response: Newline delimited JSON (application/x-ndjson), streamed while the batch is processed:
+              one job status per image, in the order the images are processed, then a summary line.
+              With "?async=true" (or "Prefer: respond-async") the job statuses are sent as soon as the
+              images are queued, the results are available from /jobs/<job_id>.
+    """
+    try:
+        files = batch.iter_uploaded_files(request.mimetype, request.mimetype_params, request.body,
+                                          max_file_size=batch_max_file_size,
+                                          zip_memory_size=batch_zip_memory_size,
+                                          body_timeout=request.body_timeout)
+    except batch.UnsupportedBatch as ex:
+        return jsonify({"error": str(ex)}), 415
+    try:
+        batch_meter = meter_registry.get(request.headers.get(meter_registry.header)) \
+            if meter_registry.header and request.headers.get(meter_registry.header) else None
+    except UnknownMeter as ex:
+        return jsonify({"error": str(ex)}), 400
+
+    respond_async = wants_async_response()
+    # Without the spool, the images of a batch are held in memory until processed: bound how many
+    in_flight = asyncio.Semaphore(batch_max_in_flight)
+
+    async def submit_batch_file(filename, file_content):
+        meter = batch_meter or meter_registry.from_filename(filename) or meter_registry.default
+        if upload_spool is not None:
+            if await asyncio.to_thread(upload_spool.is_full):
+                raise RuntimeError("Upload spool is full")
+            spool_id = await asyncio.to_thread(upload_spool.append, filename, file_content, {"meter": meter.id})
+            return submit_upload(filename, file_content, spool_id=spool_id, lane=BULK, meter_id=meter.id)
+        await in_flight.acquire()
+        job = job_queue.submit(filename, {"data": file_content, "meter": meter.id,
+                                          "request_id": custom_logger.request_id.get()}, overflow=True, lane=BULK)
+        job.future.add_done_callback(lambda _: in_flight.release())
+        return job
+
+    @stream_with_context
+    async def results():
+        lines = asyncio.Queue()
+        summary = {"files": 0, "queued": 0, "done": 0, "failed": 0}
+        waited_jobs = []  # Jobs whose result is streamed to the client
+
+        def report(job):
+            lines.put_nowait(job.to_dict())
+
+        async def submit_files():
+            # Extract and queue the images while the body is received, then tell how many lines to expect
+            error = None
+            try:
+                async for filename, file_content, file_error in files:
+                    summary["files"] += 1
+                    if file_error is None:
+                        try:
+                            job = await submit_batch_file(filename, file_content)
+                        except Exception as ex:
+                            file_error = str(ex)
+                    if file_error is not None:
+                        logger.warning("Batch upload: %s refused: %s", filename, file_error)
+                        lines.put_nowait({"filename": filename, "status": "failed", "error": file_error})
+                        continue
+                    if respond_async:
+                        lines.put_nowait({**job.to_dict(), "status_url": url_for("get_job", job_id=job.id)})
+                    else:
+                        waited_jobs.append(job)
+                        job.future.add_done_callback(lambda _, job=job: report(job))
+            except Exception as ex:
+                logger.error("Error reading batch upload: %s", ex)
+                error = str(ex)
+            lines.put_nowait({"end": summary["files"], "error": error})
+
+        producer = asyncio.ensure_future(submit_files())
+        try:
+            expected, received, error = None, 0, None
+            while expected is None or received < expected:
+                line = await lines.get()
+                if "end" in line:
+                    expected, error = line["end"], line["error"]
+                    continue
+                received += 1
+                summary[line["status"]] = summary.get(line["status"], 0) + 1
+                yield json.dumps(line) + "\n"
+            yield json.dumps({"summary": summary, "error": error}) + "\n"
+        finally:
+            producer.cancel()
+            for job in waited_jobs:
+                job.cancel("client disconnected")  # No-op for the finished jobs
+
+    logger.info("Batch upload started (%s)", request.mimetype)
+    response = Response(results(), mimetype="application/x-ndjson")
+    response.timeout = None  # A batch may take longer than the default response timeout
+    return response
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+async def get_job(job_id):
+    """
+    Fetch the status (and the result, once done) of an upload job.
+
+    Returns:
+        JSON job status, or 404 if the job is unknown (or finished too long ago).
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/meters", methods=["GET"])
+async def get_meters():
+    """
+    List the configured meters, with the last result processed for each of them (by this worker process).
+    """
+    return jsonify({"default": meter_registry.default.id, "meters": [meter.to_dict() for meter in meter_registry]})
+
+
+@app.route("/metrics", methods=["GET"])
+async def get_metrics():
+    """
+    Export the metrics of this process (job counts and durations, aborted jobs, queue depth, ...)
+    in the Prometheus text format.
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+async def stream_image(filename, as_attachment=False):
+    """
+    Stream an image from MongoDB (GridFS) to the client, one GridFS chunk at a time.
+
+    Supports single "Range" requests (206 Partial Content), so memory used per request
+    stays at roughly one chunk regardless of the size of the file.
+
+    Args:
+        filename (str): Name of the file stored in GridFS.
+        as_attachment (bool): Send a "Content-Disposition: attachment" header.
+
+    Returns:
+        Response: Streaming response, or an error response.
+    """
+    try:
+        grid_out = await asyncio.to_thread(db_handler.open_image, filename)
+    except FileNotFoundError:
+        abort(404)  # Image not found
+
+    file_size = grid_out.length
+    content_type = grid_out.content_type or mimetypes.guess_type(filename)[0] or "image/jpeg"
+
+    # Files stored on the local filesystem are served from disk, without copying them through Python
+    if getattr(grid_out, "path", None):
+        grid_out.close()
+        return await send_local_file(grid_out.path, filename, content_type, as_attachment)
+    headers = {"ETag": f'"{grid_out._id}"'}
+    if grid_out.upload_date:
+        headers["Last-Modified"] = http_date(grid_out.upload_date)
+    if as_attachment:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+
+    return streaming.file_response(grid_out, file_size, request.headers.get("Range"), content_type, headers,
+                                   chunk_size=grid_out.chunk_size)
+
+
+async def send_local_file(path, filename, content_type, as_attachment=False):
+    """
+    Send a file stored by the filesystem storage backend.
+
+    When "Storage: sendfile_header" is configured (e.g. X-Accel-Redirect for nginx, X-Sendfile for Apache),
+    only the header is returned and the reverse proxy sends the file with sendfile (zero-copy).
+    Otherwise the file is streamed from disk by Quart, which also answers Range requests.
+
+    Args:
+        path (str): Path of the file on disk.
+        filename (str): Name of the file, as requested by the client.
+        content_type (str): MIME type of the file.
+        as_attachment (bool): Send a "Content-Disposition: attachment" header.
+    """
+    if sendfile_header:
+        headers = {sendfile_header: f"{sendfile_prefix}{db_handler.store.relative_path(path)}"}
+        if as_attachment:
+            headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return Response("", headers=headers, mimetype=content_type)
+
+    return await send_file(
+        path,
+        mimetype=content_type,
+        as_attachment=as_attachment,
+        attachment_filename=filename,
+        conditional=True
+    )
+
+
 @app.route("/download/<filename>")
-def download_file(filename):  # Removed async
+async def download_file(filename):
     """
     Download a specific file from the MONOGDB server.
 
@@ -230,16 +1054,9 @@ def download_file(filename):  # Removed async
     if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
         abort(404)
     try:
-        image_document = db_handler.get_image_data(filename)
-        if image_document:
-            return send_file(  
-                io.BytesIO(image_document['data']),
-                mimetype='image/jpeg',  # Adjust mimetype if necessary
-                as_attachment=True,
-                attachment_filename=filename
-            )
-        else:
-            abort(404)  # Image not found
+        return await stream_image(filename, as_attachment=True)
+    except HTTPException:
+        raise
     except Exception as ex:
         logger.error("Error downloading file: %s", ex)
         abort(500)
@@ -248,57 +1065,177 @@ def download_file(filename):  # Removed async
 @app.route('/image/<filename>')
 async def get_image(filename):
     """
-    Retrieves an image from MongoDB (GridFS) and sends it to the client.
+    Streams an image from MongoDB (GridFS) to the client.
 
     Returns:
-        JSON metadata details.
+        The image (or the requested byte range of it).
     """
     try:
-        # Retrieve image binary data and content type
-        image_data, content_type = db_handler.get_image_data(filename)
-        
-        # Return the binary data as an image response
-        return await send_file(
-            io.BytesIO(image_data),  # Convert binary data to file-like object
-            mimetype=content_type,   # Use dynamic content type
-            as_attachment=False,     # Ensures it displays in browser
-            attachment_filename=filename
-        )
-    except FileNotFoundError:
-        return abort(404)  # Image not found
+        return await stream_image(filename, as_attachment=False)
+    except HTTPException:
+        raise
     except Exception as ex:
         logger.error("Error retrieving image: %s", ex)
         return abort(500)
 
+@app.route("/thumbnail/<filename>")
+async def get_thumbnail(filename):
+    """
+    Send the thumbnail of the counter detected on an image (stored inline in the metadata).
+
+    Returns:
+        The JPEG thumbnail, or 404 if the image has none.
+    """
+    metadata = await asyncio.to_thread(db_handler.get_metadata_by_filename, filename, fields=["detected_thumbnail"])
+    thumbnail = (metadata or {}).get("detected_thumbnail") or ""
+    if not thumbnail.startswith("data:image/jpeg;base64,"):
+        abort(404)
+    response = Response(base64.b64decode(thumbnail.split(",", 1)[1]), mimetype="image/jpeg")
+    response.cache_control.max_age = 3600
+    return response
+
+
+def send_cached(entry):
+    """
+    Send a response from the response cache: 304 Not Modified if the client already has it (ETag),
+    otherwise compressed with the best encoding the client accepts.
+
+    Args:
+        entry (CachedResponse): The cached response.
+    """
+    headers = {"ETag": entry.etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if request.if_none_match.contains_weak(entry.etag[3:-1]):
+        return Response(status=304, headers=headers)
+    coding = entry.select_encoding(request.headers.get("Accept-Encoding"))
+    if coding:
+        headers["Content-Encoding"] = coding
+    return Response(entry.encoded(coding), headers=headers, mimetype=entry.mimetype)
+
+
 @app.route("/metadata", methods=["GET"])
 async def get_metadata():
     """
-    Fetch metadata grouped by filename.
+    Fetch the metadata, most recent first.
+
+    Without `after` and `limit`, returns the 16 most recent entries as a JSON object keyed by filename (the original
+    format of this route). With one of them, returns one page of entries.
+
+    Query parameters:
+        after (str): Cursor returned as `next_cursor` by the previous page.
+        limit (int): Number of entries per page (default: 16).
+        fields (str): Comma separated list of fields to return (default: all).
+        since (ISO 8601 date): Only return entries processed at or after this date.
+        meter (str): Only return the entries of this meter.
 
     Returns:
-        JSON metadata details.
+        JSON object with the entries keyed by filename, or, when paginated, with the entries (`items`) and the
+        cursor of the next page (`next_cursor`, null on the last page).
     """
     try:
-        grouped_metadata = db_handler.get_grouped_metadata(limit=16)
-        logger.debug("/metadata: Number of items returned from get_grouped_metadata: %i" ,len(grouped_metadata))
-        return jsonify(grouped_metadata)
+        fields = [field.strip() for field in request.args.get("fields", "").split(",") if field.strip()]
+        since = parse_query_datetime(request.args.get("since"))
+        after = request.args.get("after")
+        paginated = "after" in request.args or "limit" in request.args
+        limit = request.args.get("limit", 16, type=int)
+        meter_id = request.args.get("meter") or None
+        if meter_id:
+            meter_registry.get(meter_id)  # UnknownMeter (400)
+
+        async def render():
+            items, next_cursor = await asyncio.to_thread(
+                db_handler.get_metadata_page,
+                after=after,
+                limit=limit,
+                fields=fields,
+                since=since,
+                meter=meter_id,
+                include_untagged=meter_id == meter_registry.default.id,
+            )
+            logger.debug("/metadata: Number of items returned from get_metadata_page: %i", len(items))
+            if not paginated:
+                return app.json.dumps({item["filename"]: item for item in items})
+            return app.json.dumps({"items": items, "next_cursor": next_cursor})
+
+        # Served from the cache until an upload is processed or entries are pruned
+        key = ("metadata", paginated, after, limit, tuple(fields), since, meter_id)
+        entry = await response_cache.get(key, render, "application/json")
+        return send_cached(entry)
+    except ValueError as ex:
+        return jsonify({"error": str(ex)}), 400
     except Exception as ex:
         logger.error("Error in /metadata route: %s", ex)
         return jsonify({"error": str(ex)}), 500
 
+@app.route("/readings", methods=["GET"])
+async def get_readings():
+    """
+    Fetch the consumption of a meter, aggregated per hour or per day.
+
+    Query parameters:
+        from (ISO 8601 date): Start of the period. Defaults to 24 hours before `to`.
+        to (ISO 8601 date): End of the period. Defaults to now.
+        bucket (str): "hour" (default) or "day".
+        meter (str): Id (or device_id) of the meter. Defaults to the default meter.
+
+    Returns:
+        JSON list of rollups, answered from the pre-aggregated collection.
+    """
+    try:
+        end = parse_query_datetime(request.args.get("to")) or datetime.now(tz=timezone.utc)
+        start = parse_query_datetime(request.args.get("from")) or end - timedelta(days=1)
+        bucket = request.args.get("bucket", "hour")
+        # The readings are stored under the device_id of the meter
+        meter_id = request.args.get("meter")
+        if meter_id in meter_registry.meters or not meter_id:
+            meter_id = meter_registry.get(meter_id).device_id
+
+        readings = await asyncio.to_thread(db_handler.get_readings, meter_id, start, end, bucket)
+        return jsonify({
+            "meter_id": meter_id,
+            "bucket": bucket,
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "readings": readings
+        })
+    except ValueError as ex:
+        return jsonify({"error": str(ex)}), 400
+    except Exception as ex:
+        logger.error("Error in /readings route: %s", ex)
+        return jsonify({"error": str(ex)}), 500
+
+
+def parse_query_datetime(value):
+    """
+    Parse an ISO 8601 date from a query parameter (naive dates are taken as UTC).
+
+    Returns:
+        datetime or None if the parameter is not set.
+    """
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"Invalid date '{value}', expected ISO 8601 format")
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
 @app.route("/prune_db", methods=["POST"])
 async def prune_db():
     """
     Handle database pruning requests.
 
     This route is used for clearing unnecessary data from the database.
+    It runs the retention policies defined in config.yaml once, outside of the schedule.
     """
     try:
-        result = db_handler.prune_old_entries(retain_count=16)
+        result = await asyncio.to_thread(retention_engine.run_once)
+        event_bus.publish({"type": "invalidate"})
         return jsonify({
             "message": "Database pruned successfully",
             "deleted_metadata_count": result["deleted_metadata_count"],
-            "deleted_files_count": result["deleted_files_count"]
+            "deleted_files_count": result["deleted_files_count"],
+            "reclaimed_bytes": result["reclaimed_bytes"]
         })
     except Exception as ex:
         logger.error("Error in /prune_db route: %s", ex)
@@ -315,11 +1252,15 @@ async def info():
     base_url = request.url_root
     ws_url = f"{base_url.replace('http', 'ws')}ws"
 
-    # Fetch the latest 16 image metadata entries from MongoDB
-    grouped_metadata = db_handler.get_grouped_metadata(limit=16)
-    logger.debug("Before rendering: Number of items found in MongoDB: %i", len(grouped_metadata))
+    async def render():
+        # Fetch the first page of image metadata entries from MongoDB, inlined in the page
+        items, next_cursor = await asyncio.to_thread(db_handler.get_metadata_page, limit=16)
+        logger.debug("Before rendering: Number of items found in MongoDB: %i", len(items))
+        return await render_template("index.html", item_list=items, next_cursor=next_cursor, ws_url=ws_url)
 
-    return await render_template("index.html", item_list=grouped_metadata, ws_url=ws_url)
+    # Served from the cache until an upload is processed or entries are pruned
+    entry = await response_cache.get(("index", ws_url), render, "text/html")
+    return send_cached(entry)
 
 
 @app.route('/shutdown', methods=['POST'])
@@ -356,7 +1297,15 @@ async def ws():
     This route establishes WebSocket communication for real-time updates.
     """
     logger.debug("Adding a WebSocket client...")
-    clients.add(websocket)  # Add the current WebSocket connection
+    client_queue = asyncio.Queue(maxsize=ws_queue_size)
+    clients.add(client_queue)  # Events for this connection are queued here by broadcast()
+
+    async def send_events():
+        while True:
+            event = await client_queue.get()
+            await websocket.send_json(event)
+
+    sender = asyncio.ensure_future(copy_current_websocket_context(send_events)())
     try:
         while True:
             await websocket.receive()  # Keep the connection alive
@@ -364,7 +1313,8 @@ async def ws():
         logger.warning("WebSocket error: %s", ex)
     finally:
         # Remove the WebSocket connection from the set when it disconnects
-        clients.discard(websocket)
+        sender.cancel()
+        clients.discard(client_queue)
         logger.debug("WebSocket client removed.")
 
 
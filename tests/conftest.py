@@ -0,0 +1,165 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Shared fixtures of the tests:
+#   - event_loop_thread: an asyncio loop running in a background thread (the MQTT clients use threads)
+#   - broker: the MQTT stand-in broker (helpers/mqtt_standin_broker.py), on a free port
+#   - make_config: writes a config.yaml with the given sections and returns its ConfigLoader
+#   - make_mqtt_client: HomeAssistant_MQTT_Client connected to the stand-in broker
+#
+# Run from the root of the repository:
+#    >python -m pytest tests
+#
+import os
+import sys
+import time
+import asyncio
+import itertools
+import threading
+
+import pytest
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers import config
+from helpers.mqtt_client import HomeAssistant_MQTT_Client
+from helpers.mqtt_standin_broker import StandinBroker
+
+_client_ids = itertools.count()
+
+
+def wait_until(condition, timeout=10.0):
+    """Polls `condition` until it is true (returns True) or the timeout (returns False)."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+class LoopThread:
+    """asyncio loop running in a background thread, for the code under test that runs in threads."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="test-loop", daemon=True)
+        self._thread.start()
+
+    def run(self, coro, timeout=10):
+        """Runs a coroutine on the loop and returns its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+        self.loop.close()
+
+
+@pytest.fixture
+def event_loop_thread():
+    loop_thread = LoopThread()
+    yield loop_thread
+    loop_thread.stop()
+
+
+class BrokerControl:
+    """
+    Stand-in broker running on the loop of a LoopThread.
+
+    Attributes:
+        current: The running StandinBroker (a new instance after every restart).
+        port: Port of the broker, kept across restarts.
+    """
+
+    def __init__(self, loop_thread):
+        self.loop_thread = loop_thread
+        self.current = StandinBroker(port=0)
+        loop_thread.run(self.current.start())
+        self.port = self.current.port
+
+    def stop(self):
+        """Stops the broker, dropping the connections (as a crash would)."""
+        self.loop_thread.run(self.current.stop())
+
+    def start(self, **kwargs):
+        """Starts a new broker on the same port (kwargs: see StandinBroker)."""
+        self.current = StandinBroker(port=self.port, **kwargs)
+        self.loop_thread.run(self.current.start())
+        return self.current
+
+    def received(self, topic):
+        """Payloads received by the current broker on a topic, in order."""
+        return [payload for received_topic, payload, _, _ in self.current.received if received_topic == topic]
+
+    def wait_for(self, topic, count=1, timeout=10.0):
+        """Waits until the broker received `count` messages on a topic, and returns their payloads."""
+        wait_until(lambda: len(self.received(topic)) >= count, timeout)
+        return self.received(topic)
+
+
+@pytest.fixture
+def broker(event_loop_thread):
+    control = BrokerControl(event_loop_thread)
+    yield control
+    control.stop()
+
+
+@pytest.fixture
+def make_config(tmp_path, monkeypatch):
+    """Factory: make_config({"MQTT": {...}, ...}) returns a ConfigLoader of a config.yaml holding these sections."""
+
+    def factory(sections):
+        path = tmp_path / "config.yaml"
+        path.write_text(yaml.safe_dump(sections))
+        monkeypatch.setenv("CONFIG_FILE", str(path))
+        return config.ConfigLoader()
+
+    return factory
+
+
+class MQTTClientFactory:
+    """Creates HomeAssistant_MQTT_Clients connected to the stand-in broker, and stops them."""
+
+    def __init__(self, broker, make_config, directory):
+        self.broker = broker
+        self.make_config = make_config
+        self.directory = directory
+        self.clients = []
+
+    def __call__(self, sections=None, **mqtt_settings):
+        """Returns a connected client. `sections`: other sections of config.yaml, kwargs: "MQTT" settings."""
+        settings = {
+            "broker": "127.0.0.1",
+            "port": self.broker.port,
+            "topic": "homeassistant/sensor",
+            "qos": 1,
+            "client_id": f"test-client-{next(_client_ids)}",
+            "last_value_directory": str(self.directory / "last_values"),
+            "reconnect_min_seconds": 1,
+            "reconnect_max_seconds": 1,
+            **mqtt_settings,
+        }
+        client = HomeAssistant_MQTT_Client(self.make_config({**(sections or {}), "MQTT": settings}))
+        assert client.connected_event.is_set(), "Not connected to the stand-in broker"
+        self.clients.append(client)
+        return client
+
+    @staticmethod
+    def stop(client):
+        """Stops the network thread without waiting for the acknowledgements (as a crash would)."""
+        if client.client is not None:
+            client.client.disconnect()
+            client.client.loop_stop()
+            client.client = None
+            client.outbound.close()
+            client.last_values.close()
+
+
+@pytest.fixture
+def make_mqtt_client(broker, make_config, tmp_path):
+    factory = MQTTClientFactory(broker, make_config, tmp_path)
+    yield factory
+    for client in factory.clients:
+        factory.stop(client)
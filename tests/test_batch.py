@@ -0,0 +1,41 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Tests of the naming of the files of a batch upload (helpers/batch.py): files of different folders with the
+# same name, and names lost when secured, get unique names instead of overwriting each other.
+#
+import io
+import asyncio
+import zipfile
+
+from helpers import batch
+
+
+def extract_zip(members):
+    """Names of the images extracted from a zip archive holding `members` (name -> content)."""
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        for name, content in members.items():
+            zip_file.writestr(name, content)
+
+    async def body():
+        yield archive.getvalue()
+
+    async def extract():
+        files = batch.iter_uploaded_files("application/zip", {}, body(), max_file_size=1024, zip_memory_size=1024)
+        return [(name, content) async for name, content, _ in files]
+
+    return asyncio.run(extract())
+
+
+def test_same_name_in_different_folders():
+    files = extract_zip({"day1/img.jpg": b"1", "day2/img.jpg": b"2", "notes.txt": b"-"})
+
+    assert files == [("img.jpg", b"1"), ("img_day2.jpg", b"2")]
+
+
+def test_unique_names():
+    names = batch.UniqueNames()
+
+    assert [names(path) for path in ("a/img.jpg", "b/img.jpg", "b/img.jpg", "日本.jpg", "img_b.jpg")] == \
+        ["img.jpg", "img_b.jpg", "img_2.jpg", "image_4.jpg", "img_b_2.jpg"]
@@ -0,0 +1,42 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Tests of the logging shared with forked worker processes (helpers/custom_logger.py): the records of the
+# children are written by the parent, so the rotation of the log file loses none of them.
+#
+import os
+import sys
+import subprocess
+
+SCRIPT = """
+import sys, logging, multiprocessing
+from helpers import custom_logger
+
+ctx = multiprocessing.get_context("fork")
+logger = custom_logger.setup_logging("shared", sys.argv[1], log_level=logging.INFO, max_log_size=4096, backup_count=50)
+custom_logger.share_with_children(ctx)
+
+def child(index):
+    for number in range(200):
+        logger.info("child %i record %i", index, number)
+
+children = [ctx.Process(target=child, args=(index,)) for index in range(3)]
+for process in children:
+    process.start()
+for process in children:
+    process.join()
+logger.info("parent done")
+"""
+
+
+def test_records_of_forked_children_survive_the_rotation(tmp_path):
+    log_file = tmp_path / "shared.log"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", SCRIPT, str(log_file)], cwd=root, check=True, timeout=60,
+                   stderr=subprocess.DEVNULL)
+
+    lines = [line for path in tmp_path.iterdir() for line in path.read_text().splitlines()]
+    assert len([path for path in tmp_path.iterdir()]) > 2  # Rotated
+    for index in range(3):
+        assert len([line for line in lines if f"child {index} record" in line]) == 200
+    assert any(line.endswith("parent done") for line in lines)
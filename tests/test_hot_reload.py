@@ -0,0 +1,69 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Tests of the reload of config.yaml (helpers/hot_reload.py): only the reloadable sections reach the running
+# configuration, the other ones wait for the next restart.
+#
+import asyncio
+
+import pytest
+import yaml
+
+from helpers.hot_reload import HotReloader
+
+WEIGHTS = {"frame": "frame.pt", "counter": "counter.pt", "digits": "digits.pt"}
+
+
+@pytest.fixture
+def sections(tmp_path):
+    for filename in WEIGHTS.values():
+        (tmp_path / filename).write_bytes(b"")
+    return {
+        "YOLO": {"weights_path": str(tmp_path), "weights": dict(WEIGHTS)},
+        "Plausibility": {"tolerance": 1},
+        "MQTT": {"broker": "mqtt.local", "port": 1883},
+    }
+
+
+@pytest.fixture
+def applied():
+    """(config, registry) of every call of the `apply` function of the reloader."""
+    return []
+
+
+@pytest.fixture
+def reloader(sections, make_config, applied):
+    return HotReloader(make_config(sections), registry=lambda: None,
+                       apply=lambda config, registry: applied.append((config, registry)))
+
+
+def save(reloader, sections):
+    with open(reloader.config.config_path, "w") as file:
+        yaml.safe_dump(sections, file)
+
+
+def test_reload_applies_only_the_reloadable_sections(reloader, sections, applied):
+    save(reloader, {**sections, "Plausibility": {"tolerance": 5}, "MQTT": {"broker": "other.local", "port": 1883}})
+
+    assert asyncio.run(reloader.reload()) is True
+    [(config, registry)] = applied
+    assert registry is None  # YOLO and Meters unchanged: the models are kept
+    for live in (config, reloader.config):
+        assert live.get("Plausibility", "tolerance") == 5
+        assert live.get("MQTT", "broker") == "mqtt.local"  # On the next restart
+
+
+def test_reload_without_reloadable_changes_applies_nothing(reloader, sections, applied):
+    save(reloader, {**sections, "MQTT": {"broker": "other.local", "port": 1883}})
+
+    assert asyncio.run(reloader.reload()) is False
+    assert applied == []
+    assert reloader.config.get("MQTT", "broker") == "mqtt.local"
+
+
+def test_invalid_reload_keeps_the_running_configuration(reloader, sections, applied):
+    save(reloader, {**sections, "Plausibility": {"tolerance": -1}})
+
+    assert asyncio.run(reloader.reload()) is False
+    assert applied == []
+    assert reloader.config.get("Plausibility", "tolerance") == 1
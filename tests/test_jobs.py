@@ -0,0 +1,240 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Tests of the job queue (helpers/jobs.py): admission (QueueFull with the Retry-After estimate, overflow),
+# the errors of the handler passed on to the client waiting for the job, the deadlines (expired in the
+# queue or during a stage, cancellation), and the weighted sharing of the workers between the priority lanes.
+#
+import time
+import asyncio
+
+import pytest
+
+from helpers.jobs import JobQueue, QueueFull, Deadline, JobAborted, DONE, FAILED, BULK, INTERACTIVE, TIMEOUT, CANCELLED
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class Handler:
+    """Job handler waiting on a gate, recording the order the jobs are started in."""
+
+    def __init__(self):
+        self.started = []
+        self.gate = asyncio.Event()
+
+    async def __call__(self, job):
+        self.started.append(job.filename)
+        await self.gate.wait()
+        return {"file_name_image": job.filename}
+
+
+def test_queue_full_is_refused_with_a_retry_after():
+    async def scenario():
+        handler = Handler()
+        job_queue = JobQueue(handler, workers=1, max_queue=2)
+        job_queue.start()
+        running = job_queue.submit("running.jpg", {})
+        await asyncio.sleep(0.01)  # Started: not counted in the queue
+        queued = [job_queue.submit(f"{index}.jpg", {}) for index in range(2)]
+        assert job_queue.full()
+
+        with pytest.raises(QueueFull) as refused:
+            job_queue.submit("refused.jpg", {})
+        assert refused.value.retry_after == job_queue.retry_after() == 3  # (2 queued + 1) x 1 second, 1 worker
+        assert not job_queue.full(BULK)  # Lanes are bounded separately
+
+        overflow = job_queue.submit("overflow.jpg", {}, overflow=True)  # Held outside of memory by the caller
+        assert job_queue.lane_depth(INTERACTIVE) == 3
+
+        handler.gate.set()
+        results = await asyncio.gather(*(job.future for job in [running, *queued, overflow]))
+        await job_queue.stop()
+        return results, [job.status for job in [running, *queued, overflow]]
+
+    results, statuses = run(scenario())
+    assert [result["file_name_image"] for result in results] == ["running.jpg", "0.jpg", "1.jpg", "overflow.jpg"]
+    assert statuses == [DONE] * 4
+
+
+def test_retry_after_follows_the_job_durations():
+    job_queue = JobQueue(Handler(), workers=2)
+    job_queue._average_duration = 10.0
+    assert job_queue.retry_after() == 5  # (0 queued + 1) x 10 seconds / 2 workers
+    assert job_queue.retry_after(BULK) == 10  # The bulk lane runs on 1 worker at a time
+
+
+def test_handler_error_is_passed_on_to_the_waiting_client():
+    async def handler(job):
+        raise ValueError("File is not a valid image")
+
+    async def scenario():
+        job_queue = JobQueue(handler)
+        job_queue.start()
+        job = job_queue.submit("invalid.jpg", {})
+        with pytest.raises(ValueError):
+            await job.future
+        await job_queue.stop()
+        return job
+
+    job = run(scenario())
+    assert job.error == "File is not a valid image"
+
+
+def test_deadline_check():
+    deadline = Deadline(0.05)
+    deadline.check("decode")  # Not expired yet
+    time.sleep(0.06)
+    with pytest.raises(JobAborted) as aborted:
+        deadline.check("persist")
+    assert (aborted.value.reason, aborted.value.stage) == (TIMEOUT, "persist")
+
+    Deadline(None).check("persist")  # No deadline
+
+
+def test_deadline_expiring_during_a_stage():
+    async def scenario():
+        deadline = Deadline(0.05)
+        with pytest.raises(JobAborted) as aborted:
+            await deadline.run("frame", time.sleep, 0.3)  # The thread finishes on its own, its result is dropped
+        return aborted.value
+
+    started = time.monotonic()
+    aborted = run(scenario())
+    assert (aborted.reason, aborted.stage) == (TIMEOUT, "frame")
+    assert time.monotonic() - started < 0.3 + 0.2
+
+
+def test_worker_waits_for_an_abandoned_stage_before_the_next_job():
+    async def scenario():
+        events = []
+
+        def stage(filename, seconds):
+            events.append(f"{filename} start")
+            time.sleep(seconds)
+            events.append(f"{filename} end")
+
+        async def handler(job):
+            await job.deadline.run("frame", stage, job.filename, 0.2 if job.filename == "slow.jpg" else 0)
+
+        job_queue = JobQueue(handler, workers=1, deadline_seconds=0.05)
+        job_queue.start()
+        slow = job_queue.submit("slow.jpg", {})
+        with pytest.raises(JobAborted):
+            await slow.future  # Aborted at the deadline, while the stage still runs
+        aborted_at = list(events)
+        following = job_queue.submit("next.jpg", {}, lane=BULK)  # Deadline counted from its start
+        await following.future
+        await job_queue.stop()
+        return aborted_at, events
+
+    aborted_at, events = run(scenario())
+    assert aborted_at == ["slow.jpg start"]
+    assert events == ["slow.jpg start", "slow.jpg end", "next.jpg start", "next.jpg end"]
+
+
+def test_job_expired_in_the_queue_is_not_started():
+    async def scenario():
+        handler = Handler()
+
+        async def handle(job):
+            if job.filename == "late.jpg":
+                job.deadline.check("decode")  # As run_upload_job does before its first stage
+            return await handler(job)
+
+        job_queue = JobQueue(handle, workers=1, deadline_seconds=0.05)
+        job_queue.start()
+        first = job_queue.submit("first.jpg", {})
+        late = job_queue.submit("late.jpg", {})  # The deadline counts from the submission (interactive lane)
+        await asyncio.sleep(0.1)
+        handler.gate.set()
+        await first.future
+        with pytest.raises(JobAborted) as aborted:
+            await late.future
+        await job_queue.stop()
+        return late, aborted.value
+
+    late, aborted = run(scenario())
+    assert (aborted.reason, aborted.stage) == (TIMEOUT, "decode")
+    assert late.status == FAILED
+
+
+def test_cancelled_job_is_aborted_between_stages():
+    async def scenario():
+        stages = []
+
+        async def handler(job):
+            for stage in ("frame", "counter", "digits"):
+                await job.deadline.run(stage, time.sleep, 0.05)
+                stages.append(stage)
+
+        job_queue = JobQueue(handler)
+        job_queue.start()
+        job = job_queue.submit("image.jpg", {})
+        await asyncio.sleep(0.07)  # In the second stage
+        job.cancel("client disconnected")
+        with pytest.raises(JobAborted) as aborted:
+            await job.future
+        await job_queue.stop()
+        return stages, aborted.value
+
+    stages, aborted = run(scenario())
+    assert stages == ["frame"]
+    assert (aborted.reason, aborted.stage) == (CANCELLED, "counter")
+
+
+def start_order(workers, jobs, lanes=None):
+    """
+    Queues `jobs` ((filename, lane) tuples) while the workers are busy, then lets them run.
+    Returns the filenames in the order the jobs were started, and the maximum number of bulk jobs running at once.
+    """
+    async def scenario():
+        started, running, max_bulk = [], {BULK: 0}, [0]
+        gate = asyncio.Event()
+
+        async def handler(job):
+            started.append(job.filename)
+            if job.lane == BULK:
+                running[BULK] += 1
+                max_bulk[0] = max(max_bulk[0], running[BULK])
+            await gate.wait()
+            await asyncio.sleep(0.001)
+            if job.lane == BULK:
+                running[BULK] -= 1
+
+        job_queue = JobQueue(handler, workers=workers, max_queue=100, lanes=lanes)
+        job_queue.start()
+        blockers = [job_queue.submit(f"blocker-{index}", {}) for index in range(workers)]
+        await asyncio.sleep(0.01)
+        queued = [job_queue.submit(filename, {}, lane=lane) for filename, lane in jobs]
+        gate.set()
+        await asyncio.gather(*(job.future for job in blockers + queued))
+        await job_queue.stop()
+        return started[workers:], max_bulk[0]
+
+    return run(scenario())
+
+
+def test_lanes_share_the_workers_by_weight():
+    jobs = [(f"i{index}", INTERACTIVE) for index in range(8)] + [(f"b{index}", BULK) for index in range(3)]
+    order, _ = start_order(1, jobs)
+
+    # Weights 4 and 1: one bulk job started for every four interactive ones, each lane in its own order
+    # (the bulk lane goes first: the interactive one already had its share, with the blocking job)
+    assert order == ["b0", "i0", "i1", "i2", "i3", "b1", "i4", "i5", "i6", "i7", "b2"]
+
+
+def test_configured_weights():
+    jobs = [(f"i{index}", INTERACTIVE) for index in range(4)] + [(f"b{index}", BULK) for index in range(4)]
+    order, _ = start_order(1, jobs, lanes={BULK: {"weight": 4}})
+
+    assert order == ["b0", "i0", "b1", "i1", "b2", "i2", "b3", "i3"]
+
+
+def test_bulk_lane_concurrency_cap():
+    jobs = [(f"b{index}", BULK) for index in range(4)] + [("i0", INTERACTIVE)]
+    order, max_bulk = start_order(3, jobs)
+
+    assert max_bulk == 1  # "max_concurrency": 1, with 3 workers
+    assert order.index("i0") <= 1  # Not queued behind the backfill
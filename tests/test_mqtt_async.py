@@ -0,0 +1,98 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Tests of the asyncio MQTT client (helpers/mqtt_async.py), against the stand-in broker: start() not waiting
+# for the broker, the reconnection, and send_value(wait=True) returning on the acknowledgement, the timeout
+# or when the message is dropped from the full outbound queue.
+#
+import asyncio
+import json
+import time
+
+import pytest
+
+from conftest import wait_until
+from helpers.mqtt_async import AsyncHomeAssistant_MQTT_Client
+
+STATE_TOPIC = "homeassistant/sensor/test_meter/state"
+
+
+def values(payloads):
+    return [json.loads(payload)["value"] for payload in payloads]
+
+
+@pytest.fixture
+def make_async_client(broker, make_config, event_loop_thread, tmp_path):
+    """Factory: returns a started AsyncHomeAssistant_MQTT_Client (kwargs: "MQTT" settings), disconnected afterwards."""
+    clients = []
+
+    def factory(**mqtt_settings):
+        settings = {
+            "broker": "127.0.0.1",
+            "port": broker.port,
+            "topic": "homeassistant/sensor",
+            "qos": 1,
+            "client_id": f"test-async-client-{len(clients)}",
+            "last_value_directory": str(tmp_path / "last_values"),
+            "reconnect_min_seconds": 1,
+            "reconnect_max_seconds": 1,
+            **mqtt_settings,
+        }
+        client = AsyncHomeAssistant_MQTT_Client(make_config({"MQTT": settings}))
+        event_loop_thread.run(client.start())
+        clients.append(client)
+        return client
+
+    yield factory
+    for client in clients:
+        event_loop_thread.run(client.disconnect_mqtt(), timeout=15)
+
+
+def test_start_does_not_wait_for_the_broker(broker, make_async_client):
+    broker.stop()
+    started = time.monotonic()
+    client = make_async_client()
+    assert time.monotonic() - started < 1
+    assert not client.connected_event.is_set()
+
+    broker.start()
+    assert wait_until(client.connected_event.is_set), "Not connected once the broker is up"
+
+
+def test_values_queued_while_disconnected_are_delivered_after_reconnecting(broker, make_async_client, event_loop_thread):
+    client = make_async_client()
+    assert wait_until(client.connected_event.is_set), "Not connected"
+
+    broker.stop()
+    assert wait_until(lambda: not client.connected_event.is_set()), "The client did not notice the disconnection"
+    for value in (1, 2):
+        event_loop_thread.run(client.send_value("test_meter", value))
+    assert len(client.outbound) == 2
+
+    broker.start()
+    assert values(broker.wait_for(STATE_TOPIC, 2)) == [1, 2]
+    assert wait_until(lambda: len(client.outbound) == 0)
+
+
+def test_send_value_waits_for_the_acknowledgement(broker, make_async_client, event_loop_thread):
+    client = make_async_client()
+
+    assert event_loop_thread.run(client.send_value("test_meter", 1, wait=True)) is True
+    assert len(client.outbound) == 0
+
+    broker.current.withhold_acks = True
+    assert event_loop_thread.run(client.send_value("test_meter", 2, wait=True, timeout=0.5)) is False
+    assert len(client.outbound) == 1  # Still queued
+    assert client._ack_waiters == {}
+
+
+def test_send_value_returns_when_its_message_is_dropped(broker, make_async_client, event_loop_thread):
+    broker.stop()
+    client = make_async_client(outbound_max_messages=1)
+    waiting = asyncio.run_coroutine_threadsafe(client.send_value("test_meter", 1, wait=True), event_loop_thread.loop)
+    assert wait_until(lambda: len(client._ack_waiters) == 1)
+
+    event_loop_thread.run(client.send_value("test_meter", 2))  # Drops the first value
+
+    assert waiting.result(timeout=5) is False
+    assert client._ack_waiters == {}
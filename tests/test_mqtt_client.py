@@ -0,0 +1,88 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Tests of the outbound queue of the MQTT client (helpers/mqtt_client.py), against the stand-in broker:
+# delivery after a reconnection, acknowledgements arriving before publish() returns, the SQLite queue
+# keeping the unacknowledged messages across a restart, and the last values re-published with the discovery.
+#
+import json
+import sqlite3
+
+from conftest import wait_until
+
+STATE_TOPIC = "homeassistant/sensor/test_meter/state"
+
+
+def values(payloads):
+    return [json.loads(payload)["value"] for payload in payloads]
+
+
+def test_values_queued_while_disconnected_are_delivered_after_reconnecting(broker, make_mqtt_client):
+    client = make_mqtt_client()
+    client.send_value("test_meter", 1)
+    assert client.wait_for_publish(timeout=5)
+
+    broker.stop()
+    assert wait_until(lambda: not client.connected_event.is_set()), "The client did not notice the disconnection"
+    for value in (2, 3, 4):
+        client.send_value("test_meter", value)
+    assert len(client.outbound) == 3
+
+    broker.start()
+    assert client.wait_for_publish(timeout=10), f"{len(client.outbound)} message(s) not acknowledged"
+    assert values(broker.received(STATE_TOPIC)) == [2, 3, 4]
+
+
+def test_acknowledgement_before_publish_returns(broker, make_mqtt_client):
+    """The broker may acknowledge a message before paho's publish() returned its mid (network thread)."""
+    client = make_mqtt_client()
+    broker.current.withhold_acks = True  # The acknowledgements are sent by the wrapper below instead
+    paho_publish = client.client.publish
+
+    def publish_acknowledged_at_once(*args, **kwargs):
+        info = paho_publish(*args, **kwargs)
+        client.on_publish(client.client, None, info.mid)  # PUBACK handled before the mid is returned
+        return info
+
+    client.client.publish = publish_acknowledged_at_once
+    for value in (1, 2, 3):
+        client.send_value("test_meter", value)
+
+    assert len(client.outbound) == 0
+    assert client._inflight == {}
+    assert client._early_acks == set()
+    assert values(broker.wait_for(STATE_TOPIC, 3)) == [1, 2, 3]
+
+
+def test_unacknowledged_values_survive_a_restart(broker, make_mqtt_client, tmp_path):
+    queue_file = str(tmp_path / "outbox.sqlite")
+    broker.stop()
+    broker.start(withhold_acks=True)
+    client = make_mqtt_client(outbound_queue_file=queue_file)
+    for value in (10, 11):
+        client.send_value("test_meter", value)
+    assert len(broker.wait_for(STATE_TOPIC, 2)) == 2
+    assert len(client.outbound) == 2  # Sent, never acknowledged
+    make_mqtt_client.stop(client)  # The server stops without the acknowledgements
+
+    with sqlite3.connect(queue_file) as db:
+        assert db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 2
+
+    broker.stop()
+    broker.start()
+    client = make_mqtt_client(outbound_queue_file=queue_file)
+    assert client.wait_for_publish(timeout=10), f"{len(client.outbound)} message(s) not acknowledged"
+    assert values(broker.received(STATE_TOPIC)) == [10, 11]
+    with sqlite3.connect(queue_file) as db:
+        assert db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 0
+
+
+def test_discovery_republishes_only_the_meters_with_a_last_value(broker, make_mqtt_client):
+    meters = {"meters": {"electricity": {"device_id": "electricity_meter"}, "gas": {"device_id": "gas_meter"}}}
+    client = make_mqtt_client(sections={"Meters": meters})
+    client.send_value("electricity_meter", 42)
+    client.send_discovery()
+    assert client.wait_for_publish(timeout=5)
+
+    assert values(broker.received("homeassistant/sensor/electricity_meter/state")) == [42, 42]
+    assert broker.received("homeassistant/sensor/gas_meter/state") == []  # Not {"value": null}
@@ -0,0 +1,111 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Tests of the image ingestion over MQTT (helpers/mqtt_ingest.py), against the stand-in broker: raw and JSON
+# payloads, the size limit, refused images, and the results published to the result topic.
+#
+import json
+import base64
+
+import pytest
+import paho.mqtt.client as mqtt
+
+from conftest import wait_until
+from helpers.jobs import JobQueue
+from helpers.mqtt_ingest import MQTTImageIngest
+
+IMAGE = b"\xff\xd8\xff\xe0 not decoded by the tests \xff\xd9"
+METERS = ("electricity", "gas")
+
+
+@pytest.fixture
+def ingest(broker, make_mqtt_client, event_loop_thread):
+    """
+    Ingestion subscribed to meterreader/+/image, queuing the images in a job queue whose handler
+    returns the size of the image as the value (the real one reads the meter, see run_upload_job).
+    """
+    async def handler(job):
+        return {"file_name_image": job.filename, "value": len(job.payload["data"]), "meter": job.payload["meter"]}
+
+    job_queue = JobQueue(handler)
+
+    async def submit(filename, content, meter_id):
+        if meter_id not in METERS:
+            raise ValueError(f"Unknown meter '{meter_id}'")
+        return job_queue.submit(filename, {"data": content, "meter": meter_id})
+
+    client = make_mqtt_client(image_topic="meterreader/+/image", image_max_mb=0.001)  # 1048 bytes
+    instance = MQTTImageIngest.from_config(client.config, client, submit)
+
+    async def start():
+        job_queue.start()
+        instance.start()
+
+    event_loop_thread.run(start())
+    assert wait_until(lambda: broker.current.has_subscriber("meterreader/gas/image")), "Not subscribed"
+    yield instance
+    event_loop_thread.run(job_queue.stop())
+
+
+@pytest.fixture
+def camera(broker):
+    """MQTT client publishing the images, as a camera would."""
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="test-camera")
+    client.connect("127.0.0.1", broker.port)
+    client.loop_start()
+    assert wait_until(client.is_connected), "Camera not connected"
+    yield client
+    client.disconnect()
+    client.loop_stop()
+
+
+def results(broker, meter, count=1):
+    return [json.loads(payload) for payload in broker.wait_for(f"meterreader/{meter}/result", count)]
+
+
+def test_ingestion_is_disabled_by_default(make_mqtt_client):
+    client = make_mqtt_client()
+    assert MQTTImageIngest.from_config(client.config, client, None) is None
+
+
+def test_raw_image_is_queued_for_the_meter_of_the_topic(ingest, camera, broker):
+    camera.publish("meterreader/gas/image", IMAGE)
+
+    [result] = results(broker, "gas")
+    assert result["status"] == "done"
+    assert result["meter"] == "gas"
+    assert result["value"] == len(IMAGE)
+    assert result["filename"].startswith("mqtt_gas_")
+
+
+def test_json_envelope_names_the_meter_and_the_file(ingest, camera, broker):
+    envelope = {"image": base64.b64encode(IMAGE).decode(), "meter": "electricity", "filename": "cam1.jpg"}
+    camera.publish("meterreader/gas/image", json.dumps(envelope))
+
+    [result] = results(broker, "electricity")
+    assert result["status"] == "done"
+    assert result["filename"] == "cam1.jpg"
+    assert result["value"] == len(IMAGE)
+    assert broker.received("meterreader/gas/result") == []
+
+
+@pytest.mark.parametrize("payload, error", [
+    (b"\xff" * 2000, "larger than"),
+    (json.dumps({"image": "not base64!"}).encode(), "Invalid JSON image message"),
+    (json.dumps({"meter": "gas"}).encode(), "Invalid JSON image message"),
+])
+def test_invalid_images_are_refused(ingest, camera, broker, payload, error):
+    camera.publish("meterreader/gas/image", payload)
+
+    [result] = results(broker, "gas")
+    assert result["status"] == "refused"
+    assert error in result["error"]
+    assert result["job_id"] is None
+
+
+def test_image_of_an_unknown_meter_is_refused(ingest, camera, broker):
+    camera.publish("meterreader/water/image", IMAGE)
+
+    [result] = results(broker, "water")
+    assert result["status"] == "refused"
+    assert "Unknown meter 'water'" in result["error"]
@@ -0,0 +1,168 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Tests of the output sinks (helpers/outputs.py): the oldest reading dropped by a sink falling behind, the
+# retries with a backoff, the lines of the file sink, and the webhook retrying once on a stale keep-alive
+# connection (closed by the server while idle).
+#
+import json
+import asyncio
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from helpers import outputs
+from helpers.meters import Meter
+from helpers.plausibility import Reading
+
+TIMESTAMP = datetime(2024, 1, 2, 3, 4, 5, 600000, tzinfo=timezone.utc)
+
+
+def reading(value, meter=None):
+    return Reading(meter or Meter("gas"), value, 0.9, TIMESTAMP, f"{value}.jpg")
+
+
+class RecordingSink(outputs.OutputSink):
+    """Sink recording the delivered values; fails the first `failures` attempts of each reading."""
+
+    def __init__(self, failures=0, **kwargs):
+        super().__init__("test", **kwargs)
+        self.failures = failures
+        self.attempts = {}
+        self.delivered = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def deliver(self, reading):
+        await self.gate.wait()
+        self.attempts[reading.value] = self.attempts.get(reading.value, 0) + 1
+        if self.attempts[reading.value] <= self.failures:
+            raise OSError("unreachable")
+        self.delivered.append(reading.value)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Delays of the backoff, not actually waited."""
+    delays = []
+    sleep = asyncio.sleep
+
+    async def record(delay, *args):
+        delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(outputs.asyncio, "sleep", record)
+    return delays
+
+
+def test_oldest_reading_dropped_when_the_queue_is_full():
+    async def run():
+        sink = RecordingSink(queue_size=2)
+        sink.start()
+        sink.gate.clear()
+        sink.submit(reading(1))
+        await asyncio.sleep(0.01)  # Taken by the worker, which waits on the gate
+        for value in (2, 3, 4):
+            sink.submit(reading(value))
+        sink.gate.set()
+        await sink.stop()
+        return sink.delivered
+
+    assert asyncio.run(run()) == [1, 3, 4]
+
+
+def test_retries_with_backoff_until_max_attempts(sleeps):
+    async def run():
+        sink = RecordingSink(failures=10, max_attempts=4, retry_min_seconds=1, retry_max_seconds=3)
+        sink.start()
+        sink.submit(reading(1))
+        await sink.stop()
+        return sink
+
+    sink = asyncio.run(run())
+    assert sink.attempts == {1: 4}
+    assert sink.delivered == []  # Given up
+    assert sleeps == [1, 2, 3]
+
+
+def test_delivered_after_a_retry(sleeps):
+    async def run():
+        sink = RecordingSink(failures=1, max_attempts=2)
+        sink.start()
+        for value in (1, 2):
+            sink.submit(reading(value))
+        await sink.stop()
+        return sink
+
+    sink = asyncio.run(run())
+    assert sink.delivered == [1, 2]
+    assert sink.attempts == {1: 2, 2: 2}
+
+
+def test_line_protocol_escaping(tmp_path):
+    sink = outputs.FileSink(str(tmp_path / "readings.lp"), measurement="meter reading")
+    meter = Meter("gas,main", device_id="house=1 gas")
+
+    assert sink.format_line(reading(1234, meter)) == (
+        "meter\\ reading,meter=gas\\,main,device_id=house\\=1\\ gas value=1234i,confidence=0.900 "
+        "1704164645600000000\n")
+
+
+def test_csv_header_written_once(tmp_path):
+    path = tmp_path / "out" / "readings.csv"
+
+    async def write(value):
+        sink = outputs.FileSink(str(path), format="csv")
+        await sink.deliver(reading(value))
+        await sink.close()
+
+    asyncio.run(write(1))
+    asyncio.run(write(2))  # Appended to the existing file: no second header
+    assert path.read_text().splitlines() == [
+        "timestamp,meter,device_id,value,confidence,filename",
+        f"{TIMESTAMP.isoformat()},gas,gas,1,0.9,1.jpg",
+        f"{TIMESTAMP.isoformat()},gas,gas,2,0.9,2.jpg",
+    ]
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Keep-alive HTTP/1.1 server closing the connection after its first response, without telling the client."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.received.append(json.loads(body)["value"])
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        self.close_connection = len(self.server.received) == 1  # The client still believes it is kept alive
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def webhook_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), WebhookHandler)
+    server.received = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_webhook_retries_once_on_a_stale_keepalive_connection(webhook_server):
+    sink = outputs.WebhookSink(f"http://127.0.0.1:{webhook_server.server_port}/meter", max_connections=1)
+
+    async def run():
+        await sink.deliver(reading(1))
+        await asyncio.sleep(0.1)  # The server closes the idle connection meanwhile
+        await sink.deliver(reading(2))  # Fails on the stale connection, sent again on a new one
+        await sink.close()
+
+    asyncio.run(run())
+    assert webhook_server.received == [1, 2]
@@ -0,0 +1,124 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Tests of the plausibility filter (helpers/plausibility.py): the checks against the last accepted reading,
+# the new baseline after consistent rejected readings, concurrent readings of a meter checked one at a time,
+# and the coalescing of a burst to its best reading.
+#
+import time
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from helpers.meters import Meter
+from helpers.plausibility import ReadingFilter, DEFAULT_SETTINGS, ACCEPTED, REJECTED
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def at(hours):
+    return START + timedelta(hours=hours)
+
+
+class Published:
+    """Publish function of the filter, keeping the last published reading as the baseline (like the readings store)."""
+
+    def __init__(self):
+        self.readings = []
+
+    async def __call__(self, reading):
+        self.readings.append(reading)
+
+    def last_reading(self, meter):
+        last = self.readings[-1] if self.readings else None
+        return (last.value, last.timestamp) if last else (None, None)
+
+    @property
+    def values(self):
+        return [reading.value for reading in self.readings]
+
+
+@pytest.fixture
+def published():
+    return Published()
+
+
+def make_filter(published, **settings):
+    return ReadingFilter(published, published.last_reading, **settings)
+
+
+@pytest.mark.parametrize("value, hours, settings, rejected", [
+    (100, 1, {}, False),
+    (99, 1, {}, True),                                   # Lower than the last value
+    (99, 1, {"monotonic": False}, False),
+    (106, 1, {"max_rate_per_hour": 5}, False),           # 5 per hour, plus the tolerance of 1
+    (107, 1, {"max_rate_per_hour": 5}, True),
+    (115, 2, {"max_rate_per_hour": 5, "tolerance": 5}, False),
+])
+def test_check(published, value, hours, settings, rejected):
+    reading_filter = make_filter(published)
+    reason = reading_filter.check(value, at(hours), 100, at(0), {**DEFAULT_SETTINGS, **settings})
+    assert (reason is not None) == rejected
+
+
+def test_first_reading_is_accepted(published):
+    assert make_filter(published).check(5, at(0), None, None, DEFAULT_SETTINGS) is None
+
+
+def test_consistent_rejected_readings_become_the_new_baseline(published):
+    meter = Meter("gas")
+    reading_filter = make_filter(published, accept_after=3)
+
+    async def submit(value, hours):
+        return await reading_filter.submit(meter, value, 0.9, at(hours), f"{value}.jpg")
+
+    async def run():
+        assert await submit(1000, 0) == (ACCEPTED, None)
+        assert (await submit(5, 1))[0] == REJECTED        # Meter replaced: starts again from 0
+        assert (await submit(7, 2))[0] == REJECTED
+        assert (await submit(3, 3))[0] == REJECTED        # Lower than the last rejected reading: counts from 1 again
+        assert (await submit(4, 4))[0] == REJECTED
+        assert await submit(6, 5) == (ACCEPTED, None)     # Third consistent rejected reading: new baseline
+        assert await submit(8, 6) == (ACCEPTED, None)
+
+    asyncio.run(run())
+    assert published.values == [1000, 6, 8]
+
+
+def test_concurrent_readings_are_checked_one_after_the_other(published):
+    meter = Meter("gas")
+    stale = (100, START)
+
+    def last_reading(meter):
+        time.sleep(0.05)  # The store still has the baseline from before both readings
+        return stale
+
+    reading_filter = ReadingFilter(published, last_reading)
+
+    async def run():
+        return await asyncio.gather(reading_filter.submit(meter, 150, 0.9, at(1), "150.jpg"),
+                                    reading_filter.submit(meter, 120, 0.9, at(1), "120.jpg"))
+
+    verdicts = asyncio.run(run())
+    assert [verdict for verdict, _ in verdicts] == [ACCEPTED, REJECTED]  # 120 is checked against 150
+    assert published.values == [150]
+
+
+def test_burst_publishes_its_most_confident_reading(published):
+    meter = Meter("gas")
+    reading_filter = make_filter(published, coalesce_seconds=0.1)
+
+    async def run():
+        for value, confidence in ((10, 0.8), (11, 0.95), (12, 0.6)):
+            assert await reading_filter.submit(meter, value, confidence, START, f"{value}.jpg") == (ACCEPTED, None)
+        assert published.values == []  # Published at the end of the window
+        await asyncio.sleep(0.2)
+        assert published.values == [11]
+
+        await reading_filter.submit(meter, 13, 0.9, START, "13.jpg")
+        await reading_filter.submit(meter, 14, 0.9, START, "14.jpg")  # Ties: the latest
+        await reading_filter.close()  # Publishes the open window at once
+        assert published.values == [11, 14]
+
+    asyncio.run(run())
@@ -0,0 +1,45 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Tests of the local filesystem image store (helpers/storage.py): objects shared between names, removed with
+# their last name, and written again when removed while being linked to a new name.
+#
+import os
+
+from helpers import storage
+
+
+def objects(store):
+    return [name for _, _, files in os.walk(store.objects_dir) for name in files]
+
+
+def test_object_removed_with_its_last_name(tmp_path):
+    store = storage.LocalFileStore(str(tmp_path))
+    store.put("a.jpg", b"same")
+    store.put("b.jpg", b"same")
+    assert len(objects(store)) == 1
+
+    store.put("a.jpg", b"other")  # b.jpg still references the first object
+    assert len(objects(store)) == 2
+    assert store.delete(["b.jpg"]) == {"deleted_files_count": 1, "reclaimed_bytes": 4}
+    assert len(objects(store)) == 1
+    assert store.read("a.jpg")[0] == b"other"
+
+
+def test_object_removed_while_linked_is_written_again(tmp_path, monkeypatch):
+    store = storage.LocalFileStore(str(tmp_path))
+    store.put("a.jpg", b"same")
+    link = os.link
+
+    def delete_first(source, target):
+        # A concurrent delete of the last name of the object, between the check and the link
+        monkeypatch.setattr(storage.os, "link", link)
+        store.delete(["a.jpg"])
+        return link(source, target)
+
+    monkeypatch.setattr(storage.os, "link", delete_first)
+    store.put("b.jpg", b"same")
+
+    assert store.read("b.jpg")[0] == b"same"
+    assert os.stat(store._name_path("b.jpg")).st_nlink == 2  # Linked to the object written again
+    assert os.listdir(store.tmp_dir) == []
@@ -0,0 +1,66 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Tests of the pruning to the storage quota (helpers/monogodb_handler.py): just enough of the oldest entries are
+# selected to get below the quota, each stored file counted once even if several fields of an entry reference it.
+#
+import pytest
+
+from helpers.monogodb_handler import MongoDBHandler
+
+SIZES = {f"{index}.jpg": 100 for index in range(10)} | {f"{index}_counter.jpg": 10 for index in range(10)}
+
+
+class Cursor(list):
+    def sort(self, keys):
+        return self
+
+    def limit(self, count):
+        return Cursor(self[:count])
+
+
+class Collection:
+    """Metadata entries, oldest first."""
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def find(self, query, projection):
+        return Cursor(self.entries)
+
+
+class Store:
+    def sizes(self, filenames):
+        return {name: SIZES[name] for name in filenames if name in SIZES}
+
+
+@pytest.fixture
+def handler():
+    handler = MongoDBHandler.__new__(MongoDBHandler)  # Without a connection to MongoDB
+    handler.collection = Collection([{"_id": index, "filename": f"{index}.jpg", "file_name_image": f"{index}.jpg",
+                                      "file_name_counter": f"{index}_counter.jpg"} for index in range(10)])
+    handler.store = Store()
+    handler.selected = []
+
+    def delete_entries(entries):
+        handler.selected.append([entry["_id"] for entry in entries])
+        handler.collection.entries = handler.collection.entries[len(entries):]
+        reclaimed = sum(SIZES[name] for entry in entries for name in {entry["filename"], entry["file_name_counter"]})
+        return {"deleted_metadata_count": len(entries), "deleted_files_count": 2 * len(entries),
+                "reclaimed_bytes": reclaimed}
+
+    handler.delete_entries = delete_entries
+    handler.get_storage_bytes = lambda: sum(SIZES.values())  # 1100 bytes, 110 per entry
+    return handler
+
+
+@pytest.mark.parametrize("max_bytes, selected", [
+    (1000, [0]),           # 100 bytes over the quota: the first entry (110 bytes) is enough
+    (800, [0, 1, 2]),      # 300 bytes over: 330 bytes selected, not 2 entries counting their image twice
+    (1100, []),
+])
+def test_selects_just_enough_entries_in_one_pass(handler, max_bytes, selected):
+    totals = handler.prune_to_storage_quota(max_bytes)
+
+    assert handler.selected == ([selected] if selected else [])
+    assert totals["reclaimed_bytes"] == 110 * len(selected)
@@ -0,0 +1,92 @@
+# (c) 2024 Yonz
+# License: Nonlicense
+#
+# Tests of the streaming of stored files (helpers/streaming.py): the whole file (200), a byte range
+# (206 Partial Content), a range outside of the file (416) and an invalid range (ignored: 200), through a Quart
+# test client.
+#
+import io
+import asyncio
+
+import pytest
+from quart import Quart, request
+
+from helpers import streaming
+
+CONTENT = bytes(range(256)) * 4  # 1024 bytes
+
+
+class StoredFile(io.BytesIO):
+    """Stand-in for a GridOut, recording that it was closed."""
+
+    closed_files = []
+
+    def close(self):
+        StoredFile.closed_files.append(self)
+        super().close()
+
+
+@pytest.fixture
+def get():
+    """get(range_header) -> (status, headers, body) of the response streaming CONTENT in chunks of 100 bytes."""
+    app = Quart(__name__)
+
+    @app.route("/file")
+    async def stored_file():
+        return streaming.file_response(StoredFile(CONTENT), len(CONTENT), request.headers.get("Range"), "image/jpeg",
+                                       {"ETag": '"1"'}, chunk_size=100)
+
+    def factory(range_header=None):
+        async def run():
+            response = await app.test_client().get("/file", headers={"Range": range_header} if range_header else {})
+            return response.status_code, response.headers, await response.get_data()
+
+        StoredFile.closed_files.clear()
+        return asyncio.run(run())
+
+    return factory
+
+
+def test_whole_file(get):
+    status, headers, body = get()
+
+    assert status == 200
+    assert body == CONTENT
+    assert headers["Content-Length"] == "1024"
+    assert headers["Accept-Ranges"] == "bytes"
+    assert headers["ETag"] == '"1"'
+    assert len(StoredFile.closed_files) == 1
+
+
+@pytest.mark.parametrize("range_header, start, end", [
+    ("bytes=0-99", 0, 99),
+    ("bytes=150-449", 150, 449),   # Across chunks
+    ("bytes=1000-", 1000, 1023),   # Open ended
+    ("bytes=-24", 1000, 1023),     # Suffix
+    ("bytes=1000-5000", 1000, 1023),
+])
+def test_partial_content(get, range_header, start, end):
+    status, headers, body = get(range_header)
+
+    assert status == 206
+    assert body == CONTENT[start:end + 1]
+    assert headers["Content-Range"] == f"bytes {start}-{end}/1024"
+    assert headers["Content-Length"] == str(end - start + 1)
+
+
+@pytest.mark.parametrize("range_header", ["bytes=1024-", "bytes=-0"])
+def test_range_not_satisfiable(get, range_header):
+    status, headers, body = get(range_header)
+
+    assert status == 416
+    assert headers["Content-Range"] == "bytes */1024"
+    assert body == b""
+    assert len(StoredFile.closed_files) == 1
+
+
+@pytest.mark.parametrize("range_header", ["bytes=0-1,5-6", "items=0-1", "bytes=a-b", "bytes=500-100"])
+def test_unsupported_range_sends_the_whole_file(get, range_header):
+    status, _, body = get(range_header)
+
+    assert status == 200
+    assert body == CONTENT